@@ -40,6 +40,26 @@ setuptools.setup(
                 '{pkg}.engine.main:main'
                 .format(pkg=PACKAGE)
             ),
+            (
+                '{pkg}_search = '
+                '{pkg}.engine.search:main'
+                .format(pkg=PACKAGE)
+            ),
+            (
+                '{pkg}_ann_bench = '
+                '{pkg}.engine.ann_bench:main'
+                .format(pkg=PACKAGE)
+            ),
+            (
+                '{pkg}_export = '
+                '{pkg}.engine.export:main'
+                .format(pkg=PACKAGE)
+            ),
+            (
+                '{pkg}_quantize = '
+                '{pkg}.engine.quantize:main'
+                .format(pkg=PACKAGE)
+            ),
         ]
     }
 ) 
@@ -1,5 +1,6 @@
 # Global imports
 import os
+import re
 import json
 import collections
 import numpy as np
@@ -209,8 +210,22 @@ class SSLBatchSampler(BatchSampler):
         return _replica_list
 
 
+# Video frame names, e.g., PRW: c1s2_000151.jpg = camera 1, sequence 2, frame 151
+VIDEO_FRAME_PATTERN = re.compile(r'^c(\d+)s(\d+)_(\d+)\.\w+$')
+
+def get_video_frame_key(file_name):
+    """
+    Returns the ((camera, sequence), frame) key of a video frame from its
+    file name, or None if the name does not follow the video frame pattern.
+    """
+    match = VIDEO_FRAME_PATTERN.match(os.path.basename(file_name))
+    if match is None:
+        return None
+    camera, sequence, frame = [int(x) for x in match.groups()]
+    return (camera, sequence), frame
+
 class TestSampler(torch.utils.data.Sampler):
-    def __init__(self, partition_name, dataset, retrieval_dir, retrieval_name_list):
+    def __init__(self, partition_name, dataset, retrieval_dir, retrieval_name_list, video_order=False):
         # If dataset is subset, get dataset object
         if isinstance(dataset, torch.utils.data.Subset):
             dataset = dataset.dataset
@@ -243,6 +258,17 @@ class TestSampler(torch.utils.data.Sampler):
             image_id_list = list(image_id_set)
             self.image_idx_list = [dataset.ids.index(_id) for _id in image_id_list]
             self.query_id_list = [int(x) for x in list(query_id_set)]
+        # Map from image_id to video frame key, for images with video frame names
+        self.frame_key_dict = {}
+        for image_idx in self.image_idx_list:
+            image_id = dataset.ids[image_idx]
+            frame_key = get_video_frame_key(dataset.coco.imgs[image_id]['file_name'])
+            if frame_key is not None:
+                self.frame_key_dict[image_id] = frame_key
+        # Iterate over video frames in camera order, followed by other images
+        if video_order:
+            self.image_idx_list = sorted(self.image_idx_list,
+                key=lambda i: (0, self.frame_key_dict[dataset.ids[i]]) if dataset.ids[i] in self.frame_key_dict else (1, i))
 
     def __iter__(self):
         for image_idx in self.image_idx_list:
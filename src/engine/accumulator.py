@@ -0,0 +1,152 @@
+# Global imports
+import array
+import collections.abc
+## torch
+import torch
+
+
+class RaggedBuffer:
+    """
+    Growable buffer holding a sequence of tensors which share all but their
+    first dim, stored back to back in one preallocated tensor. Capacity is
+    doubled when full, so appends are amortized O(1) and the number of
+    allocated tensors does not grow with the number of entries.
+
+    A None value is stored as an empty entry with an invalid flag.
+    """
+    def __init__(self, initial_capacity=1024):
+        self.initial_capacity = initial_capacity
+        self.data = None
+        self.size = 0
+        self.scalar = False
+        self.starts = array.array('q')
+        self.ends = array.array('q')
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _reserve(self, num_rows):
+        capacity = self.data.shape[0]
+        if (self.size + num_rows) > capacity:
+            new_capacity = max(2 * capacity, self.size + num_rows)
+            new_data = self.data.new_empty((new_capacity,) + tuple(self.data.shape[1:]))
+            new_data[:self.size] = self.data[:self.size]
+            self.data = new_data
+
+    def append(self, value):
+        # None: store an invalid entry
+        if value is None:
+            self.starts.append(-1)
+            self.ends.append(-1)
+            return len(self.starts) - 1
+        value = value.detach()
+        if self.data is None:
+            self.scalar = value.dim() == 0
+            self.data = value.new_empty((self.initial_capacity,) + tuple(value.shape[1:]))
+        value = value.reshape((-1,) + tuple(self.data.shape[1:]))
+        num_rows = value.shape[0]
+        self._reserve(num_rows)
+        self.data[self.size:self.size+num_rows] = value
+        self.starts.append(self.size)
+        self.ends.append(self.size + num_rows)
+        self.size += num_rows
+        return len(self.starts) - 1
+
+    def __getitem__(self, index):
+        start, end = self.starts[index], self.ends[index]
+        if start < 0:
+            return None
+        if self.scalar:
+            return self.data[start]
+        return self.data[start:end]
+
+    def trim(self):
+        """
+        Releases unused capacity.
+        """
+        if (self.data is not None) and (self.data.shape[0] > self.size):
+            self.data = self.data[:self.size].clone()
+
+
+class LookupAccumulator:
+    """
+    Streaming accumulator for lookup dicts of namedtuple entries (e.g.,
+    DetectionLookupEntry), built one eval step at a time. Each entry field is
+    appended to its own RaggedBuffer, so memory scales with the total number
+    of rows (e.g., detections) rather than with the number of entries.
+
+    Lookups may be flat {key: entry} (OC) or nested {key: {subkey: entry}}
+    (QC). The accumulated lookup is returned as a read-only mapping with the
+    same structure, whose entries are views into the buffers.
+    """
+    def __init__(self, entry_type, nested=False, initial_capacity=1024):
+        self.entry_type = entry_type
+        self.nested = nested
+        self.buffer_dict = {field:RaggedBuffer(initial_capacity=initial_capacity) for field in entry_type._fields}
+        self.index_dict = {}
+        self.num_entry = 0
+
+    def __len__(self):
+        return self.num_entry
+
+    def _add_entry(self, entry):
+        for field, value in zip(entry._fields, entry):
+            self.buffer_dict[field].append(value)
+        self.num_entry += 1
+        return self.num_entry - 1
+
+    def add(self, lookup):
+        """
+        Appends all entries of a (per-step) lookup dict.
+        """
+        for key, value in lookup.items():
+            if self.nested:
+                sub_index_dict = self.index_dict.setdefault(key, {})
+                for sub_key, entry in value.items():
+                    sub_index_dict[sub_key] = self._add_entry(entry)
+            else:
+                self.index_dict[key] = self._add_entry(value)
+
+    def get_entry(self, index):
+        return self.entry_type(*[self.buffer_dict[field][index] for field in self.entry_type._fields])
+
+    def lookup(self):
+        """
+        Trims the buffers and returns the accumulated lookup.
+        """
+        for buffer in self.buffer_dict.values():
+            buffer.trim()
+        if self.nested:
+            return _NestedLookupView(self, self.index_dict)
+        else:
+            return _LookupView(self, self.index_dict)
+
+
+class _LookupView(collections.abc.Mapping):
+    def __init__(self, accumulator, index_dict):
+        self.accumulator = accumulator
+        self.index_dict = index_dict
+
+    def __getitem__(self, key):
+        return self.accumulator.get_entry(self.index_dict[key])
+
+    def __iter__(self):
+        return iter(self.index_dict)
+
+    def __len__(self):
+        return len(self.index_dict)
+
+
+class _NestedLookupView(collections.abc.Mapping):
+    def __init__(self, accumulator, index_dict):
+        self.accumulator = accumulator
+        self.index_dict = index_dict
+
+    def __getitem__(self, key):
+        return _LookupView(self.accumulator, self.index_dict[key])
+
+    def __iter__(self):
+        return iter(self.index_dict)
+
+    def __len__(self):
+        return len(self.index_dict)
@@ -0,0 +1,300 @@
+# Global imports
+## torch
+import torch
+import torch.nn.functional as F
+
+# Package imports
+from osr.engine.metrics import ragged_range
+
+
+# Function to run k-means on the rows of x
+def _kmeans(x, num_cluster, num_iter=20, spherical=False, seed=0, chunk_size=65536):
+    """
+    Lloyd's k-means. If spherical is True, rows are assumed to be normalized,
+    assignment uses the inner product, and centroids are re-normalized.
+    Empty clusters are re-seeded with random points.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    num_cluster = min(num_cluster, len(x))
+    centroids = x[torch.randperm(len(x), generator=generator)[:num_cluster]].clone()
+    for _ in range(num_iter):
+        assign = _assign(x, centroids, spherical=spherical, chunk_size=chunk_size)
+        counts = torch.bincount(assign, minlength=num_cluster)
+        new_centroids = torch.zeros_like(centroids).index_add_(0, assign, x)
+        new_centroids = new_centroids / counts.clamp(min=1).unsqueeze(1).to(x.dtype)
+        ## Re-seed empty clusters
+        empty_idx = torch.where(counts == 0)[0]
+        if len(empty_idx) > 0:
+            new_centroids[empty_idx] = x[torch.randint(len(x), (len(empty_idx),), generator=generator)]
+        if spherical:
+            new_centroids = F.normalize(new_centroids, dim=1)
+        centroids = new_centroids
+    return centroids
+
+
+# Function to assign each row of x to its closest centroid
+def _assign(x, centroids, spherical=False, chunk_size=65536):
+    assign_list = []
+    for start in range(0, len(x), chunk_size):
+        _x = x[start:start + chunk_size]
+        if spherical:
+            assign_list.append((_x @ centroids.T).argmax(dim=1))
+        else:
+            assign_list.append(torch.cdist(_x, centroids).argmin(dim=1))
+    return torch.cat(assign_list) if len(assign_list) > 0 else torch.zeros(0, dtype=torch.long)
+
+
+# Exact inner product search baseline
+class FlatIndex:
+    """
+    Exact nearest-neighbor search over L2-normalized embeddings, computed as
+    a chunked matrix product with a running top-k.
+    """
+    def __init__(self, chunk_size=65536):
+        self.chunk_size = chunk_size
+        self.emb = None
+
+    def train(self, emb):
+        pass
+
+    def add(self, emb):
+        emb = F.normalize(emb.detach().float().cpu(), dim=-1)
+        self.emb = emb if self.emb is None else torch.cat([self.emb, emb])
+
+    def __len__(self):
+        return 0 if self.emb is None else len(self.emb)
+
+    @torch.no_grad()
+    def search(self, query_emb, top_k):
+        """
+        Returns [Q, top_k] scores and indices of the most similar embeddings,
+        padded with -inf and -1 if fewer than top_k embeddings are indexed.
+        """
+        query_emb = F.normalize(query_emb.detach().float().cpu(), dim=-1)
+        num_query = len(query_emb)
+        best_score = torch.full((num_query, 0), -float('inf'))
+        best_idx = torch.zeros((num_query, 0), dtype=torch.long)
+        for start in range(0, len(self), self.chunk_size):
+            sims = query_emb @ self.emb[start:start + self.chunk_size].T
+            chunk_score, chunk_idx = torch.topk(sims, min(top_k, sims.size(1)), dim=1)
+            cat_score = torch.cat([best_score, chunk_score], dim=1)
+            cat_idx = torch.cat([best_idx, chunk_idx + start], dim=1)
+            best_score, _idx = torch.topk(cat_score, min(top_k, cat_score.size(1)), dim=1)
+            best_idx = torch.gather(cat_idx, 1, _idx)
+        return _pad_result(best_score, best_idx, top_k)
+
+
+# Helper to pad search results to top_k columns
+def _pad_result(score, idx, top_k):
+    pad = top_k - score.size(1)
+    if pad > 0:
+        score = F.pad(score, (0, pad), value=-float('inf'))
+        idx = F.pad(idx, (0, pad), value=-1)
+    return score, idx
+
+
+# Helper to get the top-k of each query from flat candidates sorted by query
+def _candidate_topk(cand_score, cand_query, num_query, top_k):
+    """
+    Returns a [num_query, top_k] tensor of flat candidate indices, padded with
+    -1, using one padded torch.topk instead of sorting all candidates.
+    """
+    counts = torch.bincount(cand_query, minlength=num_query)
+    _, rank = ragged_range(counts)
+    max_count = counts.max().item() if num_query > 0 else 0
+    padded_score = torch.full((num_query, max_count), -float('inf'))
+    padded_score[cand_query, rank] = cand_score
+    padded_idx = torch.full((num_query, max_count), -1, dtype=torch.long)
+    padded_idx[cand_query, rank] = torch.arange(len(cand_score))
+    _, topk_pos = torch.topk(padded_score, min(top_k, max_count), dim=1)
+    topk_idx = torch.gather(padded_idx, 1, topk_pos)
+    return _pad_result(topk_idx.float(), topk_idx, top_k)[1]
+
+
+# Inverted file index with optional product quantization
+class IVFIndex:
+    """
+    Approximate inner product search over L2-normalized embeddings.
+
+    A coarse quantizer (spherical k-means with num_list centroids) splits the
+    embeddings into inverted lists, and only the num_probe lists closest to
+    each query are scanned. If pq_m is set, the residual of each embedding to
+    its list centroid is stored as pq_m one-byte product quantization codes,
+    and list entries are scored with per-query lookup tables (asymmetric
+    distance computation). If rerank_k is set, the rerank_k best approximate
+    candidates are re-scored exactly with the stored fp16 embeddings.
+    """
+    def __init__(self, num_list=1024, num_probe=16, pq_m=None, pq_bits=8, rerank_k=None,
+            num_iter=20, query_chunk_size=256, seed=0):
+        self.num_list = num_list
+        self.num_probe = num_probe
+        self.pq_m = pq_m
+        self.pq_bits = pq_bits
+        self.rerank_k = rerank_k
+        self.num_iter = num_iter
+        self.query_chunk_size = query_chunk_size
+        self.seed = seed
+        self.centroids = None
+        self.codebooks = None
+        # Entries sorted by list: original index, codes, and embeddings
+        self.entry_idx = torch.zeros(0, dtype=torch.long)
+        self.entry_list = torch.zeros(0, dtype=torch.long)
+        self.codes = None
+        self.emb = None
+        self.list_offset = None
+        self.list_count = None
+
+    def __len__(self):
+        return len(self.entry_idx)
+
+    @torch.no_grad()
+    def train(self, emb):
+        """
+        Trains the coarse quantizer, and the product quantizer codebooks on
+        the residuals, from a sample of embeddings.
+        """
+        emb = F.normalize(emb.detach().float().cpu(), dim=-1)
+        self.centroids = _kmeans(emb, self.num_list, num_iter=self.num_iter, spherical=True, seed=self.seed)
+        if self.pq_m is not None:
+            dim = emb.size(1)
+            if dim % self.pq_m != 0:
+                raise ValueError('Embedding dim {} is not divisible by pq_m={}'.format(dim, self.pq_m))
+            residual = emb - self.centroids[_assign(emb, self.centroids, spherical=True)]
+            sub_residual = residual.view(len(emb), self.pq_m, -1)
+            self.codebooks = torch.stack([_kmeans(sub_residual[:, m], 2 ** self.pq_bits,
+                num_iter=self.num_iter, seed=self.seed + m) for m in range(self.pq_m)])
+
+    @torch.no_grad()
+    def add(self, emb):
+        if self.centroids is None:
+            raise RuntimeError('IVFIndex must be trained before adding embeddings')
+        emb = F.normalize(emb.detach().float().cpu(), dim=-1)
+        new_list = _assign(emb, self.centroids, spherical=True)
+        new_idx = torch.arange(len(self), len(self) + len(emb))
+        # Encode residuals
+        if self.pq_m is not None:
+            sub_residual = (emb - self.centroids[new_list]).view(len(emb), self.pq_m, -1)
+            new_codes = torch.stack([_assign(sub_residual[:, m], self.codebooks[m])
+                for m in range(self.pq_m)], dim=1).to(torch.uint8)
+            self.codes = new_codes if self.codes is None else torch.cat([self.codes, new_codes])
+        ## Exact embeddings are only needed without PQ, or to re-rank
+        if (self.pq_m is None) or (self.rerank_k is not None):
+            new_emb = emb if self.pq_m is None else emb.half()
+            self.emb = new_emb if self.emb is None else torch.cat([self.emb, new_emb])
+        # Re-sort all entries by list
+        entry_idx = torch.cat([self.entry_idx, new_idx])
+        entry_list = torch.cat([self.entry_list, new_list])
+        sort_idx = torch.argsort(entry_list, stable=True)
+        self.entry_idx, self.entry_list = entry_idx[sort_idx], entry_list[sort_idx]
+        if self.codes is not None:
+            self.codes = self.codes[sort_idx]
+        if self.emb is not None:
+            self.emb = self.emb[sort_idx]
+        self.list_count = torch.bincount(self.entry_list, minlength=len(self.centroids))
+        self.list_offset = self.list_count.cumsum(0) - self.list_count
+
+    @torch.no_grad()
+    def search(self, query_emb, top_k):
+        """
+        Returns [Q, top_k] scores and indices of the most similar embeddings,
+        padded with -inf and -1 if fewer than top_k candidates are found.
+        """
+        query_emb = F.normalize(query_emb.detach().float().cpu(), dim=-1)
+        score_list, idx_list = [], []
+        for start in range(0, len(query_emb), self.query_chunk_size):
+            score, idx = self._search_chunk(query_emb[start:start + self.query_chunk_size], top_k)
+            score_list.append(score)
+            idx_list.append(idx)
+        if len(score_list) == 0:
+            return torch.zeros((0, top_k)), torch.zeros((0, top_k), dtype=torch.long)
+        return torch.cat(score_list), torch.cat(idx_list)
+
+    def _search_chunk(self, query_emb, top_k):
+        num_query = len(query_emb)
+        # Probe the closest lists
+        coarse_sims = query_emb @ self.centroids.T
+        num_probe = min(self.num_probe, len(self.centroids))
+        probe_sims, probe_list = torch.topk(coarse_sims, num_probe, dim=1)
+        if self.pq_m is not None:
+            ## q.x ~= q.c + sum_m q_m.codebook_m[code_m]
+            lut = torch.einsum('qmd,mkd->qmk', query_emb.view(num_query, self.pq_m, -1), self.codebooks)
+            lut_offset = torch.arange(self.pq_m) * lut.size(2)
+            lut = lut.reshape(num_query, -1)
+        keep_k = top_k if (self.pq_m is None) or (self.rerank_k is None) else max(self.rerank_k, top_k)
+        # Scan each probed list once for all queries probing it, keeping the best keep_k entries
+        pair_query = torch.arange(num_query).repeat_interleave(num_probe)
+        pair_list, pair_sims = probe_list.view(-1), probe_sims.view(-1)
+        pair_order = torch.argsort(pair_list, stable=True)
+        unique_list, unique_count = torch.unique_consecutive(pair_list[pair_order], return_counts=True)
+        cand_query_list, cand_score_list, cand_entry_list = [], [], []
+        for list_idx, pair_idx in zip(unique_list.tolist(), torch.split(pair_order, unique_count.tolist())):
+            start, count = self.list_offset[list_idx].item(), self.list_count[list_idx].item()
+            if count == 0:
+                continue
+            _query = pair_query[pair_idx]
+            if self.pq_m is None:
+                sims = query_emb[_query] @ self.emb[start:start + count].T
+            else:
+                ## Offset codes into the flattened [pq_m * num_code] lookup table
+                codes = self.codes[start:start + count].long() + lut_offset
+                sims = pair_sims[pair_idx].unsqueeze(1) + \
+                    lut[_query].index_select(1, codes.view(-1)).view(len(_query), count, self.pq_m).sum(dim=2)
+            _score, _local = torch.topk(sims, min(keep_k, count), dim=1)
+            cand_query_list.append(_query.unsqueeze(1).expand_as(_local).reshape(-1))
+            cand_score_list.append(_score.reshape(-1))
+            cand_entry_list.append((_local + start).reshape(-1))
+        if len(cand_query_list) == 0:
+            return _pad_result(torch.zeros((num_query, 0)), torch.zeros((num_query, 0), dtype=torch.long), top_k)
+        cand_query = torch.cat(cand_query_list)
+        cand_score = torch.cat(cand_score_list)
+        cand_entry = torch.cat(cand_entry_list)
+        ## Sort candidates by query
+        cand_order = torch.argsort(cand_query, stable=True)
+        cand_query, cand_score, cand_entry = cand_query[cand_order], cand_score[cand_order], cand_entry[cand_order]
+        # Re-rank the best approximate candidates exactly
+        if (self.pq_m is not None) and (self.rerank_k is not None):
+            keep_idx = _candidate_topk(cand_score, cand_query, num_query, keep_k).view(-1)
+            keep_idx = keep_idx[keep_idx >= 0]
+            cand_query, cand_entry = cand_query[keep_idx], cand_entry[keep_idx]
+            cand_score = (query_emb[cand_query] * self.emb[cand_entry].float()).sum(dim=1)
+        # Get the top-k candidates of each query
+        topk_idx = _candidate_topk(cand_score, cand_query, num_query, top_k)
+        valid_mask = topk_idx >= 0
+        score = torch.full((num_query, top_k), -float('inf'))
+        idx = torch.full((num_query, top_k), -1, dtype=torch.long)
+        score[valid_mask] = cand_score[topk_idx[valid_mask]]
+        idx[valid_mask] = self.entry_idx[cand_entry[topk_idx[valid_mask]]]
+        return score, idx
+
+
+# Function to build an ANN index from its mode string
+def get_ann_index(ann_mode, num_list=1024, num_probe=16, pq_m=None, rerank_k=None, seed=0):
+    """
+    ann_mode:
+        'flat': exact search
+        'ivf': inverted file index, exact scores within probed lists
+        'ivfpq': inverted file index with product quantized residuals
+    """
+    if ann_mode == 'flat':
+        return FlatIndex()
+    elif ann_mode == 'ivf':
+        return IVFIndex(num_list=num_list, num_probe=num_probe, seed=seed)
+    elif ann_mode == 'ivfpq':
+        return IVFIndex(num_list=num_list, num_probe=num_probe, pq_m=pq_m, rerank_k=rerank_k, seed=seed)
+    else:
+        raise NotImplementedError
+
+
+# Function to compute the recall of approximate top-k results with respect to exact results
+def get_recall_at_k(exact_idx, approx_idx, k_list):
+    """
+    Returns {k: fraction of the exact top-k which is in the approximate top-k},
+    averaged over queries, for each k in k_list.
+    """
+    recall_dict = {}
+    for k in k_list:
+        _exact_idx, _approx_idx = exact_idx[:, :k], approx_idx[:, :k]
+        hit = (_exact_idx.unsqueeze(2) == _approx_idx.unsqueeze(1)).any(dim=2) & (_exact_idx >= 0)
+        num_valid = (_exact_idx >= 0).sum().item()
+        recall_dict[k] = hit.sum().item() / max(num_valid, 1)
+    return recall_dict
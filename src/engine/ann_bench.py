@@ -0,0 +1,110 @@
+# Global imports
+import time
+import argparse
+
+# Package imports
+from osr.engine import evaluate
+from osr.engine import lookup_store
+from osr.engine.ann import get_recall_at_k
+
+
+# Function to benchmark ANN OC retrieval against exact retrieval
+def benchmark_ann(data_loader, query_lookup, image_lookup, detection_lookup,
+        ann_config_list, top_k=1000, recall_k_list=(1, 10, 100), retrieval_eval_mode='fast'):
+    """
+    For each ANN config (a dict with ann_mode and index kwargs), reports the
+    index build and search time, recall@k of the ANN results with respect to
+    exact top-k search, and the mAP and top-1 deltas of each retrieval
+    protocol with respect to exact retrieval over all detections.
+    """
+    query_embeddings, _ = evaluate.get_query_embeddings(query_lookup, image_lookup)
+    _, retrieval_lookup, _ = evaluate.evaluate_detection_orig(data_loader.sampler.partition_name,
+        detection_lookup, image_lookup, query_embeddings)
+    protocol_list = evaluate.get_protocol_list(data_loader)
+
+    # Function to compute the retrieval metrics of each protocol
+    def _get_metrics(_retrieval_lookup):
+        _metric_dict = {}
+        for protocol in protocol_list:
+            _protocol_metric_dict, _ = evaluate.evaluate_retrieval(protocol,
+                _retrieval_lookup, query_lookup, image_lookup, retrieval_eval_mode=retrieval_eval_mode)
+            _metric_dict.update({k:v for k, v in _protocol_metric_dict.items() if k.endswith(('_mAP', '_top1'))})
+        return _metric_dict
+
+    # Exact baselines: all detections, and exact top-k
+    exact_metric_dict = _get_metrics(retrieval_lookup)
+    _, exact_idx = evaluate.get_ann_retrieval_lookup(retrieval_lookup, detection_lookup, query_embeddings,
+        ann_mode='flat', top_k=top_k)
+
+    # Evaluate each ANN config
+    result_list = []
+    for ann_config in ann_config_list:
+        start_time = time.time()
+        ann_retrieval_lookup, ann_idx = evaluate.get_ann_retrieval_lookup(retrieval_lookup, detection_lookup,
+            query_embeddings, top_k=top_k, **ann_config)
+        ann_time = time.time() - start_time
+        ann_metric_dict = _get_metrics(ann_retrieval_lookup)
+        result_list.append({
+            'config': ann_config,
+            'time': ann_time,
+            'recall': get_recall_at_k(exact_idx, ann_idx, [k for k in recall_k_list if k <= top_k]),
+            'delta': {k:ann_metric_dict[k] - v for k, v in exact_metric_dict.items()},
+        })
+    return exact_metric_dict, result_list
+
+
+# Main function
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ANN OC retrieval on a stored lookup')
+    parser.add_argument('--store_dir', required=True,
+        help='Lookup store directory saved from an OC evaluation (see lookup_store_dir)')
+    parser.add_argument('--ann_mode_list', nargs='+', default=['flat', 'ivf', 'ivfpq'])
+    parser.add_argument('--top_k', type=int, default=1000)
+    parser.add_argument('--num_list', type=int, default=1024)
+    parser.add_argument('--num_probe_list', type=int, nargs='+', default=[4, 16, 64])
+    parser.add_argument('--pq_m', type=int, default=16)
+    parser.add_argument('--rerank_k', type=int, default=4096)
+    parser.add_argument('--train_size', type=int, default=100000)
+    parser.add_argument('--recall_k_list', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--retrieval_name_list', nargs='+', default=None)
+    parser.add_argument('--retrieval_eval_mode', default='fast')
+    args = parser.parse_args()
+
+    # Load lookups
+    data_loader, eval_mode, query_lookup, image_lookup, detection_lookup, _ = lookup_store.load_lookups(
+        args.store_dir, retrieval_name_list=args.retrieval_name_list, device='cpu')
+    if eval_mode == 'qc':
+        raise ValueError('ANN retrieval applies to OC lookups, but the store has eval_mode: {}'.format(eval_mode))
+
+    # Build configs: the flat index does not depend on the number of probes
+    ann_config_list = []
+    for ann_mode in args.ann_mode_list:
+        for num_probe in [None] if ann_mode == 'flat' else args.num_probe_list:
+            ann_config = {'ann_mode': ann_mode}
+            if ann_mode != 'flat':
+                ann_config.update({'num_list': args.num_list, 'num_probe': num_probe,
+                    'train_size': args.train_size})
+            if ann_mode == 'ivfpq':
+                ann_config.update({'pq_m': args.pq_m, 'rerank_k': args.rerank_k})
+            ann_config_list.append(ann_config)
+
+    # Run benchmark
+    exact_metric_dict, result_list = benchmark_ann(data_loader, query_lookup, image_lookup, detection_lookup,
+        ann_config_list, top_k=args.top_k, recall_k_list=args.recall_k_list,
+        retrieval_eval_mode=args.retrieval_eval_mode)
+
+    # Report results
+    print('==> Exact retrieval:')
+    for k, v in exact_metric_dict.items():
+        print('    {}: {:.4f}'.format(k, v))
+    for result in result_list:
+        print('==> {}: {:.2f}s'.format(
+            ', '.join(['{}={}'.format(k, v) for k, v in result['config'].items()]), result['time']))
+        print('    recall: {}'.format(', '.join(['@{}={:.4f}'.format(k, v) for k, v in result['recall'].items()])))
+        for k, v in result['delta'].items():
+            print('    delta {}: {:+.4f}'.format(k, v))
+
+
+# Run main
+if __name__ == '__main__':
+    main()
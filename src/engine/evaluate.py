@@ -5,15 +5,18 @@ import torch
 import torch.nn.functional as F
 import os
 import json
+import tempfile
 import numpy as np
 from pprint import pprint
-from sklearn.metrics import average_precision_score
 from torchmetrics import Accuracy
 from tqdm import tqdm
 #from ray.tune.integration.torch import is_distributed_trainable
 from torchvision.ops import boxes as box_ops
 # Package imports
 from osr.engine import utils as engine_utils
+from osr.engine.metrics import average_precision, segment_average_precision, segment_argmax, ragged_range
+from osr.engine.ann import get_ann_index
+from osr.engine.pipeline import PackedHostTransfer, PendingOutput
 from osr.models.seqnext import SeqNeXt
 
 
@@ -24,13 +27,13 @@ QueryLookupEntry = collections.namedtuple('QueryLookupEntry',
 )
 
 ImageLookupEntry = collections.namedtuple('ImageLookupEntry',
-    ['id', 'person_ids', 'iou_thresh', 'boxes', 'scores', 'cws', 'embeddings', 'features'],
-    defaults=[None, None, None, None, None, None, None, None],
+    ['id', 'person_ids', 'iou_thresh', 'boxes', 'scores', 'cws', 'embeddings', 'features', 'emb_scale'],
+    defaults=[None, None, None, None, None, None, None, None, None],
 )
 
 DetectionLookupEntry = collections.namedtuple('DetectionLookupEntry',
-    ['boxes', 'scores', 'cws', 'embeddings', 'labels', 'anchors', 'anchor_boxes', 'anchor_scores'],
-    defaults=[None, None, None, None, None, None, None, None],
+    ['boxes', 'scores', 'cws', 'embeddings', 'labels', 'anchors', 'anchor_boxes', 'anchor_scores', 'emb_scale'],
+    defaults=[None, None, None, None, None, None, None, None, None],
 )
 
 RetrievalLookupEntry = collections.namedtuple('RetrievalLookupEntry',
@@ -42,11 +45,21 @@ Protocol = collections.namedtuple('Protocol',
     ['partition_name', 'name', 'data', 'image_queries']
 )
 
+DetectionVariant = collections.namedtuple('DetectionVariant',
+    ['use_anchor_boxes', 'use_anchor_scores', 'iou_thresh'],
+    defaults=[False, False, 0.5],
+)
+
 RetrievalBox = collections.namedtuple('RetrievalBox',
     ['image_id', 'box', 'score', 'match', 'query'],
     defaults=[None, None, None, None, None],
 )
 
+# GFN scores [Q] for each gallery image, and the min score [Q] for a (query, image) pair to be searched
+GFNGate = collections.namedtuple('GFNGate',
+    ['score_dict', 'query_thresh'],
+)
+
 
 
 # Get retrieval protocol information
@@ -94,7 +107,13 @@ def get_query_embeddings(query_lookup, image_lookup):
 
 
 def get_gfn_scores(model, image_lookup, query_embeddings, query_image_feat_list,
-        use_amp=False, use_gfn=False):
+        use_amp=False, use_gfn=False, tile_bytes=None, score_dir=None):
+    """
+    Returns a dict mapping each gallery image id to its [Q] GFN scores.
+
+    If tile_bytes is set, scores are computed tile by tile into a preallocated
+    [I, Q] score matrix, which is memory-mapped to a file in score_dir if set.
+    """
     # Compute GFN scores
     if use_gfn:
         ## Pack feats together for GFN or QFN
@@ -103,14 +122,127 @@ def get_gfn_scores(model, image_lookup, query_embeddings, query_image_feat_list,
         ## Get GFN
         gfn = model.head.gfn
         ## Get scores
-        with torch.cuda.amp.autocast(enabled=use_amp):
-            gfn_scores = gfn.get_scores(query_embeddings, query_img_feat_mat, gallery_img_feat_mat)
-        #print(gfn_scores.min(), gfn_scores.max())
-        gfn_score_dict = dict(zip(list(image_lookup.keys()), gfn_scores.T.cpu()))
+        if tile_bytes is None:
+            with torch.cuda.amp.autocast(enabled=use_amp):
+                gfn_scores = gfn.get_scores(query_embeddings, query_img_feat_mat, gallery_img_feat_mat)
+            #print(gfn_scores.min(), gfn_scores.max())
+            gfn_score_mat = gfn_scores.T.cpu()
+        else:
+            score_shape = (gallery_img_feat_mat.size(0), query_embeddings.size(0))
+            gfn_score_mat = _empty_score_matrix(score_shape, score_dir=score_dir)
+            with torch.cuda.amp.autocast(enabled=use_amp):
+                gfn.get_scores_tiled(query_embeddings, query_img_feat_mat, gallery_img_feat_mat,
+                    out=gfn_score_mat.T, tile_bytes=tile_bytes)
+        gfn_score_dict = dict(zip(list(image_lookup.keys()), gfn_score_mat))
     else:
         gfn_score_dict = None
     return gfn_score_dict
 
+
+# Function to get the per-query GFN score threshold for gated QC search
+def _get_gfn_gate_thresh(gfn_score_mat, thresh=None, top_m=None, valid_mat=None):
+    """
+    Returns the min GFN score [Q] for a (query, image) pair to be searched:
+    pairs are kept if their score is >= thresh, or if the image is within the
+    top_m images for the query. Only pairs where valid_mat is True, if given,
+    are ranked for top_m.
+    """
+    num_image, num_query = gfn_score_mat.shape
+    query_thresh = torch.full((num_query,), float('inf'))
+    if (thresh is None) and (top_m is None):
+        return torch.full((num_query,), -float('inf'))
+    if thresh is not None:
+        query_thresh = query_thresh.clamp(max=thresh)
+    if (top_m is not None) and (top_m > 0) and (num_image > 0):
+        topm_score_mat = gfn_score_mat.float()
+        if valid_mat is not None:
+            topm_score_mat = topm_score_mat.masked_fill(~valid_mat, -float('inf'))
+        topm_score = torch.topk(topm_score_mat, min(top_m, num_image), dim=0).values[-1]
+        query_thresh = torch.minimum(query_thresh, topm_score)
+    return query_thresh
+
+
+# Function to get the mask of (gallery image, query) pairs which are not a query with its own image
+def _get_gfn_gate_valid_mat(image_id_list, query_lookup):
+    valid_mat = torch.ones((len(image_id_list), len(query_lookup)), dtype=torch.bool)
+    image_index_dict = {image_id:i for i, image_id in enumerate(image_id_list)}
+    for query_entry in query_lookup.values():
+        query_image_index = image_index_dict.get(query_entry.image_id)
+        if query_image_index is not None:
+            valid_mat[query_image_index, query_entry.idx] = False
+    return valid_mat
+
+
+# Function to build the GFN gate for QC search
+def get_gfn_gate(gfn_score_dict, query_lookup=None, thresh=None, top_m=None):
+    """
+    gfn_score_dict maps each gallery image id to its GFN scores [Q], ordered
+    by QueryLookupEntry.idx (see get_query_embeddings). If query_lookup is
+    given, the top_m images of each query exclude its own image, as in
+    get_gfn_gate_curve.
+    """
+    gfn_score_mat = torch.stack(list(gfn_score_dict.values()))
+    valid_mat = None
+    if query_lookup is not None:
+        valid_mat = _get_gfn_gate_valid_mat(list(gfn_score_dict.keys()), query_lookup)
+    return GFNGate(score_dict=gfn_score_dict,
+        query_thresh=_get_gfn_gate_thresh(gfn_score_mat, thresh=thresh, top_m=top_m, valid_mat=valid_mat))
+
+
+# Function to measure the trade-off between GFN gate recall and search work
+def get_gfn_gate_curve(gfn_gate, query_lookup, image_lookup,
+        thresh_list=(), top_m_list=()):
+    """
+    For the gate in use and for each other operating point (a threshold or a
+    top-M), returns the fraction of (query, gallery image) pairs which would
+    be searched, and the fraction of pairs where the gallery image contains
+    the query person which would be kept (recall). Pairs of a query with its
+    own image are excluded.
+    """
+    gfn_score_dict = gfn_gate.score_dict
+    image_id_list = list(gfn_score_dict.keys())
+    gfn_score_mat = torch.stack([gfn_score_dict[i] for i in image_id_list]).float()
+    query_id_list = sorted(query_lookup, key=lambda q: query_lookup[q].idx)
+    # Ground truth pair matches, and pairs to exclude
+    pos_mat = torch.zeros(gfn_score_mat.shape, dtype=torch.bool)
+    valid_mat = _get_gfn_gate_valid_mat(image_id_list, query_lookup)
+    query_person_ids = torch.stack([query_lookup[q].person_id.cpu().reshape(()) for q in query_id_list])
+    for image_index, image_id in enumerate(image_id_list):
+        person_ids = image_lookup[image_id].person_ids.cpu()
+        pos_mat[image_index] = (query_person_ids.unsqueeze(1) == person_ids.unsqueeze(0)).any(dim=1)
+    pos_mat &= valid_mat
+    num_pair, num_pos = valid_mat.sum().item(), pos_mat.sum().item()
+    # Evaluate each operating point
+    curve_list = []
+    op_list = [('gate', None)] + [('thresh', t) for t in thresh_list] + [('top_m', m) for m in top_m_list]
+    for op_name, op_value in op_list:
+        if op_name == 'gate':
+            query_thresh = gfn_gate.query_thresh
+        elif op_name == 'thresh':
+            query_thresh = _get_gfn_gate_thresh(gfn_score_mat, thresh=op_value)
+        else:
+            query_thresh = _get_gfn_gate_thresh(gfn_score_mat, top_m=op_value, valid_mat=valid_mat)
+        keep_mat = (gfn_score_mat >= query_thresh.unsqueeze(0)) & valid_mat
+        curve_list.append({
+            'op': op_name if op_value is None else '{}={}'.format(op_name, op_value),
+            'pair_frac': keep_mat.sum().item() / max(num_pair, 1),
+            'recall': (keep_mat & pos_mat).sum().item() / max(num_pos, 1),
+        })
+    return curve_list
+
+
+# Function to preallocate a float32 score matrix, in memory or memory-mapped
+def _empty_score_matrix(shape, score_dir=None):
+    if (score_dir is None) or (0 in shape):
+        return torch.empty(shape, dtype=torch.float32)
+    os.makedirs(score_dir, exist_ok=True)
+    fd, score_path = tempfile.mkstemp(prefix='osr_gfn_scores_', suffix='.bin', dir=score_dir)
+    os.close(fd)
+    score_arr = np.memmap(score_path, dtype=np.float32, mode='w+', shape=shape)
+    ## The mapping stays valid after the file is unlinked, and the space is freed with it
+    os.remove(score_path)
+    return torch.from_numpy(score_arr)
+
 def run_step_classifier(model, batch):
     #
     images, targets = batch
@@ -132,7 +264,61 @@ def compute_metrics_classifier(class_logits, class_labels):
     }
     return metric_dict
 
-def run_step(model, batch, query_id_list):
+# Function to store embeddings at reduced precision
+def quantize_embeddings(embeddings, emb_precision='fp32'):
+    """
+    Returns a compact copy of embeddings [N, D], which never shares storage
+    with the batch tensor it was sliced from, and its per-vector scale [N]:
+        'fp32': float32, with no scale
+        'fp16': float16, with no scale
+        'int8': symmetric int8, with float32 scale: embeddings ~= values * scale
+    """
+    embeddings = embeddings.detach()
+    if emb_precision == 'fp32':
+        return embeddings.to(torch.float32, copy=True), None
+    elif emb_precision == 'fp16':
+        return embeddings.to(torch.float16, copy=True), None
+    elif emb_precision == 'int8':
+        embeddings = embeddings.float()
+        scale = embeddings.abs().amax(dim=-1).clamp(min=1e-12) / 127.0 if embeddings.shape[-1] > 0 \
+            else embeddings.new_ones(embeddings.shape[:-1])
+        values = torch.round(embeddings / scale.unsqueeze(-1)).clamp(-127, 127).to(torch.int8)
+        return values, scale
+    else:
+        raise NotImplementedError
+
+
+# Function to restore float32 embeddings from reduced precision storage
+def dequantize_embeddings(values, scale=None):
+    """
+    The per-vector scale cancels in cosine similarity, so it may be omitted
+    when the result is normalized.
+    """
+    embeddings = values.float()
+    if scale is not None:
+        embeddings = embeddings * scale.to(embeddings.device).unsqueeze(-1)
+    return embeddings
+
+
+# Function to store the embeddings of a lookup entry at reduced precision
+def quantize_entry(entry, emb_precision='fp32'):
+    embeddings = dequantize_embeddings(entry.embeddings, entry.emb_scale) if entry.emb_scale is not None else entry.embeddings
+    embeddings, emb_scale = quantize_embeddings(embeddings, emb_precision=emb_precision)
+    return entry._replace(embeddings=embeddings, emb_scale=emb_scale)
+
+
+# Function to store the embeddings of all entries of a (possibly nested QC) lookup at reduced precision
+def quantize_lookup(lookup, emb_precision='fp32'):
+    quantized_lookup = {}
+    for key, value in lookup.items():
+        if isinstance(value, tuple):
+            quantized_lookup[key] = quantize_entry(value, emb_precision=emb_precision)
+        else:
+            quantized_lookup[key] = {k:quantize_entry(v, emb_precision=emb_precision) for k, v in value.items()}
+    return quantized_lookup
+
+
+def run_step(model, batch, query_id_list, emb_precision='fp32'):
     #
     image_lookup = {}
     query_lookup = {}
@@ -142,11 +328,11 @@ def run_step(model, batch, query_id_list):
     #
     outputs = model(images, targets, inference_mode='both')
     #
-    embeddings = torch.cat([output['gt_emb'] for output in outputs])
     assert len(targets) == len(outputs)
     # XXX
     for target, output in zip(targets, outputs):
         image_id = target['image_id'].item()
+        embeddings = output['gt_emb']
         if 'scene_emb' in output:
             scene_emb = output['scene_emb']
         else:
@@ -171,10 +357,13 @@ def run_step(model, batch, query_id_list):
         for _id, _person_id, _box, _embedding in zip(target['id'].tolist(), target['person_id'], target['boxes'], embeddings.unsqueeze(1)):
             if _id in query_id_list:
                 query_lookup[_id] = QueryLookupEntry(image_id=image_id, person_id=_person_id,
-                    embedding=_embedding, box=_box)
+                    embedding=_embedding.clone(), box=_box)
+        # Store image and detection embeddings at reduced precision: queries are kept as is
+        image_lookup[image_id] = quantize_entry(image_lookup[image_id], emb_precision=emb_precision)
+        detection_lookup[image_id] = quantize_entry(detection_lookup[image_id], emb_precision=emb_precision)
     return query_lookup, image_lookup, detection_lookup
 
-def run_step_query(model, batch, query_id_list):
+def run_step_query(model, batch, query_id_list, emb_precision='fp32'):
     #
     image_lookup = {}
     query_lookup = {}
@@ -183,12 +372,12 @@ def run_step_query(model, batch, query_id_list):
     #
     outputs = model(images, targets, inference_mode='gt')
     #
-    embeddings = torch.cat([output['gt_emb'] for output in outputs])
-    loc_embeddings = torch.cat([output['gt_loc_emb'] for output in outputs])
     assert len(targets) == len(outputs)
     # XXX
     for target, output in zip(targets, outputs):
         image_id = target['image_id'].item()
+        embeddings = output['gt_emb']
+        loc_embeddings = output['gt_loc_emb']
         if 'scene_emb' in output:
             scene_emb = output['scene_emb']
         else:
@@ -203,107 +392,173 @@ def run_step_query(model, batch, query_id_list):
         for _id, _person_id, _box, _embedding, _loc_embedding in zip(target['id'].tolist(), target['person_id'], target['boxes'], embeddings.unsqueeze(1), loc_embeddings.unsqueeze(1)):
             if _id in query_id_list:
                 query_lookup[_id] = QueryLookupEntry(image_id=image_id, person_id=_person_id,
-                    embedding=_embedding, loc_embedding=_loc_embedding, box=_box)
+                    embedding=_embedding.clone(), loc_embedding=_loc_embedding.clone(), box=_box)
+        # Store image embeddings at reduced precision: queries are kept as is
+        image_lookup[image_id] = quantize_entry(image_lookup[image_id], emb_precision=emb_precision)
     return query_lookup, image_lookup
 
 
-def run_step_search(model, batch, query_id_list, query_lookup, image_lookup, protocol,
-        search_mode='all', compute_anchor_metrics=False):
+# Get the union of queries to search for in each gallery image of a batch, over all protocols
+def get_image_query_dict(protocol_list, query_id_list, targets):
+    """
+    Returns a dict mapping each gallery image_id in the batch (in batch order)
+    to the list of query ids to search for in that image. The search results
+    for each (gallery image, query) pair are shared by all protocols.
+    """
+    batch_image_id_list = [target['image_id'].item() for target in targets]
+    # Use dicts as ordered sets, so the query order is deterministic
+    image_query_set_dict = {image_id:{} for image_id in batch_image_id_list}
+    for protocol in protocol_list:
+        if protocol.name == 'all':
+            pid_lookup = dict(zip(
+                batch_image_id_list,
+                [set(target['id'].tolist()) for target in targets],
+            ))
+            for gallery_image_id in batch_image_id_list:
+                # Filter out the identity query
+                image_query_set_dict[gallery_image_id].update(dict.fromkeys(
+                    [q for q in query_id_list if q not in pid_lookup[gallery_image_id]]))
+        elif type(protocol.data['queries']) == list:
+            gallery_image_ids = set(protocol.data['images'])
+            protocol_query_id_list = [int(q) for q in protocol.data['queries']]
+            for gallery_image_id in batch_image_id_list:
+                if gallery_image_id in gallery_image_ids:
+                    image_query_set_dict[gallery_image_id].update(dict.fromkeys(protocol_query_id_list))
+        elif type(protocol.data['queries']) == dict:
+            image_queries = protocol.image_queries
+            for gallery_image_id in batch_image_id_list:
+                image_query_set_dict[gallery_image_id].update(dict.fromkeys(
+                    image_queries.get(gallery_image_id, [])))
+    return {k:list(v) for k, v in image_query_set_dict.items()}
+
+
+def run_step_search(model, batch, query_id_list, query_lookup, image_lookup, protocol_list,
+        search_mode='all', compute_anchor_metrics=False, gfn_gate=None, emb_precision='fp32',
+        async_output=False):
+    """
+    If gfn_gate (a GFNGate) is given, (query, gallery image) pairs with a GFN
+    score below the query threshold are not searched, and get an empty
+    detection entry. Detection embeddings are stored with emb_precision.
+
+    Output tensors of all pairs are moved to the host in one packed transfer.
+    If async_output, a PendingOutput is returned without waiting for the
+    transfer, and its get() returns the detection lookup.
+    """
     t0 = time.time()
     #
-    detection_lookup = collections.defaultdict(dict)
-    # Unpack protocol data
-    if protocol.name == 'all':
-        protocol_dict = {'queries': None}
-    else:
-        protocol_dict = protocol.data
-    #
     images, targets = batch
-    # form targets
-    batch_image_id_list = set([target['image_id'].item() for target in targets])
-    ####
+    # Get union of queries for each gallery image over all protocols
     image_query_dict = {}
-    if protocol.name == 'all':
-        pid_lookup = dict(zip(
-            [target['image_id'].item() for target in targets],
-            [target['id'].tolist() for target in targets],
-        ))
-        for gallery_image_id in batch_image_id_list:
-            # Filter out the identity query
-            _query_id_list = [q for q in query_id_list if q not in pid_lookup[gallery_image_id]]
-            image_query_dict[gallery_image_id] = {
-                'query_id': _query_id_list,
-                'query_emb': [query_lookup[qid].embedding for qid in _query_id_list],
-                'query_loc_emb': [query_lookup[qid].loc_embedding for qid in _query_id_list],
-                'image_id': gallery_image_id,
-            }
-    elif type(protocol_dict['queries']) == list:
-        gallery_image_ids = set(protocol_dict['images'])
-        for gallery_image_id in batch_image_id_list.intersection(gallery_image_ids):
-            image_query_dict[gallery_image_id] = {
-                'query_id': query_id_list,
-                'query_emb': [query_lookup[qid].embedding for qid in query_id_list],
-                'query_loc_emb': [query_lookup[qid].loc_embedding for qid in query_id_list],
-                'image_id': gallery_image_id,
-            }
-    elif type(protocol_dict['queries']) == dict:
-        image_queries = protocol.image_queries
-        for gallery_image_id in batch_image_id_list:
-            image_query_dict[gallery_image_id] = {
-                'query_id': image_queries[gallery_image_id],
-                'query_emb': [query_lookup[qid].embedding for qid in image_queries[gallery_image_id]],
-                'query_loc_emb': [query_lookup[qid].loc_embedding for qid in image_queries[gallery_image_id]],
-                'image_id': gallery_image_id,
-            }
+    skip_query_dict = {}
+    for gallery_image_id, _query_id_list in get_image_query_dict(protocol_list, query_id_list, targets).items():
+        # Skip queries which are filtered by the GFN gate
+        if (gfn_gate is not None) and (type(model) != SeqNeXt) and (len(_query_id_list) > 0):
+            query_idx = torch.LongTensor([query_lookup[qid].idx for qid in _query_id_list])
+            keep_mask = (gfn_gate.score_dict[gallery_image_id][query_idx].float() >= gfn_gate.query_thresh[query_idx]).tolist()
+            skip_query_dict[gallery_image_id] = [qid for qid, k in zip(_query_id_list, keep_mask) if not k]
+            _query_id_list = [qid for qid, k in zip(_query_id_list, keep_mask) if k]
+        image_query_dict[gallery_image_id] = {
+            'query_id': _query_id_list,
+            'query_emb': [query_lookup[qid].embedding for qid in _query_id_list],
+            'query_loc_emb': [query_lookup[qid].loc_embedding for qid in _query_id_list],
+            'image_id': gallery_image_id,
+        }
 
     #
     queries = list(image_query_dict.values())
     t1 = time.time()
     if type(model) == SeqNeXt:
         outputs = model(images, inference_mode='both')
+    elif sum([len(q['query_id']) for q in queries]) == 0:
+        # Every query was filtered by the GFN gate: skip the model
+        outputs = [[] for _ in queries]
     else:
         outputs = model(images, queries=queries, inference_mode=f'search_{search_mode}')
     t2 = time.time()
-    #
-    assert len(targets) == len(outputs) == 1
-    # XXX
+    # One list of per-query outputs for each image in the batch
+    assert len(queries) == len(targets) == len(outputs)
+    # Gather the output tensors of each (image, query) pair
+    pair_list, field_dict_list = [], []
     for query, target, output in zip(queries, targets, outputs):
         image_id = target['image_id'].item()
         for query_id, query_output in zip(query['query_id'], output):
+            # Quantize embeddings on the device, before moving them
+            det_emb, det_emb_scale = quantize_embeddings(query_output['det_emb'], emb_precision=emb_precision)
+            field_dict = {
+                'boxes': query_output['det_boxes'],
+                'scores': query_output['det_scores'],
+                'cws': query_output['det_cws'],
+                'labels': query_output['det_labels'],
+                'embeddings': det_emb,
+            }
             if compute_anchor_metrics:
-                detection_lookup[image_id][query_id] = DetectionLookupEntry(
-                    boxes=query_output['det_boxes'].cpu(),
-                    scores=query_output['det_scores'].cpu(),
-                    cws=query_output['det_cws'].cpu(),
-                    labels=query_output['det_labels'].cpu(),
-                    embeddings=query_output['det_emb'].cpu(),
-                    anchors=query_output['det_anchors'].cpu(),
-                    anchor_boxes=query_output['det_anchor_boxes'].cpu(),
-                    anchor_scores=query_output['det_anchor_scores'].cpu(),
-                )
-            else:
-                detection_lookup[image_id][query_id] = DetectionLookupEntry(
-                    boxes=query_output['det_boxes'].cpu(),
-                    scores=query_output['det_scores'].cpu(),
-                    cws=query_output['det_cws'].cpu(),
-                    labels=query_output['det_labels'].cpu(),
-                    embeddings=query_output['det_emb'].cpu(),
-                )
+                field_dict['anchors'] = query_output['det_anchors']
+                field_dict['anchor_boxes'] = query_output['det_anchor_boxes']
+                field_dict['anchor_scores'] = query_output['det_anchor_scores']
+            if det_emb_scale is not None:
+                field_dict['emb_scale'] = det_emb_scale
+            pair_list.append((image_id, query_id))
+            field_dict_list.append(field_dict)
+
+    # Function to build the detection lookup from the host tensors
+    def _get_detection_lookup(host_tensor_list):
+        detection_lookup = collections.defaultdict(dict)
+        host_tensor_iter = iter(host_tensor_list)
+        for (image_id, query_id), field_dict in zip(pair_list, field_dict_list):
+            detection_lookup[image_id][query_id] = DetectionLookupEntry(
+                **{k:next(host_tensor_iter) for k in field_dict})
+        # Store empty detections for the skipped pairs, so their GT is still counted
+        for image_id, skip_query_id_list in skip_query_dict.items():
+            for query_id in skip_query_id_list:
+                detection_lookup[image_id][query_id] = _get_empty_detection(
+                    query_lookup[query_id].embedding, compute_anchor_metrics=compute_anchor_metrics,
+                    emb_precision=emb_precision)
+        return detection_lookup
+
+    # Move outputs to the host in one transfer per dtype, instead of one per tensor
+    pending_output = PendingOutput(
+        PackedHostTransfer([t for field_dict in field_dict_list for t in field_dict.values()]),
+        _get_detection_lookup)
     t3 = time.time()
     #print('OUTER prep time: {:.3f}'.format(t1 - t0))
     #print('OUTER model time: {:.3f}'.format(t2 - t1))
     #print('OUTER post time: {:.3f}'.format(t3 - t2))
-    return detection_lookup
+    if async_output:
+        return pending_output
+    return pending_output.get()
+
+# Function to get a detection entry with no detections
+def _get_empty_detection(query_embedding, compute_anchor_metrics=False, emb_precision='fp32'):
+    empty_boxes = torch.zeros((0, 4))
+    empty_scores = torch.zeros((0,))
+    empty_embeddings, empty_emb_scale = quantize_embeddings(
+        torch.zeros((0, query_embedding.shape[-1])), emb_precision=emb_precision)
+    detection = DetectionLookupEntry(
+        boxes=empty_boxes,
+        scores=empty_scores,
+        cws=empty_scores,
+        labels=torch.zeros((0,), dtype=torch.long),
+        embeddings=empty_embeddings,
+        emb_scale=empty_emb_scale,
+    )
+    if compute_anchor_metrics:
+        detection = detection._replace(anchors=empty_boxes, anchor_boxes=empty_boxes, anchor_scores=empty_scores)
+    return detection
 
 @torch.no_grad()
 def compute_metrics_reid(
     model, data_loader,
     query_lookup, image_lookup,
-    use_amp=False,
+    use_amp=False, retrieval_eval_mode='orig', device=None,
 ):
     # Combine all query embeddings into a single tensor for easy computation of cosine similarity
     query_embeddings, query_image_feat_list = get_query_embeddings(query_lookup, image_lookup)
 
+    # Evaluate on the device of the query embeddings by default: AMP is only used on the GPU
+    device = query_embeddings.device if device is None else torch.device(device)
+    query_embeddings = query_embeddings.to(device)
+    use_amp = use_amp and (device.type == 'cuda')
+
     # Dicts to store results
     metric_dict, value_dict = {}, {}
 
@@ -312,7 +567,7 @@ def compute_metrics_reid(
     with torch.cuda.amp.autocast(enabled=use_amp):
         gt_detection_metric_dict, gt_retrieval_dict, _ = evaluate_detection_orig(
             data_loader.sampler.partition_name,
-            image_lookup, image_lookup, query_embeddings)
+            image_lookup, image_lookup, query_embeddings, device=device)
 
     # Get retrieval protocol information
     protocol_list = get_protocol_list(data_loader)
@@ -321,9 +576,9 @@ def compute_metrics_reid(
     print('==> Computing retrieval performance (protocol)')
     for protocol in protocol_list:
         print('==> Protocol: {}'.format(protocol.name))
-        gt_retrieval_metric_dict, gt_retrieval_value_dict = evaluate_retrieval_orig(protocol,
+        gt_retrieval_metric_dict, gt_retrieval_value_dict = evaluate_retrieval(protocol,
             gt_retrieval_dict, query_lookup, image_lookup, use_gt=True,
-            use_gfn=False)
+            use_gfn=False, retrieval_eval_mode=retrieval_eval_mode)
         # Store results for this set
         metric_dict.update(gt_retrieval_metric_dict)
 
@@ -336,14 +591,23 @@ def compute_metrics(
     query_lookup, image_lookup, detection_lookup,
     use_amp=False, use_gfn=False, gfn_mode=None,
     eval_mode=None, compute_anchor_metrics=False, use_cws=False,
+    retrieval_eval_mode='orig', det_iou_thresh_list=(0.5,), gfn_score_dict=None,
+    det_eval_mode='orig', gfn_tile_bytes=None, gfn_score_dir=None,
+    ann_mode=None, ann_kwargs=None, device=None,
 ):
     # Combine all query embeddings into a single tensor for easy computation of cosine similarity
     query_embeddings, query_image_feat_list = get_query_embeddings(query_lookup, image_lookup)
 
-    # Compute GFN scores
-    gfn_score_dict = get_gfn_scores(model,
-        image_lookup, query_embeddings, query_image_feat_list,
-        use_amp=use_amp, use_gfn=use_gfn)
+    # Evaluate on the device of the query embeddings by default: AMP is only used on the GPU
+    device = query_embeddings.device if device is None else torch.device(device)
+    query_embeddings = query_embeddings.to(device)
+    use_amp = use_amp and (device.type == 'cuda')
+
+    # Compute GFN scores, unless they were precomputed (e.g., loaded from a lookup store)
+    if gfn_score_dict is None:
+        gfn_score_dict = get_gfn_scores(model,
+            image_lookup, query_embeddings, query_image_feat_list,
+            use_amp=use_amp, use_gfn=use_gfn, tile_bytes=gfn_tile_bytes, score_dir=gfn_score_dir)
 
     # Dicts to store results
     metric_dict, value_dict = {}, {}
@@ -354,35 +618,33 @@ def compute_metrics(
         evaluate_detection_func = evaluate_detection_orig
     else: raise Exception
 
+    # Detection variants to evaluate: the first one is used for retrieval
+    detection_variant_list = []
+    for use_anchor_boxes, use_anchor_scores in [(False, False), (True, False), (False, True)] if compute_anchor_metrics else [(False, False)]:
+        for iou_thresh in det_iou_thresh_list:
+            detection_variant_list.append(DetectionVariant(use_anchor_boxes=use_anchor_boxes,
+                use_anchor_scores=use_anchor_scores, iou_thresh=iou_thresh))
+    detection_variant_list = list(dict.fromkeys(detection_variant_list))
+
     # Compute detection performance
+    ## All detection variants are computed in a single pass
     print('==> Computing detection performance')
     with torch.cuda.amp.autocast(enabled=use_amp):
-        if compute_anchor_metrics:
-            anchor_metric_dict = evaluate_anchor_recall(
-                    data_loader.sampler.partition_name, 
-                    detection_lookup, image_lookup, query_lookup=query_lookup)
-            metric_dict.update(anchor_metric_dict)
-            ab_detection_metric_dict, _, _ = evaluate_detection_func(
-                data_loader.sampler.partition_name, detection_lookup, image_lookup,
-                query_embeddings, gfn_score_dict=gfn_score_dict, query_lookup=query_lookup, use_anchor_boxes=True)
-            as_detection_metric_dict, _, _ = evaluate_detection_func(
-                data_loader.sampler.partition_name, detection_lookup, image_lookup,
-                query_embeddings, gfn_score_dict=gfn_score_dict, query_lookup=query_lookup, use_anchor_scores=True)
-            metric_dict.update(ab_detection_metric_dict)
-            metric_dict.update(as_detection_metric_dict)
         detection_metric_dict, retrieval_dict, scores_dict = evaluate_detection_func(
             data_loader.sampler.partition_name, detection_lookup, image_lookup,
-            query_embeddings, gfn_score_dict=gfn_score_dict, query_lookup=query_lookup, measure_iou_gain=compute_anchor_metrics)
-        if False:
-            detection_metric_dict_75, _, _ = evaluate_detection_func(
-                data_loader.sampler.partition_name, detection_lookup, image_lookup,
-                query_embeddings, gfn_score_dict=gfn_score_dict, iou_thresh=0.75,
-                query_lookup=query_lookup)
-            detection_metric_dict.update(detection_metric_dict_75)
+            query_embeddings, gfn_score_dict=gfn_score_dict, query_lookup=query_lookup,
+            variant_list=detection_variant_list, measure_iou_gain=compute_anchor_metrics,
+            compute_anchor_recall=compute_anchor_metrics, det_eval_mode=det_eval_mode, device=device)
         gt_detection_metric_dict, gt_retrieval_dict, _ = evaluate_detection_orig(
             data_loader.sampler.partition_name,
-            image_lookup, image_lookup, query_embeddings, gfn_score_dict=gfn_score_dict)
+            image_lookup, image_lookup, query_embeddings, gfn_score_dict=gfn_score_dict, device=device)
     metric_dict.update(detection_metric_dict)
+
+    # Restrict OC retrieval to the results of an ANN index
+    if (ann_mode is not None) and (eval_mode != 'qc'):
+        print('==> Searching OC detections with ANN index: {}'.format(ann_mode))
+        retrieval_dict, _ = get_ann_retrieval_lookup(retrieval_dict, detection_lookup, query_embeddings,
+            ann_mode=ann_mode, **({} if ann_kwargs is None else ann_kwargs))
     #print('det:')
     #pprint(detection_metric_dict)
     #print('gt:')
@@ -396,10 +658,12 @@ def compute_metrics(
     for protocol in protocol_list:
         print('==> Protocol: {}'.format(protocol.name))
         for _use_gfn in [False, True] if use_gfn else [False]:
-            retrieval_metric_dict, retrieval_value_dict = evaluate_retrieval_orig(protocol,
-                retrieval_dict, query_lookup, image_lookup, use_gt=False, use_gfn=_use_gfn, use_cws=use_cws)
-            gt_retrieval_metric_dict, gt_retrieval_value_dict = evaluate_retrieval_orig(protocol,
-                gt_retrieval_dict, query_lookup, image_lookup, use_gt=True, use_gfn=_use_gfn, use_cws=use_cws)
+            retrieval_metric_dict, retrieval_value_dict = evaluate_retrieval(protocol,
+                retrieval_dict, query_lookup, image_lookup, use_gt=False, use_gfn=_use_gfn, use_cws=use_cws,
+                retrieval_eval_mode=retrieval_eval_mode)
+            gt_retrieval_metric_dict, gt_retrieval_value_dict = evaluate_retrieval(protocol,
+                gt_retrieval_dict, query_lookup, image_lookup, use_gt=True, use_gfn=_use_gfn, use_cws=use_cws,
+                retrieval_eval_mode=retrieval_eval_mode)
             #print('det:')
             #pprint(retrieval_metric_dict)
             #print('gt:')
@@ -441,52 +705,63 @@ def _match_boxes(match_quality_matrix, iou_thresh):
     det_idx, gt_idx = torch.where(match_quality_matrix)
     return det_idx, gt_idx
 
-def evaluate_anchor_recall(partition_name, detection_lookup,
-        image_lookup, query_lookup=None, iou_thresh=0.5):
-    num_gt_match, num_gt_tot = 0, 0
-    # Iterate through all images
-    for image_id in tqdm(image_lookup):
-        # Unpack GT for this image
-        gt = image_lookup[image_id]
-        gt_boxes = gt.boxes
-        gt_person_ids = gt.person_ids.cpu()
-
-        # Vectorize some calculations
-        torch.cuda.synchronize()
-        t0 = time.time()
-        
-        # Unpack detections for this image
-        for query_id, detection in detection_lookup[image_id].items():
-            #
-            query_person_id = query_lookup[query_id].person_id.cpu()
-            query_mask = query_person_id == gt_person_ids
-            if query_mask.sum() > 0:
-                gt_box = gt_boxes[query_mask]
-                # Box IoU
-                det_iou = box_ops.box_iou(detection.anchors.cuda(), gt_box)
-                # Compute matches
-                if det_iou.max() >= iou_thresh:
-                    num_gt_match += 1
-                num_gt_tot += 1
-    
-    # Compute anchor recall
-    anchor_recall = num_gt_match / num_gt_tot
-
-    # Build metric dict
-    anchor_metric_dict = {
-        f'{partition_name}_anchor_recall@k': anchor_recall,
+# Function to compute summary detection metrics for one detection variant
+def _summarize_detection(partition_name, num_gt_match, num_gt_tot, det_scores_list, det_matches_list,
+        iou_thresh=0.5, anchor_str=''):
+    det_recall = num_gt_match / num_gt_tot
+    # Compute AP@0.5
+    if len(det_scores_list) > 0:
+        ## Combine all scores, labels, and clean any invalid scores
+        det_scores = torch.cat(det_scores_list)
+        det_matches = torch.cat(det_matches_list)
+        ## Compute AP@0.5
+        det_ap = average_precision(det_matches, det_scores) * det_recall
+        ## Compute "real" AP
+        ### get num matches
+        num_match = det_matches.sum().item()
+        num_tot = det_scores.shape[0]
+        det_rap = (num_match / num_tot) * det_ap
+    else:
+        det_ap = 0
+        det_rap = 0
+    metric_dict = {
+        f'{partition_name}_{anchor_str}ap@{iou_thresh}': det_ap,
+        f'{partition_name}_{anchor_str}rap@{iou_thresh}': det_rap,
+        f'{partition_name}_{anchor_str}recall@{iou_thresh}': det_recall,
     }
-
-    # Return results
-    return anchor_metric_dict
+    return metric_dict
 
 # Detection evaluation function
-def evaluate_detection_qc(partition_name, detection_lookup,
+def evaluate_detection_qc_orig(partition_name, detection_lookup,
         image_lookup, query_embeddings,
-        gfn_score_dict=None, det_thresh=0.5, iou_thresh=0.5, query_lookup=None, use_anchor_boxes=False, use_anchor_scores=False, measure_iou_gain=False):
-    num_gt_match, num_gt_tot = 0, 0
-    all_scores_list = []
-    all_matches_list = []
+        gfn_score_dict=None, det_thresh=0.5, iou_thresh=0.5, query_lookup=None, use_anchor_boxes=False, use_anchor_scores=False, measure_iou_gain=False,
+        variant_list=None, compute_anchor_recall=False, device=None):
+    """
+    Computes detection metrics for every variant in variant_list in a single
+    pass over the detection_lookup. Box IoU, anchor box IoU and similarities
+    are computed once per image, and shared by all variants.
+
+    The first variant is the primary one: its sims and IoU are stored in the
+    returned retrieval_lookup. If variant_list is None, a single variant is
+    built from the use_anchor_boxes, use_anchor_scores and iou_thresh args.
+
+    IoU and similarities are computed on device, that of query_embeddings by
+    default.
+    """
+    if variant_list is None:
+        variant_list = [DetectionVariant(use_anchor_boxes=use_anchor_boxes,
+            use_anchor_scores=use_anchor_scores, iou_thresh=iou_thresh)]
+    if device is None:
+        device = query_embeddings.device
+    query_embeddings = query_embeddings.to(device)
+    primary_variant = variant_list[0]
+    use_any_anchor_boxes = measure_iou_gain or any([v.use_anchor_boxes for v in variant_list])
+    use_any_anchor_scores = any([v.use_anchor_scores for v in variant_list])
+    num_gt_tot = 0
+    num_anchor_gt_match, num_anchor_gt_tot = 0, 0
+    num_gt_match_dict = {v:0 for v in variant_list}
+    all_scores_dict = {v:[] for v in variant_list}
+    all_matches_dict = {v:[] for v in variant_list}
     iou_gain_list = []
     # Initialize retrieval dictionary
     retrieval_lookup = {}
@@ -496,64 +771,68 @@ def evaluate_detection_qc(partition_name, detection_lookup,
     for image_id in tqdm(image_lookup):
         # Unpack GT for this image
         gt = image_lookup[image_id]
-        gt_boxes = gt.boxes
+        gt_boxes = gt.boxes.to(device)
         gt_person_ids = gt.person_ids.cpu()
 
         # Unpack detections for this image
         det_boxes_list = []
         det_anchor_boxes_list = []
+        det_anchors_list = []
         det_scores_list = []
+        det_anchor_scores_list = []
         det_embeddings_list = []
-        det_split_list = []
+        det_mask_list = []
+        det_anchor_mask_list = []
         for query_id, detection in detection_lookup[image_id].items():
-            # Scores
-            if use_anchor_scores:
-                det_mask = detection.anchor_scores >= det_thresh
-                det_scores = detection.anchor_scores[det_mask]
-            else:
-                det_mask = detection.scores >= det_thresh
-                det_scores = detection.scores[det_mask]
+            # Masks: all variants are computed from the full set of detections
+            det_mask = detection.scores >= det_thresh
+            det_mask_list.append(det_mask.cpu())
+            det_scores_list.append(detection.scores)
+            if use_any_anchor_scores:
+                det_anchor_mask_list.append((detection.anchor_scores >= det_thresh).cpu())
+                det_anchor_scores_list.append(detection.anchor_scores)
             # Boxes
-            if use_anchor_boxes:
-                det_boxes = detection.anchor_boxes[det_mask]
-            else:
-                det_boxes = detection.boxes[det_mask]
+            det_boxes_list.append(detection.boxes)
             # Anchor boxes
-            if measure_iou_gain:
-                det_anchor_boxes = detection.anchor_boxes[det_mask]
-                det_anchor_boxes_list.append(det_anchor_boxes)
-            # Embeddings
-            det_embeddings = detection.embeddings[det_mask]
-            #
-            det_boxes_list.append(det_boxes)
-            det_scores_list.append(det_scores)
-            det_embeddings_list.append(det_embeddings)
-            det_split_list.append(torch.count_nonzero(det_mask))
-        det_boxes = torch.cat(det_boxes_list).cuda()
-        det_scores = torch.cat(det_scores_list)
-        det_embeddings = torch.cat(det_embeddings_list).cuda()
+            if use_any_anchor_boxes:
+                det_anchor_boxes_list.append(detection.anchor_boxes)
+            # Anchors
+            if compute_anchor_recall:
+                det_anchors_list.append(detection.anchors)
+            # Embeddings: only needed for the primary variant
+            if primary_variant.use_anchor_scores:
+                det_embeddings_list.append(detection.embeddings[detection.anchor_scores >= det_thresh])
+            else:
+                det_embeddings_list.append(detection.embeddings[det_mask])
+        det_split_list = [len(m) for m in det_mask_list]
+        det_embeddings = torch.cat(det_embeddings_list).to(device)
         # Box IoU
-        #match_quality_matrix = box_ops.box_iou(good_det_boxes, gt_boxes)
-        det_iou = box_ops.box_iou(det_boxes, gt_boxes)
-        if measure_iou_gain:
-            det_anchor_boxes = torch.cat(det_anchor_boxes_list)
-            det_anchor_iou = box_ops.box_iou(det_anchor_boxes.to(gt_boxes), gt_boxes)
+        det_iou = box_ops.box_iou(torch.cat(det_boxes_list).to(device), gt_boxes)
+        if use_any_anchor_boxes:
+            det_anchor_iou = box_ops.box_iou(torch.cat(det_anchor_boxes_list).to(gt_boxes), gt_boxes)
         else:
             det_anchor_iou = det_iou
+        if compute_anchor_recall:
+            anchor_iou = box_ops.box_iou(torch.cat(det_anchors_list).to(device), gt_boxes)
+            anchor_split_list = [len(a) for a in det_anchors_list]
+            anchor_iou_list = torch.split(anchor_iou.cpu(), anchor_split_list)
         # Sims
         det_sims = torch.mm(
-            F.normalize(det_embeddings),
+            F.normalize(dequantize_embeddings(det_embeddings)),
             F.normalize(query_embeddings).T,
         )
+        det_sims_list = torch.split(det_sims.cpu(), [len(e) for e in det_embeddings_list])
+        det_iou_list = torch.split(det_iou.cpu(), det_split_list)
+        det_anchor_iou_list = torch.split(det_anchor_iou.cpu(), det_split_list)
+        det_boxes_list = torch.split(torch.cat(det_boxes_list).cpu(), det_split_list)
+        det_anchor_boxes_list = det_anchor_boxes_list if use_any_anchor_boxes else det_boxes_list
+        det_scores_list = torch.split(torch.cat(det_scores_list).cpu(), det_split_list)
+        if use_any_anchor_scores:
+            det_anchor_scores_list = torch.split(torch.cat(det_anchor_scores_list).cpu(), det_split_list)
+        else:
+            det_anchor_scores_list, det_anchor_mask_list = det_scores_list, det_mask_list
 
-        for query_id, good_det_boxes, good_det_scores, _good_det_sims, match_quality_matrix, good_anchor_iou in zip(detection_lookup[image_id].keys(), 
-                torch.split(det_boxes.cpu(), det_split_list), 
-                torch.split(det_scores.cpu(), det_split_list), 
-                torch.split(det_sims.cpu(), det_split_list), 
-                torch.split(det_iou.cpu(), det_split_list), 
-                torch.split(det_anchor_iou.cpu(), det_split_list), 
-            ):
-            good_det_sims = _good_det_sims.T
+        for query_index, query_id in enumerate(detection_lookup[image_id].keys()):
             #
             query_person_id = query_lookup[query_id].person_id.cpu()
             # 
@@ -561,6 +840,11 @@ def evaluate_detection_qc(partition_name, detection_lookup,
             gt_person_id = gt_person_ids[query_gt_mask]
             #
             num_gt_tot += query_gt_mask.sum().item()
+            # Anchor recall
+            if compute_anchor_recall and (query_gt_mask.sum() > 0):
+                if anchor_iou_list[query_index][:, query_gt_mask].max() >= 0.5:
+                    num_anchor_gt_match += 1
+                num_anchor_gt_tot += 1
             # Store GFN scores
             if gfn_score_dict is not None:
                 retrieval_lookup[image_id][query_id] = RetrievalLookupEntry(
@@ -568,73 +852,274 @@ def evaluate_detection_qc(partition_name, detection_lookup,
             else:
                 retrieval_lookup[image_id][query_id] = RetrievalLookupEntry()
 
-            # Compute detection results
-            if (good_det_boxes.shape[0] > 0):
+            # Compute detection results for each variant
+            for variant in variant_list:
                 # Filter only detections with high enough score
-                # Store detected person_ids
-                det_person_ids = torch.full((len(good_det_boxes),), -1, dtype=torch.long)
-                det_matches = torch.zeros_like(good_det_scores, dtype=torch.long)
+                if variant.use_anchor_scores:
+                    det_mask = det_anchor_mask_list[query_index]
+                    good_det_scores = det_anchor_scores_list[query_index][det_mask]
+                else:
+                    det_mask = det_mask_list[query_index]
+                    good_det_scores = det_scores_list[query_index][det_mask]
+                if variant.use_anchor_boxes:
+                    match_quality_matrix = det_anchor_iou_list[query_index][det_mask]
+                else:
+                    match_quality_matrix = det_iou_list[query_index][det_mask]
+                if good_det_scores.shape[0] == 0:
+                    continue
                 # Match detections with GT boxes
+                det_matches = torch.zeros_like(good_det_scores, dtype=torch.long)
                 if query_gt_mask.sum() > 0:
-                    det_idx, gt_idx = _match_boxes(match_quality_matrix[:, query_gt_mask].clone(), iou_thresh)
+                    det_idx, gt_idx = _match_boxes(match_quality_matrix[:, query_gt_mask].clone(), variant.iou_thresh)
                     # 
                     match_query_gt_mask = gt_person_id[gt_idx.cpu()] == query_person_id
+                    num_gt_match_dict[variant] += match_query_gt_mask.sum().item()
                     #
-                    #assert match_query_gt_mask.sum() <= 1
-                    num_gt_match += match_query_gt_mask.sum().item()
-                    #
-                    all_scores_list.append(good_det_scores)
+                    all_scores_dict[variant].append(good_det_scores)
                     det_matches[det_idx] = 1
-                    #assert det_matches.sum() <= 1
-                    all_matches_list.append(det_matches)
-                    det_person_ids[det_idx.cpu()] = gt_person_id[gt_idx.cpu()]
+                    all_matches_dict[variant].append(det_matches)
                     #
-                    if match_query_gt_mask.sum() == 1:
-                        _box_iou = match_quality_matrix[det_idx, gt_idx]
+                    if measure_iou_gain and (variant == primary_variant) and (match_query_gt_mask.sum() == 1):
+                        # gt_idx indexes the GT boxes of this query
+                        good_anchor_iou = det_anchor_iou_list[query_index][det_mask][:, query_gt_mask]
+                        _box_iou = match_quality_matrix[:, query_gt_mask][det_idx, gt_idx]
                         _anchor_iou = good_anchor_iou[det_idx, gt_idx]
                         _iou_gain = _box_iou - _anchor_iou
                         iou_gain_list.append(_iou_gain)
                 # Store everything in retrieval dict
-                assert det_matches.shape[0] == det_person_ids.shape[0] == good_det_sims.shape[1]
-                retrieval_lookup[image_id][query_id] = retrieval_lookup[image_id][query_id]._replace(sims=good_det_sims, boxes=good_det_boxes, iou=match_quality_matrix)
-    #exit()
+                if variant == primary_variant:
+                    good_det_sims = det_sims_list[query_index].T
+                    good_det_boxes = (det_anchor_boxes_list if variant.use_anchor_boxes else det_boxes_list)[query_index][det_mask]
+                    assert det_matches.shape[0] == good_det_sims.shape[1]
+                    retrieval_lookup[image_id][query_id] = retrieval_lookup[image_id][query_id]._replace(
+                        sims=good_det_sims, boxes=good_det_boxes.cpu(), iou=match_quality_matrix)
     #
-    det_recall = num_gt_match / num_gt_tot
-    # Compute AP@0.5
-    if len(all_scores_list) > 0:
-        ## Combine all scores, labels, and clean any invalid scores
-        det_scores = np.nan_to_num(torch.cat(all_scores_list).tolist(), posinf=0, neginf=0)
-        det_matches = torch.cat(all_matches_list).tolist()
-        ## Compute AP@0.5
-        det_ap = average_precision_score(det_matches, det_scores) * det_recall
-        ## Compute "real" AP
-        ### get num matches
-        num_match = torch.cat(all_matches_list).sum().item()
-        num_tot = det_scores.shape[0]
-        det_rap = (num_match / num_tot) * det_ap
-        #print(f'{num_match=}, {num_tot=}, {det_ap=}, {det_rap=}')
-    else:
-        det_ap = 0
-        det_rap = 0
+    metric_dict = {}
+    for variant in variant_list:
+        anchor_str = ''
+        if variant.use_anchor_boxes:
+            anchor_str += 'ab_'
+        if variant.use_anchor_scores:
+            anchor_str += 'as_'
+        metric_dict.update(_summarize_detection(partition_name,
+            num_gt_match_dict[variant], num_gt_tot,
+            all_scores_dict[variant], all_matches_dict[variant],
+            iou_thresh=variant.iou_thresh, anchor_str=anchor_str))
     #
     if measure_iou_gain:
         if len(iou_gain_list) > 0:
             iou_gain = sum(iou_gain_list) / len(iou_gain_list)
         else:
             iou_gain = 0
-    #
-    anchor_str = ''
-    if use_anchor_boxes:
-        anchor_str += 'ab_'
-    if use_anchor_scores:
-        anchor_str += 'as_'
-    metric_dict = {
-        f'{partition_name}_{anchor_str}ap@{iou_thresh}': det_ap,
-        f'{partition_name}_{anchor_str}rap@{iou_thresh}': det_rap,
-        f'{partition_name}_{anchor_str}recall@{iou_thresh}': det_recall,
+        metric_dict[f'{partition_name}_iou_gain'] = iou_gain
+    if compute_anchor_recall:
+        metric_dict[f'{partition_name}_anchor_recall@k'] = num_anchor_gt_match / num_anchor_gt_tot
+    scores_dict = {
+        'match_scores': [],
+        'diff_scores': [],
     }
+    #
+    return metric_dict, retrieval_lookup, scores_dict
+
+
+# Function to match predicted boxes to ground truth boxes for all queries of an image at once
+def _match_boxes_segmented(match_quality_matrix, seg, num_seg):
+    """
+    Batched version of _match_boxes: rows of match_quality_matrix are the
+    detections of all queries of an image, with seg giving the query index of
+    each row. The matrix must already be thresholded (entries < iou_thresh set
+    to 0) and masked (non-kept detections and GT of other persons set to 0).
+
+    Returns a boolean mask of the matched (det, gt) pairs, identical to
+    running _match_boxes separately for each query.
+    """
+    num_det, num_gt = match_quality_matrix.shape
+    # For each det, keep largest IoU of all GT
+    max_gt_idx = match_quality_matrix.argmax(dim=1, keepdim=True)
+    max_gt_mask = torch.zeros_like(match_quality_matrix, dtype=torch.bool)
+    max_gt_mask.scatter_(1, max_gt_idx, True)
+    # For each GT, keep largest IoU of all det of the same query: first det in case of ties
+    seg_idx = seg.unsqueeze(1).expand(-1, num_gt)
+    seg_max = match_quality_matrix.new_zeros((num_seg, num_gt)).scatter_reduce(
+        0, seg_idx, match_quality_matrix, reduce='amax', include_self=True)
+    row_idx = torch.arange(num_det, device=seg.device).unsqueeze(1).expand(-1, num_gt)
+    row_cand = torch.where(match_quality_matrix == seg_max[seg], row_idx, num_det)
+    seg_first_row = torch.full((num_seg, num_gt), num_det, dtype=torch.long, device=seg.device).scatter_reduce(
+        0, seg_idx, row_cand, reduce='amin', include_self=True)
+    max_det_mask = row_idx == seg_first_row[seg]
+    # Keep nonzero pairs which are the max of both their row and column
+    return (match_quality_matrix > 0) & max_gt_mask & max_det_mask
+
+# Detection evaluation function: device-resident version of evaluate_detection_qc_orig
+def evaluate_detection_qc_device(partition_name, detection_lookup,
+        image_lookup, query_embeddings,
+        gfn_score_dict=None, det_thresh=0.5, iou_thresh=0.5, query_lookup=None, use_anchor_boxes=False, use_anchor_scores=False, measure_iou_gain=False,
+        variant_list=None, compute_anchor_recall=False, device=None):
+    """
+    Same results as evaluate_detection_qc_orig, but all per-image tensors
+    stay on one device (that of query_embeddings by default, CPU or GPU), and
+    box matching is done for all queries of an image in one batched op
+    instead of a loop over queries. Per-image data is sent to the host once,
+    to build the retrieval_lookup; detection scores and matches stay on the
+    device until the final metrics are computed.
+    """
+    if variant_list is None:
+        variant_list = [DetectionVariant(use_anchor_boxes=use_anchor_boxes,
+            use_anchor_scores=use_anchor_scores, iou_thresh=iou_thresh)]
+    if device is None:
+        device = query_embeddings.device
+    primary_variant = variant_list[0]
+    use_any_anchor_boxes = measure_iou_gain or any([v.use_anchor_boxes for v in variant_list])
+    use_any_anchor_scores = any([v.use_anchor_scores for v in variant_list])
+    num_gt_tot = torch.zeros((), dtype=torch.long, device=device)
+    num_anchor_gt_match = torch.zeros((), dtype=torch.long, device=device)
+    num_anchor_gt_tot = torch.zeros((), dtype=torch.long, device=device)
+    num_gt_match_dict = {v:torch.zeros((), dtype=torch.long, device=device) for v in variant_list}
+    all_scores_dict = {v:[] for v in variant_list}
+    all_matches_dict = {v:[] for v in variant_list}
+    iou_gain_list = []
+    # Normalize query embeddings once
+    norm_query_embeddings = F.normalize(query_embeddings.to(device))
+    # Look up all query person ids at once
+    query_person_id_dict = dict(zip(query_lookup.keys(),
+        torch.stack([q.person_id.reshape(()) for q in query_lookup.values()]).tolist()))
+    # Initialize retrieval dictionary
+    retrieval_lookup = {}
+    for image_id in image_lookup:
+        retrieval_lookup[image_id] = {}
+    # Iterate through all images
+    for image_id in tqdm(image_lookup):
+        detection_dict = detection_lookup.get(image_id, {})
+        query_id_list = list(detection_dict.keys())
+        detection_list = list(detection_dict.values())
+        num_query = len(query_id_list)
+        for query_id in query_id_list:
+            if gfn_score_dict is not None:
+                retrieval_lookup[image_id][query_id] = RetrievalLookupEntry(
+                    gfn_scores=gfn_score_dict[image_id])
+            else:
+                retrieval_lookup[image_id][query_id] = RetrievalLookupEntry()
+        if num_query == 0:
+            continue
+
+        # Unpack GT for this image
+        gt = image_lookup[image_id]
+        gt_boxes = gt.boxes.to(device)
+        gt_person_ids = gt.person_ids.to(device)
+        num_gt = gt_boxes.shape[0]
+
+        # Unpack detections for all queries of this image
+        det_count = torch.tensor([d.scores.shape[0] for d in detection_list])
+        seg = torch.repeat_interleave(torch.arange(num_query), det_count).to(device)
+        det_scores = torch.cat([d.scores for d in detection_list]).to(device)
+        det_boxes = torch.cat([d.boxes for d in detection_list]).to(device)
+        if use_any_anchor_scores:
+            det_anchor_scores = torch.cat([d.anchor_scores for d in detection_list]).to(device)
+        if use_any_anchor_boxes:
+            det_anchor_boxes = torch.cat([d.anchor_boxes for d in detection_list]).to(device)
+        # Embeddings: only needed for the primary variant, so filter before moving them
+        if primary_variant.use_anchor_scores:
+            det_embeddings = torch.cat([d.embeddings[d.anchor_scores >= det_thresh] for d in detection_list])
+        else:
+            det_embeddings = torch.cat([d.embeddings[d.scores >= det_thresh] for d in detection_list])
+        det_embeddings = det_embeddings.to(device)
+
+        # Query-GT person match: (num_query, num_gt)
+        query_person_ids = torch.tensor([query_person_id_dict[q] for q in query_id_list], device=device)
+        query_gt_mask = query_person_ids.unsqueeze(1) == gt_person_ids.unsqueeze(0)
+        query_has_gt = query_gt_mask.any(dim=1)
+        num_gt_tot += query_gt_mask.sum()
+        det_gt_mask = query_gt_mask[seg]
+
+        # Box IoU
+        det_iou = box_ops.box_iou(det_boxes, gt_boxes)
+        if use_any_anchor_boxes:
+            det_anchor_iou = box_ops.box_iou(det_anchor_boxes, gt_boxes)
+        else:
+            det_anchor_iou = det_iou
+        # Anchor recall
+        if compute_anchor_recall:
+            anchor_count = torch.tensor([d.anchors.shape[0] for d in detection_list])
+            anchor_seg = torch.repeat_interleave(torch.arange(num_query), anchor_count).to(device)
+            anchor_iou = box_ops.box_iou(torch.cat([d.anchors for d in detection_list]).to(device), gt_boxes)
+            anchor_iou = anchor_iou.masked_fill(~query_gt_mask[anchor_seg], 0.0)
+            anchor_max_iou = anchor_iou.new_zeros(num_query).scatter_reduce(0, anchor_seg,
+                anchor_iou.max(dim=1).values if num_gt > 0 else anchor_iou.new_zeros(anchor_seg.shape[0]),
+                reduce='amax', include_self=True)
+            num_anchor_gt_match += ((anchor_max_iou >= 0.5) & query_has_gt).sum()
+            num_anchor_gt_tot += query_has_gt.sum()
+        # Sims: (num_primary_det, num_query_all)
+        det_sims = torch.mm(
+            F.normalize(dequantize_embeddings(det_embeddings)),
+            norm_query_embeddings.T,
+        )
+
+        # Compute detection results for each variant
+        for variant in variant_list:
+            # Filter only detections with high enough score
+            if variant.use_anchor_scores:
+                variant_scores = det_anchor_scores
+            else:
+                variant_scores = det_scores
+            det_mask = variant_scores >= det_thresh
+            if variant.use_anchor_boxes:
+                variant_iou = det_anchor_iou
+            else:
+                variant_iou = det_iou
+            # Match detections with GT boxes of the same person as the query
+            if num_gt > 0:
+                match_quality_matrix = variant_iou.masked_fill(~(det_mask.unsqueeze(1) & det_gt_mask), 0.0)
+                match_quality_matrix[match_quality_matrix < variant.iou_thresh] = 0.0
+                match_mask = _match_boxes_segmented(match_quality_matrix, seg, num_query)
+                det_matches = match_mask.any(dim=1).long()
+                num_gt_match_dict[variant] += match_mask.sum()
+                # Store scores and matches for queries with a GT box in this image
+                ap_mask = det_mask & query_has_gt[seg]
+                all_scores_dict[variant].append(variant_scores[ap_mask])
+                all_matches_dict[variant].append(det_matches[ap_mask])
+                # IoU gain for queries with exactly one match
+                if measure_iou_gain and (variant == primary_variant):
+                    seg_num_match = torch.zeros(num_query, dtype=torch.long, device=device).scatter_add_(
+                        0, seg, match_mask.sum(dim=1))
+                    gain_mask = match_mask & (seg_num_match[seg] == 1).unsqueeze(1)
+                    iou_gain_list.append(variant_iou[gain_mask] - det_anchor_iou[gain_mask])
+            # Store everything in retrieval dict
+            if variant == primary_variant:
+                det_mask_count = torch.zeros(num_query, dtype=torch.long, device=device).scatter_add_(
+                    0, seg, det_mask.long()).tolist()
+                variant_boxes = det_anchor_boxes if variant.use_anchor_boxes else det_boxes
+                good_det_boxes_list = torch.split(variant_boxes[det_mask].cpu(), det_mask_count)
+                good_det_iou_list = torch.split(variant_iou[det_mask].cpu(), det_mask_count)
+                good_det_sims_list = [t.T for t in torch.split(det_sims.cpu(), det_mask_count)]
+                for query_id, count, good_det_boxes, good_det_iou, good_det_sims in zip(query_id_list,
+                        det_mask_count, good_det_boxes_list, good_det_iou_list, good_det_sims_list):
+                    if count > 0:
+                        retrieval_lookup[image_id][query_id] = retrieval_lookup[image_id][query_id]._replace(
+                            sims=good_det_sims, boxes=good_det_boxes, iou=good_det_iou)
+    #
+    metric_dict = {}
+    num_gt_tot = num_gt_tot.item()
+    for variant in variant_list:
+        anchor_str = ''
+        if variant.use_anchor_boxes:
+            anchor_str += 'ab_'
+        if variant.use_anchor_scores:
+            anchor_str += 'as_'
+        metric_dict.update(_summarize_detection(partition_name,
+            num_gt_match_dict[variant].item(), num_gt_tot,
+            [t for t in all_scores_dict[variant] if t.shape[0] > 0],
+            [t for t in all_matches_dict[variant] if t.shape[0] > 0],
+            iou_thresh=variant.iou_thresh, anchor_str=anchor_str))
+    #
     if measure_iou_gain:
+        iou_gain = torch.cat(iou_gain_list) if len(iou_gain_list) > 0 else torch.zeros(0)
+        if iou_gain.shape[0] > 0:
+            iou_gain = iou_gain.mean().item()
+        else:
+            iou_gain = 0
         metric_dict[f'{partition_name}_iou_gain'] = iou_gain
+    if compute_anchor_recall:
+        metric_dict[f'{partition_name}_anchor_recall@k'] = num_anchor_gt_match.item() / num_anchor_gt_tot.item()
     scores_dict = {
         'match_scores': [],
         'diff_scores': [],
@@ -642,14 +1127,58 @@ def evaluate_detection_qc(partition_name, detection_lookup,
     #
     return metric_dict, retrieval_lookup, scores_dict
 
+# QC detection evaluation function: selects the implementation
+def evaluate_detection_qc(partition_name, detection_lookup,
+        image_lookup, query_embeddings, det_eval_mode='orig', **kwargs):
+    """
+    det_eval_mode:
+        'orig': per-query loop (reference implementation)
+        'device': device-resident implementation with batched matching
+        'parity': run both, report the largest metric difference, return 'orig' results
+    """
+    if det_eval_mode == 'orig':
+        return evaluate_detection_qc_orig(partition_name, detection_lookup, image_lookup, query_embeddings, **kwargs)
+    elif det_eval_mode == 'device':
+        return evaluate_detection_qc_device(partition_name, detection_lookup, image_lookup, query_embeddings, **kwargs)
+    elif det_eval_mode == 'parity':
+        orig_time = time.time()
+        metric_dict, retrieval_lookup, scores_dict = evaluate_detection_qc_orig(
+            partition_name, detection_lookup, image_lookup, query_embeddings, **kwargs)
+        device_time = time.time()
+        device_metric_dict, _, _ = evaluate_detection_qc_device(
+            partition_name, detection_lookup, image_lookup, query_embeddings, **kwargs)
+        end_time = time.time()
+        assert metric_dict.keys() == device_metric_dict.keys()
+        max_diff = max([abs(float(metric_dict[k]) - float(device_metric_dict[k])) for k in metric_dict], default=0.0)
+        print('==> Detection parity: max metric diff={:.3e}, orig={:.2f}s, device={:.2f}s'.format(
+            max_diff, device_time - orig_time, end_time - device_time))
+        return metric_dict, retrieval_lookup, scores_dict
+    else:
+        raise NotImplementedError
+
 
 # Detection evaluation function
 def evaluate_detection_orig(partition_name, detection_lookup, image_lookup, query_embeddings,
-        gfn_score_dict=None, det_thresh=0.5, iou_thresh=0.5, **kwargs):
-    num_gt_match, num_gt_tot = 0, 0
+        gfn_score_dict=None, det_thresh=0.5, iou_thresh=0.5, variant_list=None, device=None, **kwargs):
+    """
+    Computes detection metrics for every IoU threshold in variant_list in a
+    single pass: box IoU and similarities are computed once per image. Anchor
+    variants do not apply to OC detections, and are ignored.
+
+    Similarities are computed on device, that of query_embeddings by default.
+    """
+    if variant_list is None:
+        variant_list = [DetectionVariant(iou_thresh=iou_thresh)]
+    if device is None:
+        device = query_embeddings.device
+    query_embeddings = query_embeddings.to(device)
+    iou_thresh_list = list(dict.fromkeys([v.iou_thresh for v in variant_list]))
+    primary_iou_thresh = iou_thresh_list[0]
+    num_gt_tot = 0
     num_det_tot = 0
+    num_gt_match_dict = {t:0 for t in iou_thresh_list}
     det_scores_list = []
-    det_matches_list = []
+    det_matches_dict = {t:[] for t in iou_thresh_list}
     det_match_scores_list = []
     det_diff_scores_list = []
     retrieval_lookup = {}
@@ -680,57 +1209,39 @@ def evaluate_detection_orig(partition_name, detection_lookup, image_lookup, quer
             good_det_scores = det_scores[det_mask]
             good_det_boxes = det_boxes[det_mask]
             good_det_embeddings = det_embeddings[det_mask]
-            # Match detections with GT boxes
-            match_quality_matrix = box_ops.box_iou(good_det_boxes, gt_boxes)
-            det_idx, gt_idx = _match_boxes(match_quality_matrix.clone(), iou_thresh)
-            #
-            num_gt_match += gt_idx.shape[0]
             det_scores_list.append(good_det_scores)
-            det_matches = torch.zeros(len(good_det_boxes))
-            det_matches[det_idx] = 1
-            det_matches_list.append(det_matches)
-            # Store matching and nonmatching scores
-            match_mask = torch.zeros_like(good_det_scores).bool()
-            match_mask[det_idx] = True
-            det_match_scores_list.extend(good_det_scores[match_mask].tolist())
-            det_diff_scores_list.extend(good_det_scores[~match_mask].tolist())
-            # Store detected person_ids
-            det_person_ids = torch.full((len(good_det_boxes),), -1, dtype=torch.long)
-            det_person_ids[det_idx.cpu()] = gt_person_ids.cpu()[gt_idx.cpu()]
+            # Match detections with GT boxes: IoU is shared by all thresholds
+            match_quality_matrix = box_ops.box_iou(good_det_boxes, gt_boxes)
+            for _iou_thresh in iou_thresh_list:
+                det_idx, gt_idx = _match_boxes(match_quality_matrix.clone(), _iou_thresh)
+                #
+                num_gt_match_dict[_iou_thresh] += gt_idx.shape[0]
+                det_matches = torch.zeros(len(good_det_boxes))
+                det_matches[det_idx] = 1
+                det_matches_dict[_iou_thresh].append(det_matches)
+                # Store matching and nonmatching scores
+                if _iou_thresh == primary_iou_thresh:
+                    match_mask = torch.zeros_like(good_det_scores).bool()
+                    match_mask[det_idx] = True
+                    det_match_scores_list.extend(good_det_scores[match_mask].tolist())
+                    det_diff_scores_list.extend(good_det_scores[~match_mask].tolist())
             # Compute cosine similarity used later for retrieval ranking
             ## We assume the embeddings are already normalized, and have other scores incorporated after normalization:
             ## confidence-weighted similarity from the detector
             det_sims = torch.mm(
                 F.normalize(query_embeddings),
-                F.normalize(good_det_embeddings).T,
+                F.normalize(dequantize_embeddings(good_det_embeddings.to(device))).T,
             )
             # Store everything in retrieval dict
-            assert det_matches.shape[0] == det_person_ids.shape[0] == det_sims.shape[1]
+            assert good_det_boxes.shape[0] == det_sims.shape[1]
             retrieval_lookup[image_id] = retrieval_lookup[image_id]._replace(sims=det_sims, boxes=good_det_boxes, cws=good_det_cws, iou=match_quality_matrix)
     #
     #print('num_det_tot:', num_det_tot)
-    #print('gt/tot:', num_gt_match, num_gt_tot)
-    det_recall = num_gt_match / num_gt_tot
-    # Compute AP@0.5
-    if len(det_scores_list) > 0:
-        ## Combine all scores, labels, and clean any invalid scores
-        det_scores = np.nan_to_num(torch.cat(det_scores_list).tolist(), posinf=0, neginf=0)
-        det_matches = torch.cat(det_matches_list).tolist()
-        ## Compute AP@0.5
-        det_ap = average_precision_score(det_matches, det_scores) * det_recall
-        ## Compute "real" AP
-        ### get num matches
-        num_match = torch.cat(det_matches_list).sum().item()
-        num_tot = det_scores.shape[0]
-        det_rap = (num_match / num_tot) * det_ap
-    else:
-        det_ap = 0
-        det_rap = 0
-    metric_dict = {
-        f'{partition_name}_ap@{iou_thresh}': det_ap,
-        f'{partition_name}_rap@{iou_thresh}': det_rap,
-        f'{partition_name}_recall@{iou_thresh}': det_recall,
-    }
+    metric_dict = {}
+    for _iou_thresh in iou_thresh_list:
+        metric_dict.update(_summarize_detection(partition_name,
+            num_gt_match_dict[_iou_thresh], num_gt_tot,
+            det_scores_list, det_matches_dict[_iou_thresh], iou_thresh=_iou_thresh))
     scores_dict = {
         'match_scores': det_match_scores_list,
         'diff_scores': det_diff_scores_list,
@@ -739,6 +1250,70 @@ def evaluate_detection_orig(partition_name, detection_lookup, image_lookup, quer
     return metric_dict, retrieval_lookup, scores_dict
 
 
+# Sim given to OC detections which were not retrieved by the ANN index: ranked after all retrieved detections
+ANN_FLOOR_SIM = -1e4
+
+# Function to get the embeddings of all OC detections used for retrieval, in retrieval lookup order
+def get_retrieval_embeddings(retrieval_lookup, detection_lookup, det_thresh=0.5):
+    """
+    Returns the normalized embeddings [N, D] of the detections with a sims
+    entry in the retrieval lookup, filtered with the same det_thresh as
+    evaluate_detection_orig, and the number of detections per image.
+    """
+    emb_list, num_det_list = [], []
+    for image_id, retrieval in retrieval_lookup.items():
+        if retrieval.sims is None:
+            num_det_list.append(0)
+            continue
+        detection = detection_lookup[image_id]
+        det_embeddings = detection.embeddings[detection.scores >= det_thresh]
+        assert det_embeddings.shape[0] == retrieval.sims.shape[1]
+        emb_list.append(F.normalize(det_embeddings.float()).cpu())
+        num_det_list.append(det_embeddings.shape[0])
+    emb = torch.cat(emb_list) if len(emb_list) > 0 else torch.zeros(0, 0)
+    return emb, num_det_list
+
+
+# Function to restrict OC retrieval to the top-k results of an ANN index
+def get_ann_retrieval_lookup(retrieval_lookup, detection_lookup, query_embeddings,
+        ann_mode='ivfpq', top_k=1000, train_size=None, det_thresh=0.5, **ann_kwargs):
+    """
+    Indexes all OC gallery detections, searches the top_k detections for each
+    query, and replaces the sims of each retrieval lookup entry: retrieved
+    detections get the score returned by the index, and all others get
+    ANN_FLOOR_SIM, so that retrieval metrics reflect the ANN shortlist.
+
+    Returns the new retrieval lookup, and the [Q, top_k] result indices into
+    the flat detection list.
+    """
+    emb, num_det_list = get_retrieval_embeddings(retrieval_lookup, detection_lookup, det_thresh=det_thresh)
+    num_query = query_embeddings.shape[0]
+    if emb.shape[0] == 0:
+        return retrieval_lookup, torch.full((num_query, top_k), -1, dtype=torch.long)
+    # Build the index
+    ann_index = get_ann_index(ann_mode, **ann_kwargs)
+    if (train_size is not None) and (train_size < emb.shape[0]):
+        train_idx = torch.randperm(emb.shape[0], generator=torch.Generator().manual_seed(0))[:train_size]
+        ann_index.train(emb[train_idx])
+    else:
+        ann_index.train(emb)
+    ann_index.add(emb)
+    # Search
+    ann_scores, ann_idx = ann_index.search(query_embeddings, top_k)
+    # Scatter results into flat sims, then split by image
+    valid_mask = ann_idx >= 0
+    flat_sims = torch.full((num_query, emb.shape[0]), ANN_FLOOR_SIM)
+    query_idx = torch.arange(num_query).unsqueeze(1).expand_as(ann_idx)
+    flat_sims[query_idx[valid_mask], ann_idx[valid_mask]] = ann_scores[valid_mask]
+    ann_retrieval_lookup = {}
+    for (image_id, retrieval), image_sims in zip(retrieval_lookup.items(), torch.split(flat_sims, num_det_list, dim=1)):
+        if retrieval.sims is None:
+            ann_retrieval_lookup[image_id] = retrieval
+        else:
+            ann_retrieval_lookup[image_id] = retrieval._replace(sims=image_sims.to(retrieval.sims.device))
+    return ann_retrieval_lookup, ann_idx
+
+
 # Person search retrieval evaluation function
 def evaluate_retrieval_orig(protocol,
         retrieval_lookup, query_lookup, image_lookup,
@@ -907,9 +1482,7 @@ def evaluate_retrieval_orig(protocol,
                 top1 = gallery_matches[top1_idx].item()
                 if gallery_matches.sum().item() > 0:
                     ## Compute AP on cleaned input
-                    ap = average_precision_score(gallery_matches.tolist(),
-                        np.nan_to_num(gallery_sims.tolist(), posinf=0, neginf=0)
-                    ) * query_recall
+                    ap = average_precision(gallery_matches, gallery_sims) * query_recall
                 else:
                     ap = 0
         else:
@@ -926,7 +1499,7 @@ def evaluate_retrieval_orig(protocol,
             ## GFN AP
             if sum(gfn_match_list) > 0:
                 ### Compute AP on cleaned input
-                gfn_ap = average_precision_score(gfn_match_list, np.nan_to_num(gfn_score_list, posinf=0, neginf=0))
+                gfn_ap = average_precision(gfn_match_list, gfn_score_list)
             else:
                 gfn_ap = 0
             ## GFN top-1 accuracy
@@ -946,13 +1519,17 @@ def evaluate_retrieval_orig(protocol,
     #print('match: {}/{}'.format(tot_pred_match1_count, tot_gt_match1_count))
     #print('recall: {}/{}'.format(tot_pred_match_count, tot_gt_match_count))
     #print('num no gt: {}'.format(num_no_gt))
-    match = tot_pred_match1_count / tot_gt_match1_count
-    recall = tot_pred_match_count / tot_gt_match_count
-    top1 = np.mean(top1_list)
+    return _summarize_retrieval(protocol, top1_list, ap_list,
+        gfn_top1_list, gfn_ap_list, full_gfn_match_list, full_gfn_score_list,
+        use_gt=use_gt, use_gfn=use_gfn)
+
 
-    # Show indices of wrong top1 pred
-    top1_tsr = torch.FloatTensor(top1_list)
-    top1_idx = torch.where(top1_tsr==0)[0]
+# Function to compute summary retrieval metrics from per-query results
+def _summarize_retrieval(protocol, top1_list, ap_list,
+        gfn_top1_list, gfn_ap_list, full_gfn_match_list, full_gfn_score_list,
+        use_gt=False, use_gfn=False):
+    # Compute final summary metrics
+    top1 = np.mean(top1_list)
     mAP = np.mean(ap_list)
 
     # Store metrics
@@ -1013,6 +1590,294 @@ def evaluate_retrieval_orig(protocol,
     return metric_dict, value_dict
 
 
+# Person search retrieval evaluation function: vectorized version
+def evaluate_retrieval_fast(protocol,
+        retrieval_lookup, query_lookup, image_lookup,
+        iou_thresh=0.5, iou_thresh_mode='variable', use_gt=False, use_gfn=False, use_cws=False,
+        query_chunk_size=256):
+    """
+    Vectorized version of evaluate_retrieval_orig with identical outputs.
+
+    Gallery detections are packed into flat ragged (CSR-style) tensors, indexed
+    by retrieval unit: a gallery image for OC lookups, or a (gallery image, query)
+    pair for QC lookups. Matching, top-1 and AP are then computed for a chunk of
+    queries at a time, instead of looping over each (query, gallery image) pair.
+
+    The erroneous CUHK/PRW behavior of the original function is kept: GT in
+    duplicate gallery images is counted but the duplicate is not evaluated, and
+    only the first box of a repeated person_id in a gallery image is used.
+    """
+    # Unpack protocol data
+    if protocol.name == 'all':
+        query_id_list = protocol.data
+        protocol_dict = {'queries': None}
+    else:
+        protocol_dict = protocol.data
+        query_id_list = [int(x) for x in protocol_dict['queries']]
+    skip_identity = (protocol.name == 'all') or (type(protocol_dict['queries']) == list)
+    num_query = len(query_id_list)
+    num_query_emb = len(query_lookup)
+
+    # Index the gallery images
+    image_id_list = list(retrieval_lookup.keys())
+    num_image = len(image_id_list)
+    image_id_arr = np.array(image_id_list, dtype=np.int64)
+    image_sort_idx = np.argsort(image_id_arr, kind='stable')
+    sorted_image_id_arr = image_id_arr[image_sort_idx]
+    def _get_image_index(_image_id_list):
+        _image_id_arr = np.array(_image_id_list, dtype=np.int64)
+        _pos = np.searchsorted(sorted_image_id_arr, _image_id_arr).clip(max=max(num_image - 1, 0))
+        _found = (sorted_image_id_arr[_pos] == _image_id_arr) if num_image > 0 else np.zeros(len(_pos), dtype=bool)
+        return np.where(_found, image_sort_idx[_pos] if num_image > 0 else -1, -1)
+
+    # Pack GT person_ids and IoU thresholds for each gallery image
+    gt_person_id_list = [image_lookup[i].person_ids.cpu().view(-1) for i in image_id_list]
+    gt_count = torch.LongTensor([len(p) for p in gt_person_id_list])
+    gt_offset = gt_count.cumsum(0) - gt_count
+    gt_person_ids = torch.cat(gt_person_id_list).long() if num_image > 0 else torch.zeros(0, dtype=torch.long)
+    if iou_thresh_mode == 'variable':
+        gt_iou_thresh = torch.cat([image_lookup[i].iou_thresh.cpu().view(-1) for i in image_id_list])
+
+    # Pack query data
+    query_idx = torch.LongTensor([query_lookup[q].idx for q in query_id_list])
+    query_person_id = torch.LongTensor([int(query_lookup[q].person_id) for q in query_id_list])
+    query_image_index = torch.from_numpy(_get_image_index([query_lookup[q].image_id for q in query_id_list]))
+
+    # Pack the retrieval units
+    qc_lookup = (num_image > 0) and (type(retrieval_lookup[image_id_list[0]]) == dict)
+    if qc_lookup:
+        unit_list, unit_key_list = [], []
+        for image_index, image_id in enumerate(image_id_list):
+            for unit_query_id, detection in retrieval_lookup[image_id].items():
+                unit_query_idx = query_lookup[unit_query_id].idx
+                unit_list.append((image_index, unit_query_idx, detection))
+                unit_key_list.append(image_index * num_query_emb + unit_query_idx)
+    else:
+        unit_list = [(i, None, retrieval_lookup[g]) for i, g in enumerate(image_id_list)]
+        unit_key_list = list(range(num_image))
+    num_unit = len(unit_list)
+    unit_key = torch.LongTensor(unit_key_list)
+    sorted_unit_key, unit_sort_idx = torch.sort(unit_key, stable=True)
+    unit_image = torch.LongTensor([u[0] for u in unit_list])
+    det_unit_list = [u for u in unit_list if u[2].sims is not None]
+    unit_num_det = torch.LongTensor([0 if u[2].sims is None else u[2].sims.shape[-1] for u in unit_list])
+    unit_det_offset = unit_num_det.cumsum(0) - unit_num_det
+    ## IoU between each detection and each GT box of the image, flattened
+    unit_num_iou = unit_num_det * gt_count[unit_image] if num_unit > 0 else unit_num_det
+    unit_iou_offset = unit_num_iou.cumsum(0) - unit_num_iou
+    if len(det_unit_list) > 0:
+        unit_iou = torch.cat([u[2].iou.cpu().reshape(-1) for u in det_unit_list])
+        if use_cws:
+            for u in det_unit_list:
+                assert u[2].sims.shape[-1] == u[2].cws.shape[0]
+            unit_cws = torch.cat([u[2].cws.cpu().reshape(-1) for u in det_unit_list])
+        if qc_lookup:
+            unit_sims = torch.cat([u[2].sims[u[1]].cpu() for u in det_unit_list])
+    ## GFN scores: per (unit, query) for OC lookups, and per unit for QC lookups
+    if use_gfn:
+        if num_unit == 0:
+            unit_gfn = torch.zeros((0,) if qc_lookup else (0, num_query_emb))
+        elif qc_lookup:
+            unit_gfn = torch.stack([u[2].gfn_scores[u[1]].cpu() for u in unit_list])
+        else:
+            unit_gfn = torch.stack([u[2].gfn_scores.cpu() for u in unit_list])
+
+    # Compute metrics for each chunk of queries
+    ap_list, top1_list = [], []
+    gfn_ap_list, gfn_top1_list = [], []
+    full_gfn_match_list, full_gfn_score_list = [], []
+    if protocol.name == 'all':
+        all_gallery_index = np.arange(num_image)
+    elif type(protocol_dict['queries']) == list:
+        all_gallery_index = _get_image_index(protocol_dict['images'])
+    for chunk_start in tqdm(range(0, num_query, query_chunk_size)):
+        chunk_query_id_list = query_id_list[chunk_start:chunk_start + query_chunk_size]
+        num_chunk_query = len(chunk_query_id_list)
+
+        # Build (query, gallery image) pairs in the same order as the original loop
+        pair_query_list, pair_image_list = [], []
+        for local_query_index, query_id in enumerate(chunk_query_id_list):
+            if skip_identity:
+                gallery_index = all_gallery_index
+            else:
+                gallery_index = _get_image_index(protocol_dict['queries'][str(query_id)])
+            if (gallery_index < 0).any():
+                raise KeyError('Gallery image missing from retrieval lookup for query {}'.format(query_id))
+            pair_query_list.append(np.full(len(gallery_index), local_query_index, dtype=np.int64))
+            pair_image_list.append(gallery_index.astype(np.int64))
+        pair_query = torch.from_numpy(np.concatenate(pair_query_list))
+        pair_image = torch.from_numpy(np.concatenate(pair_image_list))
+
+        # Skip the identity search
+        if skip_identity:
+            keep_mask = pair_image != query_image_index[chunk_start + pair_query]
+            pair_query, pair_image = pair_query[keep_mask], pair_image[keep_mask]
+        num_pair = len(pair_query)
+        pair_query_idx = query_idx[chunk_start + pair_query]
+
+        # Count ground truth matches to the query person in each gallery image
+        gt_seg, gt_local = ragged_range(gt_count[pair_image])
+        gt_match = gt_person_ids[gt_offset[pair_image[gt_seg]] + gt_local] == query_person_id[chunk_start + pair_query[gt_seg]]
+        pair_gt_match_count = torch.zeros(num_pair, dtype=torch.long).index_add_(0, gt_seg, gt_match.long())
+        pair_has_gt = pair_gt_match_count > 0
+        ## Index of the first matching GT box: used for repeated person_ids
+        pair_first_gt = torch.zeros(num_pair, dtype=torch.long).scatter_reduce(
+            0, gt_seg[gt_match], gt_local[gt_match], reduce='amin', include_self=False)
+        ## Add 1 per gallery image, not the match count, to handle corner cases where it is > 1
+        query_gt_count = torch.zeros(num_chunk_query, dtype=torch.long).index_add_(0, pair_query, pair_has_gt.long())
+
+        # Get the retrieval unit for each pair
+        if qc_lookup:
+            pair_unit_key = pair_image * num_query_emb + pair_query_idx
+        else:
+            pair_unit_key = pair_image
+        pair_unit_pos = torch.searchsorted(sorted_unit_key, pair_unit_key).clamp(max=max(num_unit - 1, 0))
+        if (num_pair > 0) and ((num_unit == 0) or (sorted_unit_key[pair_unit_pos] != pair_unit_key).any()):
+            raise KeyError('Query missing from retrieval lookup')
+        pair_unit = unit_sort_idx[pair_unit_pos] if num_unit > 0 else pair_unit_pos
+
+        # Get GFN scores for each pair
+        if use_gfn:
+            if qc_lookup:
+                pair_gfn = unit_gfn[pair_unit]
+            else:
+                pair_gfn = unit_gfn[pair_unit, pair_query_idx]
+
+        # Handle mistake from CUHK dataset: repeated image in the gallery
+        ## Only the first occurrence of a gallery image with detects is evaluated
+        pair_sort_idx = np.lexsort((np.arange(num_pair), pair_image.numpy(), pair_query.numpy()))
+        sorted_pair_query = pair_query.numpy()[pair_sort_idx]
+        sorted_pair_image = pair_image.numpy()[pair_sort_idx]
+        sorted_pair_first = np.ones(num_pair, dtype=bool)
+        sorted_pair_first[1:] = (sorted_pair_query[1:] != sorted_pair_query[:-1]) | (sorted_pair_image[1:] != sorted_pair_image[:-1])
+        pair_first = np.empty(num_pair, dtype=bool)
+        pair_first[pair_sort_idx] = sorted_pair_first
+        pair_eval_mask = torch.from_numpy(pair_first) & (unit_num_det[pair_unit] > 0) if num_unit > 0 else torch.zeros(num_pair, dtype=torch.bool)
+        eval_pair = torch.where(pair_eval_mask)[0]
+        num_eval = len(eval_pair)
+        ## Make sure there is only 1 repeat of a person_id and not more
+        assert (pair_gt_match_count[eval_pair] <= 2).all()
+
+        # Expand evaluated pairs into their detections
+        eval_unit = pair_unit[eval_pair]
+        eval_query = pair_query[eval_pair]
+        det_seg, det_local = ragged_range(unit_num_det[eval_unit])
+        det_unit = eval_unit[det_seg]
+        det_query = eval_query[det_seg]
+        det_global = unit_det_offset[det_unit] + det_local
+
+        # Get sims for each detection
+        if qc_lookup:
+            det_sims = unit_sims[det_global] if num_eval > 0 else torch.zeros(0)
+        else:
+            chunk_query_idx = query_idx[chunk_start:chunk_start + num_chunk_query]
+            chunk_sims = torch.cat([u[2].sims.index_select(0, chunk_query_idx.to(u[2].sims.device)).cpu()
+                for u in det_unit_list], dim=1) if len(det_unit_list) > 0 else torch.zeros(num_chunk_query, 0)
+            det_sims = chunk_sims[det_query, det_global]
+
+        # If we are using confidence-weighted similarities (CWS / use_cws)
+        if use_cws and (num_eval > 0):
+            det_sims = det_sims * unit_cws[det_global]
+
+        # If using GFN, multiply sims by GFN scores
+        if use_gfn and (num_eval > 0):
+            gfn_dtype = torch.result_type(det_sims, pair_gfn[0])
+            det_sims = det_sims.to(gfn_dtype) * pair_gfn[eval_pair][det_seg].to(gfn_dtype)
+
+        # Get detections where IoU with the first matching GT box is above the required threshold
+        det_has_gt = pair_has_gt[eval_pair][det_seg]
+        det_cand_idx = torch.where(det_has_gt)[0]
+        cand_seg = det_seg[det_cand_idx]
+        cand_unit = det_unit[det_cand_idx]
+        cand_first_gt = pair_first_gt[eval_pair][cand_seg]
+        cand_iou = unit_iou[unit_iou_offset[cand_unit] + det_local[det_cand_idx] * gt_count[unit_image[cand_unit]] + cand_first_gt] \
+            if len(det_cand_idx) > 0 else torch.zeros(0)
+        ## Using a fixed IoU threshold
+        if iou_thresh_mode == 'fixed':
+            cand_mask = cand_iou >= iou_thresh
+        ## Using the variable size-based threshold (standard)
+        elif iou_thresh_mode == 'variable':
+            cand_iou_thresh = gt_iou_thresh[gt_offset[unit_image[cand_unit]] + cand_first_gt] \
+                if len(det_cand_idx) > 0 else torch.zeros(0)
+            cand_mask = cand_iou >= cand_iou_thresh.to(cand_iou.dtype)
+        det_cand_idx = det_cand_idx[cand_mask]
+
+        # Mark the highest scoring candidate detection as the match for each pair
+        det_match = torch.zeros(len(det_seg), dtype=torch.bool)
+        match_idx = segment_argmax(det_sims[det_cand_idx], det_seg[det_cand_idx], num_eval)
+        det_match[det_cand_idx[match_idx[match_idx >= 0]]] = True
+
+        # Compute retrieval metrics for each query
+        query_num_eval = torch.bincount(eval_query, minlength=num_chunk_query)
+        query_pred_count = torch.zeros(num_chunk_query, dtype=torch.long).index_add_(0, det_query, det_match.long())
+        ## top-1 accuracy
+        top1_idx = segment_argmax(det_sims, det_query, num_chunk_query)
+        top1 = torch.where(top1_idx >= 0, det_match[top1_idx.clamp(min=0)].double(), 0.0) if len(det_seg) > 0 \
+            else torch.zeros(num_chunk_query, dtype=torch.double)
+        ## AP on cleaned input, scaled by recall
+        ap = segment_average_precision(det_match, det_sims, det_query, num_chunk_query)
+        query_gt_count_arr = query_gt_count.numpy()
+        query_pred_count_arr = query_pred_count.numpy()
+        valid_mask = (query_gt_count_arr > 0) & (query_num_eval.numpy() > 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ap = np.where(valid_mask & (query_pred_count_arr > 0), ap * (query_pred_count_arr / query_gt_count_arr), 0)
+        top1 = np.where(valid_mask, top1.numpy(), 0)
+        ## Store retrieval metrics
+        ap_list.extend(ap.tolist())
+        top1_list.extend(top1.tolist())
+
+        # If we are using the Gallery Filter Network
+        if use_gfn:
+            pair_gfn_score = pair_gfn.double()
+            pair_gfn_match = pair_has_gt.double()
+            ## GFN AP on cleaned input
+            gfn_ap = segment_average_precision(pair_gfn_match, pair_gfn_score, pair_query, num_chunk_query)
+            ## GFN top-1 accuracy
+            gfn_top_idx = segment_argmax(pair_gfn_score, pair_query, num_chunk_query)
+            gfn_top1 = torch.where(gfn_top_idx >= 0, pair_gfn_match[gfn_top_idx.clamp(min=0)], 0.0) if num_pair > 0 \
+                else torch.zeros(num_chunk_query, dtype=torch.double)
+            ## GFN neg filter @recall=0.99
+            full_gfn_match_list.extend(pair_gfn_match.tolist())
+            full_gfn_score_list.extend(pair_gfn_score.tolist())
+            ## Store metrics
+            gfn_ap_list.extend(gfn_ap.tolist())
+            gfn_top1_list.extend(gfn_top1.tolist())
+
+    # Compute final summary metrics
+    return _summarize_retrieval(protocol, top1_list, ap_list,
+        gfn_top1_list, gfn_ap_list, full_gfn_match_list, full_gfn_score_list,
+        use_gt=use_gt, use_gfn=use_gfn)
+
+
+# Person search retrieval evaluation function: selects the implementation
+def evaluate_retrieval(protocol,
+        retrieval_lookup, query_lookup, image_lookup,
+        retrieval_eval_mode='orig', **kwargs):
+    """
+    retrieval_eval_mode:
+        'orig': per-query loop (reference implementation)
+        'fast': vectorized implementation
+        'parity': run both, report the largest metric difference, return 'orig' results
+    """
+    if retrieval_eval_mode == 'orig':
+        return evaluate_retrieval_orig(protocol, retrieval_lookup, query_lookup, image_lookup, **kwargs)
+    elif retrieval_eval_mode == 'fast':
+        return evaluate_retrieval_fast(protocol, retrieval_lookup, query_lookup, image_lookup, **kwargs)
+    elif retrieval_eval_mode == 'parity':
+        orig_time = time.time()
+        metric_dict, value_dict = evaluate_retrieval_orig(protocol, retrieval_lookup, query_lookup, image_lookup, **kwargs)
+        fast_time = time.time()
+        fast_metric_dict, fast_value_dict = evaluate_retrieval_fast(protocol, retrieval_lookup, query_lookup, image_lookup, **kwargs)
+        end_time = time.time()
+        assert metric_dict.keys() == fast_metric_dict.keys()
+        max_diff = max([abs(metric_dict[k] - fast_metric_dict[k]) for k in metric_dict], default=0.0)
+        print('==> Retrieval parity ({}): max metric diff={:.3e}, orig={:.2f}s, fast={:.2f}s'.format(
+            protocol.name, max_diff, fast_time - orig_time, end_time - fast_time))
+        return metric_dict, value_dict
+    else:
+        raise NotImplementedError
+
+
 # Function to get retrieval results for displaying
 def get_retrieval_results(protocol,
         retrieval_lookup, query_lookup, image_lookup, subset_idx=None, exclude_self=True,
@@ -0,0 +1,254 @@
+# Global imports
+import argparse
+import json
+import time
+import scipy.optimize
+## torch
+import torch
+
+# Package imports
+from osr.engine import utils as engine_utils
+from osr.engine.search import load_model
+from osr.models.export import EXPORT_MODES, EXPORT_OUTPUT_NAMES, get_export_model
+
+
+# Formats of the exported graph
+EXPORT_FORMATS = ('torchscript', 'onnx')
+
+
+# Function to get random example inputs for an export wrapper
+def get_example_inputs(model, inference_mode, image_size, num_query=8, seed=0):
+    """
+    Returns a random normalized image, and for search_topk, the query loc
+    embeddings of random boxes in another random image, computed in eager mode.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    height, width = image_size
+    image = torch.randn(1, 3, height, width, generator=generator)
+    if inference_mode == 'det':
+        return (image,)
+    ## Random query boxes of at least 32x32 pixels
+    query_image = torch.randn(3, height, width, generator=generator)
+    xy1 = torch.rand(num_query, 2, generator=generator) * torch.FloatTensor([width - 64, height - 64])
+    wh = 32 + torch.rand(num_query, 2, generator=generator) * (torch.FloatTensor([width, height]) - xy1 - 32)
+    query_boxes = torch.cat([xy1, xy1 + wh], dim=1)
+    with torch.no_grad():
+        output = model([query_image], targets=[{'boxes': query_boxes}], inference_mode='gt')[0]
+    return (image, output['gt_loc_emb'])
+
+
+# Function to run the eager SPNet, with outputs in the format of the export wrapper
+def run_eager(model, inference_mode, inputs):
+    if inference_mode == 'det':
+        image, = inputs
+        output = model([image[0]], inference_mode='det')[0]
+        return (output['det_boxes'], output['det_scores'], output['det_labels'],
+            output['det_emb'], output['scene_emb'].reshape(1, -1))
+    else:
+        image, query_loc_emb = inputs
+        query = {
+            'query_loc_emb': list(query_loc_emb.split(1)),
+            'query_emb': list(query_loc_emb.split(1)),
+        }
+        output_list = model([image[0]], queries=[query], inference_mode='search_topk')[0]
+        query_index = torch.cat([torch.full((len(o['det_boxes']),), i, dtype=torch.long)
+            for i, o in enumerate(output_list)])
+        ## Embeddings of queries without detections may have another size
+        emb_list = [o['det_emb'] for o in output_list if len(o['det_boxes']) > 0]
+        return (torch.cat([o['det_boxes'] for o in output_list]),
+            torch.cat([o['det_scores'] for o in output_list]),
+            torch.cat([o['det_labels'] for o in output_list]),
+            query_index,
+            torch.cat(emb_list) if len(emb_list) > 0 else output_list[0]['det_emb'])
+
+
+# Function to get the image size of the parity inputs for a seed
+def get_parity_image_size(image_size, seed, dynamic=False):
+    """
+    For graphs with dynamic image sizes, parity is checked on sizes other than
+    the tracing size, which are not multiples of 32.
+    """
+    height, width = image_size
+    if dynamic:
+        return (height - 40 * seed - 7, width - 56 * seed + 13)
+    return (height, width)
+
+
+# Function to load an ONNX graph in an onnxruntime CPU session, as a function of torch tensors
+def load_onnx_session(onnx_path, num_threads=None):
+    import onnxruntime
+    session_options = onnxruntime.SessionOptions()
+    if num_threads is not None:
+        session_options.intra_op_num_threads = num_threads
+    session = onnxruntime.InferenceSession(onnx_path, session_options, providers=['CPUExecutionProvider'])
+    input_names = [i.name for i in session.get_inputs()]
+    def _run(*inputs):
+        output_list = session.run(None, {k:v.numpy() for k, v in zip(input_names, inputs)})
+        return tuple(torch.from_numpy(o) for o in output_list)
+    return _run
+
+
+# Function to match exported detections to eager detections
+def match_detections(eager_outputs, export_outputs, inference_mode):
+    """
+    Returns the index of the matching exported detection for each eager
+    detection, with a one-to-one assignment by box distance within the same
+    query (search_topk) or class (det): the order of detections with tied
+    scores may differ between runtimes.
+    """
+    key_index = 3 if inference_mode == 'search_topk' else 2
+    eager_boxes, export_boxes = eager_outputs[0].float(), export_outputs[0].float()
+    box_dist = (eager_boxes[:, None] - export_boxes[None]).abs().amax(dim=2)
+    box_dist[eager_outputs[key_index][:, None] != export_outputs[key_index][None]] = 1e9
+    _, det_idx = scipy.optimize.linear_sum_assignment(box_dist.numpy())
+    return torch.from_numpy(det_idx)
+
+
+# Function to compare exported and eager outputs
+def check_parity(model, export_model, inference_mode, inputs, atol=1e-4, rtol=0.0):
+    """
+    Returns a dict with the number of detections and the max abs difference
+    of each output, and whether all outputs match within atol + rtol * |eager|.
+    """
+    with torch.no_grad():
+        eager_outputs = run_eager(model, inference_mode, inputs)
+        export_outputs = export_model(*inputs)
+    result_dict = {'num_det': len(eager_outputs[0]), 'match': True}
+    ## Reorder exported detections to match eager detections
+    num_det = len(export_outputs[0])
+    if (result_dict['num_det'] == num_det) and (num_det > 0):
+        det_idx = match_detections(eager_outputs, export_outputs, inference_mode)
+        export_outputs = [o[det_idx] if k != 'scene_emb' else o
+            for k, o in zip(EXPORT_OUTPUT_NAMES[inference_mode], export_outputs)]
+    for name, eager_output, export_output in zip(EXPORT_OUTPUT_NAMES[inference_mode], eager_outputs, export_outputs):
+        ## Without detections, eager embeddings may have another size
+        if (eager_output.numel() == 0) and (export_output.numel() == 0):
+            continue
+        elif eager_output.shape != export_output.shape:
+            result_dict[name] = 'shape {} != {}'.format(tuple(export_output.shape), tuple(eager_output.shape))
+            result_dict['match'] = False
+        elif eager_output.numel() > 0:
+            eager_output, export_output = eager_output.float(), export_output.float()
+            result_dict[name] = (eager_output - export_output).abs().max().item()
+            result_dict['match'] &= torch.allclose(export_output, eager_output, atol=atol, rtol=rtol)
+    return result_dict
+
+
+# Function to benchmark the per-image latency of a function
+def benchmark_latency(func, inputs, num_warmup=3, num_iter=20):
+    with torch.no_grad():
+        for _ in range(num_warmup):
+            func(*inputs)
+        start_time = time.perf_counter()
+        for _ in range(num_iter):
+            func(*inputs)
+    return (time.perf_counter() - start_time) / num_iter
+
+
+# Main function
+def main():
+    parser = argparse.ArgumentParser(description='Export the SPNet det or search_topk inference graph with TorchScript or ONNX')
+    parser.add_argument('--default_config', default='./configs/default.yaml')
+    parser.add_argument('--trial_config', required=True,
+        help='Config of the trained model, e.g., the config.yaml in its log dir')
+    parser.add_argument('--ckpt_path', default=None,
+        help='Checkpoint to export: without one, random weights are used (for benchmarking only)')
+    parser.add_argument('--output', required=True, help='Output TorchScript or ONNX path')
+    parser.add_argument('--format', default='torchscript', choices=EXPORT_FORMATS,
+        help='torchscript: graph for a fixed image size, onnx: det graph for dynamic image sizes')
+    parser.add_argument('--inference_mode', default='det', choices=EXPORT_MODES)
+    parser.add_argument('--image_size', type=int, nargs=2, default=[896, 1504],
+        help='Image height and width: fixed size of the TorchScript graph (multiples of 32), or tracing size for ONNX')
+    parser.add_argument('--num_query', type=int, default=8,
+        help='Number of queries of the search_topk example inputs')
+    parser.add_argument('--freeze', action='store_true',
+        help='TorchScript: freeze the graph, i.e., inline the weights as constants, and fold them')
+    parser.add_argument('--opset_version', type=int, default=17,
+        help='ONNX opset version')
+    parser.add_argument('--num_parity', type=int, default=3,
+        help='Number of random inputs, other than the tracing inputs, to check parity with')
+    parser.add_argument('--atol', type=float, default=None,
+        help='Parity tolerance: 1e-4 for TorchScript, 1e-3 (with rtol=1e-4) for ONNX by default')
+    parser.add_argument('--num_iter', type=int, default=20,
+        help='Number of benchmark iterations (0 to skip the benchmark)')
+    parser.add_argument('--num_threads', type=int, default=None)
+    args = parser.parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    use_onnx = args.format == 'onnx'
+    if use_onnx and (args.inference_mode != 'det'):
+        raise ValueError('ONNX export supports the det inference mode only')
+    if use_onnx:
+        atol, rtol = (1e-3 if args.atol is None else args.atol), 1e-4
+    else:
+        atol, rtol = (1e-4 if args.atol is None else args.atol), 0.0
+
+    # Load config
+    default_config, tuple_key_list = engine_utils.load_config(args.default_config)
+    trial_config, _ = engine_utils.load_config(args.trial_config, tuple_key_list=tuple_key_list)
+    config = {**default_config, **trial_config}
+
+    # Build model on the CPU
+    if args.ckpt_path is None:
+        print('WARNING: no checkpoint given, exporting random weights')
+    start_time = time.time()
+    model = load_model(config, args.ckpt_path, 'cpu')
+    eager_startup_time = time.time() - start_time
+
+    # Trace and save the export wrapper: ONNX graphs pad images and compute anchors for any image size
+    export_model = get_export_model(model, args.inference_mode,
+        None if use_onnx else args.image_size).eval()
+    trace_inputs = get_example_inputs(model, args.inference_mode, args.image_size,
+        num_query=args.num_query, seed=0)
+    output_names = EXPORT_OUTPUT_NAMES[args.inference_mode]
+    if use_onnx:
+        with torch.no_grad():
+            torch.onnx.export(export_model, trace_inputs, args.output, dynamo=False,
+                opset_version=args.opset_version, input_names=['images'], output_names=list(output_names),
+                dynamic_axes={'images': {2: 'height', 3: 'width'},
+                    **{k:{0: 'num_det'} for k in output_names if k != 'scene_emb'}})
+    else:
+        with torch.no_grad():
+            traced_model = torch.jit.trace(export_model, trace_inputs, check_trace=False)
+        if args.freeze:
+            traced_model = torch.jit.freeze(traced_model)
+        meta_dict = {
+            'inference_mode': args.inference_mode,
+            'image_size': args.image_size,
+            'output_names': output_names,
+        }
+        torch.jit.save(traced_model, args.output, _extra_files={'meta.json': json.dumps(meta_dict)})
+    print('==> Saved {} {} graph to: {}'.format(args.format, args.inference_mode, args.output))
+
+    # Load the saved graph
+    start_time = time.time()
+    if use_onnx:
+        loaded_model = load_onnx_session(args.output, num_threads=args.num_threads)
+    else:
+        loaded_model = torch.jit.load(args.output, map_location='cpu')
+    export_startup_time = time.time() - start_time
+
+    # Check parity of the saved graph with eager mode, on inputs not used for tracing
+    all_match = True
+    for seed in range(1, args.num_parity + 1):
+        image_size = get_parity_image_size(args.image_size, seed, dynamic=use_onnx)
+        inputs = get_example_inputs(model, args.inference_mode, image_size,
+            num_query=args.num_query + seed, seed=seed)
+        result_dict = check_parity(model, loaded_model, args.inference_mode, inputs, atol=atol, rtol=rtol)
+        all_match &= result_dict['match']
+        print('==> Parity (seed={}, image size={}): {}'.format(seed, image_size, result_dict))
+    print('==> Parity with eager mode: {}'.format('PASS' if all_match else 'FAIL'))
+
+    # Benchmark startup and per-image latency of eager vs exported
+    print('==> Startup: eager model load={:.2f}s, exported graph load={:.2f}s'.format(
+        eager_startup_time, export_startup_time))
+    if args.num_iter > 0:
+        eager_time = benchmark_latency(lambda *x: run_eager(model, args.inference_mode, x),
+            trace_inputs, num_iter=args.num_iter)
+        export_time = benchmark_latency(loaded_model, trace_inputs, num_iter=args.num_iter)
+        print('==> CPU latency per image ({} threads): eager={:.1f}ms, {}={:.1f}ms ({:.2f}x)'.format(
+            torch.get_num_threads(), eager_time * 1000, args.format, export_time * 1000, eager_time / export_time))
+
+    # Fail if parity was not reached
+    if not all_match:
+        raise SystemExit(1)
@@ -0,0 +1,245 @@
+# Global imports
+import os
+import tempfile
+import collections
+import numpy as np
+## torch
+import torch
+
+
+# Cached features for one image
+## levels holds a tensor per feature level when in memory, or a (byte offset, shape, dtype) tuple per level when spilled
+FeatureCacheEntry = collections.namedtuple('FeatureCacheEntry',
+    ['input_shape', 'keys', 'dtypes', 'levels', 'spilled'],
+)
+
+
+class FeatureCache:
+    """
+    Cache of per-image tensors keyed by image id. Used to share backbone
+    features between the QUERY_CENTRIC1 and QUERY_CENTRIC2 eval stages, and
+    to keep gallery-side anchor embeddings for QC search with new queries
+    (see SPNet.anchor_cache).
+
+    Features are kept on the CPU (in fp16 by default, except for keys in
+    full_precision_key_set). Once the in-memory size reaches max_bytes,
+    features for new images are appended to a spill file in spill_dir, which
+    is read back through a memory map.
+    """
+    def __init__(self, max_bytes, spill_dir=None, use_fp16=True, full_precision_key_set=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.use_fp16 = use_fp16
+        self.full_precision_key_set = set() if full_precision_key_set is None else set(full_precision_key_set)
+        self.entry_dict = {}
+        self.num_bytes = 0
+        self.spill_path = None
+        self.spill_offset = 0
+        self._spill_arr = None
+        self.num_hit, self.num_miss = 0, 0
+
+    def __len__(self):
+        return len(self.entry_dict)
+
+    def _spill(self, level_list):
+        # Create the spill file on first use
+        if self.spill_path is None:
+            fd, self.spill_path = tempfile.mkstemp(prefix='osr_feature_cache_', suffix='.bin',
+                dir=self.spill_dir)
+            os.close(fd)
+        # Append each level to the end of the file
+        spill_level_list = []
+        with open(self.spill_path, 'ab') as fp:
+            for level in level_list:
+                arr = level.numpy()
+                fp.write(arr.tobytes())
+                spill_level_list.append((self.spill_offset, tuple(arr.shape), arr.dtype.str))
+                self.spill_offset += arr.nbytes
+        # Memory map must be reopened to see the new data
+        self._spill_arr = None
+        return spill_level_list
+
+    def _read_spill(self, offset, shape, dtype):
+        if self._spill_arr is None:
+            self._spill_arr = np.memmap(self.spill_path, dtype=np.uint8, mode='r')
+        dtype = np.dtype(dtype)
+        num_bytes = int(np.prod(shape)) * dtype.itemsize
+        return torch.from_numpy(np.array(self._spill_arr[offset:offset+num_bytes]).view(dtype).reshape(shape))
+
+    def put(self, image_id_list, features, input_shape):
+        """
+        Stores the features (an OrderedDict of [N, C, H, W] tensors) for each
+        of the N images of a batch. input_shape is the padded (H, W) of the
+        batch tensor the features were computed from.
+        """
+        input_shape = tuple(input_shape)
+        keys = list(features.keys())
+        dtypes = [level.dtype for level in features.values()]
+        for image_index, image_id in enumerate(image_id_list):
+            level_list = []
+            for key, level in features.items():
+                level = level[image_index].detach().cpu()
+                if level.dtype == torch.bfloat16:
+                    level = level.float()
+                if self.use_fp16 and level.is_floating_point() and (key not in self.full_precision_key_set):
+                    level = level.half()
+                level_list.append(level)
+            num_bytes = sum([level.numel() * level.element_size() for level in level_list])
+            # Replace any previous entry for this image
+            self.remove(image_id)
+            if (self.num_bytes + num_bytes) <= self.max_bytes:
+                self.num_bytes += num_bytes
+                self.entry_dict[image_id] = FeatureCacheEntry(input_shape=input_shape, keys=keys,
+                    dtypes=dtypes, levels=level_list, spilled=False)
+            else:
+                self.entry_dict[image_id] = FeatureCacheEntry(input_shape=input_shape, keys=keys,
+                    dtypes=dtypes, levels=self._spill(level_list), spilled=True)
+
+    def remove(self, image_id):
+        """
+        Removes the features for one image, if present. Space in the spill
+        file is only reclaimed by clear().
+        """
+        entry = self.entry_dict.pop(image_id, None)
+        if (entry is not None) and (not entry.spilled):
+            self.num_bytes -= sum([level.numel() * level.element_size() for level in entry.levels])
+
+    def get(self, image_id_list, input_shape, device):
+        """
+        Returns the batched features for the given images as an OrderedDict,
+        or None if any image is missing or was cached with a different padded
+        input shape (i.e., the batch composition differs from the one used to
+        fill the cache).
+        """
+        input_shape = tuple(input_shape)
+        entry_list = [self.entry_dict.get(image_id) for image_id in image_id_list]
+        if any([(e is None) or (e.input_shape != input_shape) for e in entry_list]):
+            self.num_miss += len(image_id_list)
+            return None
+        self.num_hit += len(image_id_list)
+        level_list_list = []
+        for entry in entry_list:
+            if entry.spilled:
+                level_list_list.append([self._read_spill(*level) for level in entry.levels])
+            else:
+                level_list_list.append(entry.levels)
+        features = collections.OrderedDict()
+        for key, dtype, level_list in zip(entry_list[0].keys, entry_list[0].dtypes, zip(*level_list_list)):
+            features[key] = torch.stack(level_list).to(device=device, dtype=dtype, non_blocking=True)
+        return features
+
+    def clear(self):
+        """
+        Removes all cached features and deletes the spill file.
+        """
+        self._spill_arr = None
+        if (self.spill_path is not None) and os.path.exists(self.spill_path):
+            os.remove(self.spill_path)
+        self.entry_dict = {}
+        self.num_bytes = 0
+        self.spill_path = None
+        self.spill_offset = 0
+        self.num_hit, self.num_miss = 0, 0
+
+
+# Build a cache for SPNet.anchor_cache
+def get_anchor_cache(max_bytes, spill_dir=None, use_fp16=False):
+    """
+    Returns a FeatureCache for the gallery-side outputs of SPNet search_topk:
+    backbone features, anchors and anchor embeddings. Anchors and anchor
+    embeddings are always kept in full precision. By default, so are the
+    backbone features, and cached searches give the same results as uncached
+    ones. With use_fp16, backbone features take half the memory, but the
+    detection embeddings and cascade-refined boxes, which are pooled from
+    them, are only close to the uncached ones (to fp16 precision).
+    """
+    return FeatureCache(max_bytes, spill_dir=spill_dir, use_fp16=use_fp16,
+        full_precision_key_set={'_anchors', '_anchor_emb'})
+
+
+# Reuse of backbone features across near-static video frames
+class TemporalFeatureReuse:
+    """
+    Reuses backbone features across near-static frames of a video stream,
+    for frames seen in stream order (see TestSampler video_order). A frame
+    reuses the features of the current key frame of its stream if their
+    images, average pooled by downsample, differ by at most delta_thresh in
+    every pooled cell (so a single moving person is not missed), and fewer
+    than key_interval frames have reused the key frame. Otherwise, it becomes the new key frame. Images missing
+    from frame_key_dict (image_id -> (stream, frame)) are always key frames.
+    """
+    def __init__(self, frame_key_dict, delta_thresh=0.1, key_interval=10, downsample=16):
+        self.frame_key_dict = frame_key_dict
+        self.delta_thresh = delta_thresh
+        self.key_interval = key_interval
+        self.downsample = downsample
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the key frame, and resets the reuse stats.
+        """
+        self.key_stream = None
+        self.key_input_shape = None
+        self.key_thumb = None
+        self.key_features = None
+        self.key_count = 0
+        self.num_frame, self.num_reuse = 0, 0
+
+    @property
+    def skip_rate(self):
+        return self.num_reuse / max(self.num_frame, 1)
+
+    def get_features(self, image_id_list, image_tensor, backbone_func):
+        """
+        Returns the backbone features (an OrderedDict of [N, C, H, W] tensors)
+        for a batch of frames, running backbone_func only on the key frames.
+        """
+        input_shape = tuple(image_tensor.shape[-2:])
+        thumbs = torch.nn.functional.avg_pool2d(image_tensor.float(), self.downsample)
+
+        # Pick key frames: source of the features of each frame, as a batch index, or None for the stored key frame
+        key_idx_list, source_list = [], []
+        key_source = None
+        for image_index, image_id in enumerate(image_id_list):
+            frame_key = self.frame_key_dict.get(image_id)
+            stream = None if frame_key is None else frame_key[0]
+            reuse = (stream is not None) and (stream == self.key_stream) and (input_shape == self.key_input_shape)
+            reuse = reuse and (self.key_count < self.key_interval)
+            if reuse:
+                reuse = (thumbs[image_index] - self.key_thumb).abs().mean(dim=0).max().item() <= self.delta_thresh
+            if reuse:
+                self.key_count += 1
+            else:
+                self.key_stream, self.key_input_shape = stream, input_shape
+                self.key_thumb = thumbs[image_index]
+                self.key_count = 0
+                key_source = image_index
+                key_idx_list.append(image_index)
+            source_list.append(key_source)
+        self.num_frame += len(image_id_list)
+        self.num_reuse += len(image_id_list) - len(key_idx_list)
+
+        # Run the backbone on key frames only
+        batch_features = None
+        if len(key_idx_list) > 0:
+            if len(key_idx_list) == len(image_id_list):
+                batch_features = backbone_func(image_tensor)
+            else:
+                batch_features = backbone_func(image_tensor[key_idx_list])
+            if isinstance(batch_features, torch.Tensor):
+                batch_features = collections.OrderedDict([('0', batch_features)])
+        if len(key_idx_list) == len(image_id_list):
+            features = batch_features
+        else:
+            key_pos_dict = {image_index:pos for pos, image_index in enumerate(key_idx_list)}
+            keys = self.key_features.keys() if batch_features is None else batch_features.keys()
+            features = collections.OrderedDict()
+            for key in keys:
+                features[key] = torch.stack([self.key_features[key] if source is None
+                    else batch_features[key][key_pos_dict[source]] for source in source_list])
+
+        # Store the features of the last key frame for the next batch
+        if key_source is not None:
+            self.key_features = collections.OrderedDict([(k, v[-1]) for k, v in batch_features.items()])
+        return features
@@ -0,0 +1,320 @@
+# Global imports
+import os
+import json
+import shutil
+import numpy as np
+## torch
+import torch
+import torch.nn.functional as F
+
+
+# Name of the index manifest file
+MANIFEST_NAME = 'index.json'
+
+
+class _Segment:
+    """
+    One immutable segment of a GalleryIndex, stored as .npy files in its own
+    dir and opened as read-only memory maps.
+    """
+    def __init__(self, segment_dir):
+        self.segment_dir = segment_dir
+        with open(os.path.join(segment_dir, 'meta.json'), 'r') as fp:
+            self.image_key_list = json.load(fp)['image_key_list']
+        self.det_emb = self._load('det_emb')
+        self.det_boxes = self._load('det_boxes')
+        self.det_scores = self._load('det_scores')
+        self.det_image = self._load('det_image')
+        self.scene_emb = self._load('scene_emb')
+
+    def _load(self, name):
+        path = os.path.join(self.segment_dir, '{}.npy'.format(name))
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.image_key_list)
+
+
+class GalleryIndex:
+    """
+    Persistent, append-only index of object-centric detections for a growing
+    gallery. For each image, stores the detection boxes and scores, the
+    L2-normalized detection embeddings and, if available, the GFN scene
+    embedding.
+
+    New images are buffered in memory, and written as a new immutable
+    segment once segment_size images are buffered (or on flush()). Segments
+    are listed in a manifest which is replaced atomically, so a reader never
+    sees a partial segment. Re-adding an image supersedes its older entry.
+
+    Segments are merged with a size-tiered policy: a segment of N images is
+    in tier floor(log(N) / log(merge_factor)), and once a tier holds
+    merge_factor segments, they are merged into one segment of a higher
+    tier, dropping superseded entries. Each image is thus rewritten about
+    log(num_image) / log(merge_factor) times, and there are at most
+    merge_factor - 1 segments per tier.
+
+    Segments of a write or compaction that was interrupted before the
+    manifest was replaced are removed when the index is opened, so only one
+    process should write to an index at a time.
+    """
+    def __init__(self, index_dir, segment_size=1024, merge_factor=8, use_fp16=True):
+        assert merge_factor >= 2
+        self.index_dir = index_dir
+        self.segment_size = segment_size
+        self.merge_factor = merge_factor
+        self.use_fp16 = use_fp16
+        os.makedirs(index_dir, exist_ok=True)
+        # Load manifest
+        manifest_path = os.path.join(index_dir, MANIFEST_NAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as fp:
+                self.manifest = json.load(fp)
+        else:
+            self.manifest = {'segment_list': [], 'next_segment': 0}
+        self._remove_orphans()
+        self.segment_list = [_Segment(os.path.join(index_dir, s)) for s in self.manifest['segment_list']]
+        self.buffer_list = []
+        self._update_lookup()
+
+    def _remove_orphans(self):
+        # Remove temporary files and segments which are not in the manifest
+        live_name_set = set(self.manifest['segment_list'])
+        for name in os.listdir(self.index_dir):
+            if not (name.endswith('.tmp') or (name.startswith('seg_') and (name not in live_name_set))):
+                continue
+            path = os.path.join(self.index_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            ## Never reuse the name of a segment which was written after the manifest
+            if name.startswith('seg_'):
+                segment_index = int(name[len('seg_'):].split('.')[0])
+                self.manifest['next_segment'] = max(self.manifest['next_segment'], segment_index + 1)
+
+    def _update_lookup(self):
+        # Latest (segment, local image index) of each image key
+        self.image_lookup = {}
+        for segment_index, segment in enumerate(self.segment_list):
+            for image_index, image_key in enumerate(segment.image_key_list):
+                self.image_lookup[image_key] = (segment_index, image_index)
+
+    def __len__(self):
+        return len(self.image_lookup) + len([b for b in self.buffer_list if b['image_key'] not in self.image_lookup])
+
+    def __contains__(self, image_key):
+        return (image_key in self.image_lookup) or any([b['image_key'] == image_key for b in self.buffer_list])
+
+    def add(self, image_key, det_boxes, det_scores, det_emb, scene_emb=None):
+        """
+        Adds the detections of one image. Boxes should be in original image
+        coordinates.
+        """
+        self.buffer_list.append({
+            'image_key': image_key,
+            'det_boxes': det_boxes.detach().float().cpu().reshape(-1, 4),
+            'det_scores': det_scores.detach().float().cpu().reshape(-1),
+            'det_emb': F.normalize(det_emb.detach().float(), dim=-1).cpu(),
+            'scene_emb': None if (scene_emb is None) or (scene_emb.numel() == 0) else scene_emb.detach().float().cpu().reshape(-1),
+        })
+        if len(self.buffer_list) >= self.segment_size:
+            self.flush()
+
+    def _get_array_dict(self, entry_list):
+        # Arrays of a segment for a list of buffered images
+        array_dict = {
+            'det_emb': torch.cat([e['det_emb'] for e in entry_list]).numpy(),
+            'det_boxes': torch.cat([e['det_boxes'] for e in entry_list]).numpy(),
+            'det_scores': torch.cat([e['det_scores'] for e in entry_list]).numpy(),
+            'det_image': np.concatenate([np.full(len(e['det_scores']), i, dtype=np.int64) for i, e in enumerate(entry_list)]),
+        }
+        if all([e['scene_emb'] is not None for e in entry_list]):
+            array_dict['scene_emb'] = torch.stack([e['scene_emb'] for e in entry_list]).numpy()
+        return array_dict
+
+    def _write_segment(self, image_key_list, array_dict):
+        # Write all arrays to a new segment dir
+        segment_name = 'seg_{:06d}'.format(self.manifest['next_segment'])
+        segment_dir = os.path.join(self.index_dir, segment_name)
+        tmp_segment_dir = segment_dir + '.tmp'
+        os.makedirs(tmp_segment_dir)
+        emb_dtype = np.float16 if self.use_fp16 else np.float32
+        for name, arr in array_dict.items():
+            if name in ('det_emb', 'scene_emb'):
+                arr = arr.astype(emb_dtype)
+            np.save(os.path.join(tmp_segment_dir, '{}.npy'.format(name)), arr)
+        with open(os.path.join(tmp_segment_dir, 'meta.json'), 'w') as fp:
+            json.dump({'image_key_list': image_key_list}, fp)
+        os.rename(tmp_segment_dir, segment_dir)
+        self.manifest['next_segment'] += 1
+        return segment_name
+
+    def _write_manifest(self, segment_name_list):
+        self.manifest['segment_list'] = segment_name_list
+        manifest_path = os.path.join(self.index_dir, MANIFEST_NAME)
+        with open(manifest_path + '.tmp', 'w') as fp:
+            json.dump(self.manifest, fp)
+        os.replace(manifest_path + '.tmp', manifest_path)
+        self.segment_list = [_Segment(os.path.join(self.index_dir, s)) for s in segment_name_list]
+        self._update_lookup()
+
+    def flush(self):
+        """
+        Writes buffered images to a new segment, and compacts if needed.
+        """
+        if len(self.buffer_list) > 0:
+            segment_name = self._write_segment([e['image_key'] for e in self.buffer_list],
+                self._get_array_dict(self.buffer_list))
+            self.buffer_list = []
+            self._write_manifest(self.manifest['segment_list'] + [segment_name])
+        self.compact()
+
+    def _get_tier(self, segment):
+        # Size tier of a segment: floor(log(num_image) / log(merge_factor))
+        tier, num_image = 0, len(segment)
+        while num_image >= self.merge_factor:
+            num_image //= self.merge_factor
+            tier += 1
+        return tier
+
+    def compact(self, full=False):
+        """
+        Merges the segments of each tier which holds merge_factor segments,
+        from the lowest tier up, until no tier is full. If full is True, all
+        segments are merged into one.
+        """
+        if full:
+            if len(self.segment_list) > 1:
+                self._merge(list(range(len(self.segment_list))))
+            return
+        while True:
+            tier_dict = {}
+            for segment_index, segment in enumerate(self.segment_list):
+                tier_dict.setdefault(self._get_tier(segment), []).append(segment_index)
+            full_tier_list = [t for t, l in tier_dict.items() if len(l) >= self.merge_factor]
+            if len(full_tier_list) == 0:
+                return
+            self._merge(tier_dict[min(full_tier_list)])
+
+    def _get_live_image(self, segment_index):
+        # Mask of the images of a segment which are not superseded
+        segment = self.segment_list[segment_index]
+        return np.array([self.image_lookup[k] == (segment_index, i) for i, k in enumerate(segment.image_key_list)],
+            dtype=bool)
+
+    def _merge(self, merge_index_list):
+        # Collect the live images and detections of the merged segments, with one masked copy per array
+        image_key_list, array_list_dict = [], {}
+        use_scene_emb = all([self.segment_list[i].scene_emb is not None for i in merge_index_list])
+        for segment_index in merge_index_list:
+            segment = self.segment_list[segment_index]
+            live_image = self._get_live_image(segment_index)
+            det_image = np.asarray(segment.det_image)
+            live_det = live_image[det_image]
+            ## Index of each live image in the merged segment
+            merged_image_index = np.cumsum(live_image) - 1 + len(image_key_list)
+            image_key_list.extend([k for k, live in zip(segment.image_key_list, live_image) if live])
+            segment_array_dict = {
+                'det_emb': np.asarray(segment.det_emb)[live_det],
+                'det_boxes': np.asarray(segment.det_boxes)[live_det],
+                'det_scores': np.asarray(segment.det_scores)[live_det],
+                'det_image': merged_image_index[det_image[live_det]],
+            }
+            if use_scene_emb:
+                segment_array_dict['scene_emb'] = np.asarray(segment.scene_emb)[live_image]
+            for name, arr in segment_array_dict.items():
+                array_list_dict.setdefault(name, []).append(arr)
+        # Replace merged segments with the new one, keeping the manifest order of the others
+        old_name_list = self.manifest['segment_list']
+        merge_name_list = [old_name_list[i] for i in merge_index_list]
+        new_name_list = [n for n in old_name_list if n not in merge_name_list]
+        if len(image_key_list) > 0:
+            new_name_list.append(self._write_segment(image_key_list,
+                {k:np.concatenate(v) for k, v in array_list_dict.items()}))
+        self._write_manifest(new_name_list)
+        for segment_name in merge_name_list:
+            shutil.rmtree(os.path.join(self.index_dir, segment_name))
+
+    def _iter_chunks(self, chunk_size):
+        # Yields (det_emb, det_scores, global image index, live mask) for chunks of detections
+        image_offset = 0
+        for segment_index, segment in enumerate(self.segment_list):
+            live_image = self._get_live_image(segment_index)
+            for start in range(0, len(segment.det_scores), chunk_size):
+                end = start + chunk_size
+                det_image = np.asarray(segment.det_image[start:end])
+                yield (segment_index,
+                    start,
+                    torch.from_numpy(np.array(segment.det_emb[start:end])).float(),
+                    torch.from_numpy(np.array(segment.det_scores[start:end])),
+                    torch.from_numpy(det_image + image_offset),
+                    torch.from_numpy(live_image[det_image]))
+            image_offset += len(segment)
+
+    def _get_image_key(self, global_image_index):
+        for segment in self.segment_list:
+            if global_image_index < len(segment):
+                return segment.image_key_list[global_image_index]
+            global_image_index -= len(segment)
+        raise IndexError
+
+    @torch.no_grad()
+    def search(self, query_emb, top_k=100, det_thresh=0.5, chunk_size=65536):
+        """
+        Object-centric search: ranks all indexed detections by cosine
+        similarity with each query embedding [Q, D], as a chunked matrix
+        product with a running top-k. Returns, for each query, a list of
+        results (image_key, box, score, det_score) sorted by decreasing score.
+        """
+        self.flush()
+        query_emb = F.normalize(query_emb.detach().float().cpu(), dim=-1)
+        num_query = query_emb.size(0)
+        best_score = torch.full((num_query, 0), -float('inf'))
+        best_ref = torch.zeros((num_query, 0, 2), dtype=torch.long)
+        for segment_index, start, det_emb, det_scores, _, live_mask in self._iter_chunks(chunk_size):
+            sims = (query_emb @ det_emb.T).masked_fill(~(live_mask & (det_scores >= det_thresh)).unsqueeze(0), -float('inf'))
+            chunk_k = min(top_k, sims.size(1))
+            chunk_score, chunk_idx = torch.topk(sims, chunk_k, dim=1)
+            chunk_ref = torch.stack([torch.full_like(chunk_idx, segment_index), chunk_idx + start], dim=2)
+            # Merge with the running top-k
+            cat_score = torch.cat([best_score, chunk_score], dim=1)
+            cat_ref = torch.cat([best_ref, chunk_ref], dim=1)
+            best_score, best_idx = torch.topk(cat_score, min(top_k, cat_score.size(1)), dim=1)
+            best_ref = torch.gather(cat_ref, 1, best_idx.unsqueeze(2).expand(-1, -1, 2))
+        # Gather results
+        result_list = []
+        for query_index in range(num_query):
+            query_result_list = []
+            for score, (segment_index, det_index) in zip(best_score[query_index].tolist(), best_ref[query_index].tolist()):
+                if score == -float('inf'):
+                    break
+                segment = self.segment_list[segment_index]
+                query_result_list.append({
+                    'image_key': segment.image_key_list[segment.det_image[det_index]],
+                    'box': segment.det_boxes[det_index].tolist(),
+                    'score': score,
+                    'det_score': segment.det_scores[det_index].item(),
+                })
+            result_list.append(query_result_list)
+        return result_list
+
+    @torch.no_grad()
+    def shortlist(self, query_emb, top_m=100, det_thresh=0.5, chunk_size=65536):
+        """
+        Returns, for each query embedding [Q, D], the keys of the top_m images
+        by max detection similarity, e.g., to re-score with query-centric
+        search.
+        """
+        self.flush()
+        query_emb = F.normalize(query_emb.detach().float().cpu(), dim=-1)
+        num_image = sum([len(s) for s in self.segment_list])
+        image_score = torch.full((query_emb.size(0), num_image), -float('inf'))
+        for _, _, det_emb, det_scores, det_image, live_mask in self._iter_chunks(chunk_size):
+            sims = (query_emb @ det_emb.T).masked_fill(~(live_mask & (det_scores >= det_thresh)).unsqueeze(0), -float('inf'))
+            image_score.scatter_reduce_(1, det_image.unsqueeze(0).expand_as(sims), sims, reduce='amax')
+        top_score, top_idx = torch.topk(image_score, min(top_m, num_image), dim=1)
+        return [[self._get_image_key(i) for s, i in zip(_score, _idx) if s > -float('inf')]
+            for _score, _idx in zip(top_score.tolist(), top_idx.tolist())]
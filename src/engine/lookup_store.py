@@ -0,0 +1,241 @@
+# Global imports
+import os
+import json
+import collections
+import numpy as np
+## torch
+import torch
+
+# Package imports
+from osr.engine import evaluate
+
+
+# Version of the on-disk lookup store format
+STORE_VERSION = 1
+
+# Fields which hold embeddings or features: these are stored as fp16 by default
+EMBEDDING_FIELD_SET = {'embedding', 'loc_embedding', 'embeddings', 'features'}
+
+# Lookup names and the namedtuple used for their entries
+LOOKUP_ENTRY_DICT = {
+    'query': evaluate.QueryLookupEntry,
+    'image': evaluate.ImageLookupEntry,
+    'detection': evaluate.DetectionLookupEntry,
+}
+
+# Minimal stand-ins for the test data loader: compute_metrics only uses these sampler attributes
+StoreSampler = collections.namedtuple('StoreSampler',
+    ['partition_name', 'query_id_list', 'retrieval_dir', 'retrieval_name_list'],
+)
+
+StoreLoader = collections.namedtuple('StoreLoader',
+    ['sampler'],
+)
+
+
+# Helper to convert a tensor to a numpy-compatible tensor for storage
+def _to_storage(tensor, use_fp16):
+    tensor = tensor.detach().cpu()
+    if tensor.dtype == torch.bfloat16:
+        tensor = tensor.float()
+    if use_fp16 and tensor.is_floating_point():
+        tensor = tensor.half()
+    return tensor
+
+
+# Write one field of a lookup to disk in columnar format
+def _save_field(field_dir, field, value_list, use_fp16=False):
+    present_list = [v for v in value_list if v is not None]
+    # All entries are None
+    if len(present_list) == 0:
+        return {'kind': 'none'}
+    # Plain python values (e.g., the query idx)
+    if not torch.is_tensor(present_list[0]):
+        if len(present_list) != len(value_list):
+            raise TypeError('Field "{}" mixes None and non-tensor values'.format(field))
+        np.save(os.path.join(field_dir, '{}.npy'.format(field)), np.array(value_list))
+        return {'kind': 'value'}
+    # Tensors: ragged along the first dim, stored as one flat array plus offsets
+    field_meta = {
+        'kind': 'tensor',
+        'dtype': str(present_list[0].dtype).replace('torch.', ''),
+        'device': present_list[0].device.type,
+        'scalar': present_list[0].dim() == 0,
+        'valid': len(present_list) != len(value_list),
+    }
+    trailing_shape = tuple(present_list[0].shape[1:])
+    for value in present_list:
+        if (value.dim() == 0) != field_meta['scalar'] or tuple(value.shape[1:]) != trailing_shape:
+            raise ValueError('Field "{}" has inconsistent tensor shapes'.format(field))
+    row_count_arr = np.array([0 if v is None else (1 if v.dim() == 0 else v.shape[0]) for v in value_list], dtype=np.int64)
+    offset_arr = np.zeros(len(value_list) + 1, dtype=np.int64)
+    offset_arr[1:] = np.cumsum(row_count_arr)
+    storage_dtype = _to_storage(present_list[0].reshape(-1)[:0], use_fp16).numpy().dtype
+    data_arr = np.lib.format.open_memmap(os.path.join(field_dir, '{}.npy'.format(field)),
+        mode='w+', dtype=storage_dtype, shape=(int(offset_arr[-1]),) + trailing_shape)
+    for value, start, end in zip(value_list, offset_arr[:-1], offset_arr[1:]):
+        if (value is not None) and (end > start):
+            data_arr[start:end] = _to_storage(value, use_fp16).reshape((end - start,) + trailing_shape).numpy()
+    data_arr.flush()
+    del data_arr
+    np.save(os.path.join(field_dir, '{}.offsets.npy'.format(field)), offset_arr)
+    if field_meta['valid']:
+        np.save(os.path.join(field_dir, '{}.valid.npy'.format(field)),
+            np.array([v is not None for v in value_list]))
+    return field_meta
+
+
+# Read one field of a lookup from disk
+def _load_field(field_dir, field, field_meta, num_entry, device=None):
+    if field_meta['kind'] == 'none':
+        return [None] * num_entry
+    elif field_meta['kind'] == 'value':
+        return np.load(os.path.join(field_dir, '{}.npy'.format(field))).tolist()
+    # Copy-on-write memmap: torch tensors are views into the file until modified
+    data_arr = np.load(os.path.join(field_dir, '{}.npy'.format(field)), mmap_mode='c')
+    offset_arr = np.load(os.path.join(field_dir, '{}.offsets.npy'.format(field)))
+    if field_meta['valid']:
+        valid_arr = np.load(os.path.join(field_dir, '{}.valid.npy'.format(field)))
+    else:
+        valid_arr = np.ones(num_entry, dtype=bool)
+    dtype = getattr(torch, field_meta['dtype'])
+    if (field_meta['device'] != 'cpu') and (device is not None):
+        device = torch.device(device)
+    else:
+        device = torch.device('cpu')
+    data_tsr = torch.from_numpy(data_arr)
+    value_list = []
+    for start, end, valid in zip(offset_arr[:-1].tolist(), offset_arr[1:].tolist(), valid_arr.tolist()):
+        if not valid:
+            value_list.append(None)
+        elif field_meta['scalar']:
+            value_list.append(data_tsr[start].to(device=device, dtype=dtype))
+        else:
+            value_list.append(data_tsr[start:end].to(device=device, dtype=dtype))
+    return value_list
+
+
+# Write a lookup dict to disk
+def _save_lookup(lookup_dir, key_list, entry_list, entry_type, use_fp16=True):
+    os.makedirs(lookup_dir, exist_ok=True)
+    np.save(os.path.join(lookup_dir, 'keys.npy'), np.array(key_list, dtype=np.int64))
+    field_meta_dict = {}
+    for field in entry_type._fields:
+        value_list = [getattr(e, field) for e in entry_list]
+        field_meta_dict[field] = _save_field(lookup_dir, field, value_list,
+            use_fp16=use_fp16 and (field in EMBEDDING_FIELD_SET))
+    return field_meta_dict
+
+
+# Read a lookup dict from disk
+def _load_lookup(lookup_dir, field_meta_dict, entry_type, device=None):
+    key_arr = np.load(os.path.join(lookup_dir, 'keys.npy'))
+    num_entry = len(key_arr)
+    field_value_dict = {}
+    for field in entry_type._fields:
+        ## Fields added after the store was saved are None
+        field_value_dict[field] = _load_field(lookup_dir, field,
+            field_meta_dict.get(field, {'kind': 'none'}), num_entry, device=device)
+    entry_list = [entry_type(**{f:field_value_dict[f][i] for f in entry_type._fields}) for i in range(num_entry)]
+    return key_arr.tolist(), entry_list
+
+
+# Save evaluation lookups to disk
+def save_lookups(store_dir, sampler, eval_mode,
+        query_lookup, image_lookup, detection_lookup,
+        gfn_score_dict=None, use_fp16=True):
+    """
+    Saves the query, image and detection lookups from an evaluation pass as
+    memory-mappable columnar arrays, so that compute_metrics can be rerun
+    with different protocols or settings without running the model.
+
+    Each lookup is stored in its own directory with a keys array (image_id,
+    query_id, or (image_id, query_id) for QC detections) and, for each entry
+    field, a flat array of all entries concatenated along the first dim plus
+    an offsets array. Embeddings and features are stored as fp16 by default,
+    and restored to their original dtype when loading.
+    """
+    print('==> Saving lookups to: {}'.format(store_dir))
+    os.makedirs(store_dir, exist_ok=True)
+    meta_path = os.path.join(store_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    meta_dict = {
+        'version': STORE_VERSION,
+        'eval_mode': eval_mode,
+        'partition_name': sampler.partition_name,
+        'query_id_list': [int(q) for q in sampler.query_id_list],
+        'retrieval_dir': sampler.retrieval_dir,
+        'retrieval_name_list': list(sampler.retrieval_name_list),
+        'field_meta': {},
+    }
+    # Query and image lookups
+    meta_dict['field_meta']['query'] = _save_lookup(os.path.join(store_dir, 'query'),
+        list(query_lookup.keys()), list(query_lookup.values()), evaluate.QueryLookupEntry, use_fp16=use_fp16)
+    meta_dict['field_meta']['image'] = _save_lookup(os.path.join(store_dir, 'image'),
+        list(image_lookup.keys()), list(image_lookup.values()), evaluate.ImageLookupEntry, use_fp16=use_fp16)
+    # Detection lookup: QC detections are keyed by (image_id, query_id)
+    if eval_mode == 'qc':
+        key_list = [(i, q) for i, d in detection_lookup.items() for q in d]
+        entry_list = [e for d in detection_lookup.values() for e in d.values()]
+    else:
+        key_list = list(detection_lookup.keys())
+        entry_list = list(detection_lookup.values())
+    meta_dict['field_meta']['detection'] = _save_lookup(os.path.join(store_dir, 'detection'),
+        key_list, entry_list, evaluate.DetectionLookupEntry, use_fp16=use_fp16)
+    # GFN scores: (num_image, num_query) in image_lookup and query_lookup order
+    if gfn_score_dict is not None:
+        gfn_score_mat = torch.stack([gfn_score_dict[i] for i in image_lookup])
+        meta_dict['gfn_dtype'] = str(gfn_score_mat.dtype).replace('torch.', '')
+        np.save(os.path.join(store_dir, 'gfn_scores.npy'), _to_storage(gfn_score_mat, False).numpy())
+    meta_dict['has_gfn_scores'] = gfn_score_dict is not None
+    # Write metadata last, so an interrupted save is not mistaken for a valid store
+    with open(meta_path, 'w') as fp:
+        json.dump(meta_dict, fp)
+
+
+# Load evaluation lookups from disk
+def load_lookups(store_dir, retrieval_name_list=None, device=None):
+    """
+    Loads lookups saved with save_lookups. Tensors which were on an
+    accelerator when saved are moved to the given device.
+
+    Returns a stand-in data loader for compute_metrics, the eval mode, the
+    query, image and detection lookups, and the GFN score dict (or None).
+    """
+    with open(os.path.join(store_dir, 'meta.json'), 'r') as fp:
+        meta_dict = json.load(fp)
+    if meta_dict['version'] != STORE_VERSION:
+        raise ValueError('Unsupported lookup store version: {}'.format(meta_dict['version']))
+    field_meta = meta_dict['field_meta']
+    # Load lookups
+    lookup_dict = {}
+    for lookup_name, entry_type in LOOKUP_ENTRY_DICT.items():
+        lookup_dict[lookup_name] = _load_lookup(os.path.join(store_dir, lookup_name),
+            field_meta[lookup_name], entry_type, device=device)
+    query_lookup = dict(zip(*lookup_dict['query']))
+    image_lookup = dict(zip(*lookup_dict['image']))
+    if meta_dict['eval_mode'] == 'qc':
+        detection_lookup = collections.defaultdict(dict)
+        for (image_id, query_id), entry in zip(*lookup_dict['detection']):
+            detection_lookup[image_id][query_id] = entry
+        detection_lookup = dict(detection_lookup)
+    else:
+        detection_lookup = dict(zip(*lookup_dict['detection']))
+    # Load GFN scores
+    if meta_dict['has_gfn_scores']:
+        gfn_score_mat = torch.from_numpy(np.load(os.path.join(store_dir, 'gfn_scores.npy')))
+        gfn_score_mat = gfn_score_mat.to(getattr(torch, meta_dict['gfn_dtype']))
+        gfn_score_dict = dict(zip(image_lookup.keys(), gfn_score_mat))
+    else:
+        gfn_score_dict = None
+    # Build stand-in loader
+    if retrieval_name_list is None:
+        retrieval_name_list = meta_dict['retrieval_name_list']
+    data_loader = StoreLoader(sampler=StoreSampler(
+        partition_name=meta_dict['partition_name'],
+        query_id_list=meta_dict['query_id_list'],
+        retrieval_dir=meta_dict['retrieval_dir'],
+        retrieval_name_list=retrieval_name_list,
+    ))
+    return data_loader, meta_dict['eval_mode'], query_lookup, image_lookup, detection_lookup, gfn_score_dict
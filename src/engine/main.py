@@ -7,6 +7,7 @@ import argparse
 import os
 import sys
 import copy
+import time
 import shutil
 import glob
 from collections import OrderedDict
@@ -27,6 +28,10 @@ from pytorch_lightning.strategies import DDPStrategy, SingleDeviceStrategy
 # Package imports
 ## engine
 from osr.engine import evaluate
+from osr.engine import lookup_store
+from osr.engine.accumulator import LookupAccumulator
+from osr.engine.feature_cache import FeatureCache, TemporalFeatureReuse
+from osr.engine.pipeline import BatchPrefetcher, PendingOutput
 from osr.engine import utils as engine_utils
 from osr.models.seqnext import get_seqnext
 from osr.models.spnet import spnet
@@ -43,6 +48,21 @@ def set_bn_eval(module):
     if isinstance(module, torch.nn.modules.batchnorm._BatchNorm):
         module.eval()
 
+def get_gfn_tile_bytes(config):
+    if config['gfn_tile_mem_mb'] is None:
+        return None
+    return int(config['gfn_tile_mem_mb'] * 1024**2)
+
+def get_ann_kwargs(config):
+    return {
+        'top_k': config['ann_top_k'],
+        'train_size': config['ann_train_size'],
+        'num_list': config['ann_num_list'],
+        'num_probe': config['ann_num_probe'],
+        'pq_m': config['ann_pq_m'],
+        'rerank_k': config['ann_rerank_k'],
+    }
+
 class PLModule(LightningModule):
     def __init__(self, config=None, checkpoint_dir=None, lr=None):
         super().__init__()
@@ -114,11 +134,40 @@ class PLModule(LightningModule):
             else:
                 self.remaining_keys = [n for n, p in self.model.named_parameters() if (p.requires_grad and (n not in self.uninitialized_keys))]
 
+        # Streaming accumulator for detection outputs of the current eval stage
+        self.detection_accumulator = None
+
+        # Output of the previous QC search step, still being copied to the host
+        self.pending_output = None
+
+        # GFN gate for QC search, built at the start of QUERY_CENTRIC2
+        self.gfn_gate = None
+        self.search_start_time = None
+
+        # Cache backbone features from QUERY_CENTRIC1 for reuse in QUERY_CENTRIC2
+        self.feature_cache = None
+        ## Features are cached per frame, so the cache is not used with tiled inference
+        if self.config['qc_feature_cache'] and (self.config['ps_model'] == 'spnet') and (self.config['test_eval_mode'] in ('search', 'all')) and (self.config['test_tile_size'] is None):
+            self.feature_cache = FeatureCache(
+                int(self.config['qc_feature_cache_mem_gb'] * 1024**3),
+                spill_dir=self.config['qc_feature_cache_dir'],
+                use_fp16=self.config['qc_feature_cache_fp16'])
+            self.model.feature_cache = self.feature_cache
+
+        # Reuse backbone features across near-static video frames, which are evaluated in camera order
+        self.video_reuse = None
+        self.video_start_time = None
+        if self.config['video_feature_reuse'] and (self.config['ps_model'] == 'spnet') and (self.config['test_eval_mode'] != 'loss'):
+            self.video_reuse = TemporalFeatureReuse(test_loader.sampler.frame_key_dict,
+                delta_thresh=self.config['video_delta_thresh'],
+                key_interval=self.config['video_key_interval'],
+                downsample=self.config['video_delta_downsample'])
+            self.model.video_reuse = self.video_reuse
+
         # load eval protocol
         if not (self.config['test_eval_mode'] == 'loss'):
-            protocol_list = evaluate.get_protocol_list(test_loader)
-            assert len(protocol_list) == 1
-            self.protocol = protocol_list[0]
+            ## QC search is run once for the union of all protocols, then each protocol is scored
+            self.protocol_list = evaluate.get_protocol_list(test_loader)
 
         # Get list of modules needed for MOCO update
         if self.config['use_moco']:
@@ -152,9 +201,19 @@ class PLModule(LightningModule):
 
     def validation_step(self, batch, batch_idx, dataloader_idx=0):
         self.model.eval()
+        eval_stage = dataloader_idx
         if batch_idx == 0:
             self.validation_step_outputs = []
-        eval_stage = dataloader_idx
+            self.pending_output = None
+            # Detection lookups are streamed into ragged buffers instead of kept as per-step dicts
+            self.detection_accumulator = None
+            if self.config['stream_eval_outputs'] and (eval_stage in (EvalStage.OBJECT_CENTRIC, EvalStage.QUERY_CENTRIC2)):
+                self.detection_accumulator = LookupAccumulator(evaluate.DetectionLookupEntry,
+                    nested=(eval_stage == EvalStage.QUERY_CENTRIC2))
+            # Key frames and reuse stats are per eval stage
+            if self.video_reuse is not None:
+                self.video_reuse.reset()
+                self.video_start_time = time.time()
         #print('===')
         #print('EvalStage step:', eval_stage)
         #print('===')
@@ -172,22 +231,65 @@ class PLModule(LightningModule):
             output = evaluate.run_step_classifier(self.model, batch)
         elif eval_stage == EvalStage.OBJECT_CENTRIC:
             output = evaluate.run_step(self.model, batch,
-                dataloader.sampler.query_id_list)
+                dataloader.sampler.query_id_list,
+                emb_precision=self.config['emb_precision'])
         elif eval_stage == EvalStage.QUERY_CENTRIC1:
+            # Drop features cached with the weights from a previous eval
+            if (self.feature_cache is not None) and (batch_idx == 0):
+                self.feature_cache.clear()
             output = evaluate.run_step_query(self.model, batch,
-                dataloader.sampler.query_id_list)
+                dataloader.sampler.query_id_list,
+                emb_precision=self.config['emb_precision'])
         elif eval_stage == EvalStage.QUERY_CENTRIC2:
             prev_dataloader = self.val_dataloader()[EvalStage.QUERY_CENTRIC1]
+            if batch_idx == 0:
+                self.search_start_time = time.time()
+                # Score all (query, gallery image) pairs with the GFN before searching
+                self.gfn_gate = None
+                if self.config['gfn_gate'] and self.config['use_gfn'] and (self.config['ps_model'] == 'spnet'):
+                    query_embeddings, query_image_feat_list = evaluate.get_query_embeddings(
+                        prev_dataloader.query_lookup, prev_dataloader.image_lookup)
+                    gfn_score_dict = evaluate.get_gfn_scores(self.model,
+                        prev_dataloader.image_lookup, query_embeddings, query_image_feat_list,
+                        use_amp=self.config['use_amp'], use_gfn=True,
+                        tile_bytes=get_gfn_tile_bytes(self.config), score_dir=self.config['gfn_score_dir'])
+                    self.gfn_gate = evaluate.get_gfn_gate(gfn_score_dict, query_lookup=prev_dataloader.query_lookup,
+                        thresh=self.config['gfn_gate_thresh'], top_m=self.config['gfn_gate_top_m'])
             output = evaluate.run_step_search(self.model, batch,
                 prev_dataloader.sampler.query_id_list,
                 prev_dataloader.query_lookup,
                 prev_dataloader.image_lookup,
-                self.protocol, search_mode=self.search_mode,
-                compute_anchor_metrics=self.compute_anchor_metrics)
+                self.protocol_list, search_mode=self.search_mode,
+                compute_anchor_metrics=self.compute_anchor_metrics,
+                gfn_gate=self.gfn_gate,
+                emb_precision=self.config['emb_precision'],
+                async_output=self.config['test_prefetch'])
+        # Store the previous output once its copy to the host is done, so the copy overlaps with this step
+        if isinstance(output, PendingOutput):
+            self.store_pending_output()
+            self.pending_output = (output, eval_stage)
+        else:
+            self.store_step_output(output, eval_stage)
+
+    def store_step_output(self, output, eval_stage):
+        if self.detection_accumulator is not None:
+            if eval_stage == EvalStage.OBJECT_CENTRIC:
+                query_lookup, image_lookup, detection_lookup = output
+                output = (query_lookup, image_lookup, {})
+            elif eval_stage == EvalStage.QUERY_CENTRIC2:
+                detection_lookup, output = output, {}
+            self.detection_accumulator.add(detection_lookup)
         self.validation_step_outputs.append(output)
 
+    def store_pending_output(self):
+        if self.pending_output is not None:
+            pending_output, eval_stage = self.pending_output
+            self.pending_output = None
+            self.store_step_output(pending_output.get(), eval_stage)
+
     def on_validation_epoch_end(self, eval_stage=None):
         # Get outputs
+        self.store_pending_output()
         outputs = self.validation_step_outputs
 
         # Get eval stage
@@ -211,6 +313,8 @@ class PLModule(LightningModule):
             image_lookup = {k: v for d in image_list for k, v in d.items()}
             query_lookup = {k: v for d in query_list for k, v in d.items()}
             detection_lookup = {k: v for d in detection_list for k, v in d.items()}
+            if self.detection_accumulator is not None:
+                detection_lookup = self.detection_accumulator.lookup()
         elif eval_stage == EvalStage.QUERY_CENTRIC1:
             query_list, image_list = list(zip(*outputs))
             query_lookup = {k: v for d in query_list for k, v in d.items()}
@@ -221,8 +325,43 @@ class PLModule(LightningModule):
             prev_dataloader = self.val_dataloader()[EvalStage.QUERY_CENTRIC1]
             detection_list = outputs
             detection_lookup = {k: v for d in detection_list for k, v in d.items()}
+            if self.detection_accumulator is not None:
+                detection_lookup = self.detection_accumulator.lookup()
             query_lookup = prev_dataloader.query_lookup
             image_lookup = prev_dataloader.image_lookup
+            # Report GFN gate work vs. recall trade-off
+            if self.search_start_time is not None:
+                print('==> QC search time: {:.2f}s'.format(time.time() - self.search_start_time))
+            if self.gfn_gate is not None:
+                gate_curve_list = evaluate.get_gfn_gate_curve(self.gfn_gate,
+                    query_lookup, image_lookup,
+                    thresh_list=self.config['gfn_gate_curve_thresh_list'],
+                    top_m_list=self.config['gfn_gate_curve_top_m_list'])
+                print('==> GFN gate (thresh={}, top_m={}) recall vs. fraction of pairs searched:'.format(
+                    self.config['gfn_gate_thresh'], self.config['gfn_gate_top_m']))
+                for gate_curve in gate_curve_list:
+                    print('    {op}: pair_frac={pair_frac:.4f}, recall={recall:.4f}'.format(**gate_curve))
+            # Search is done: free the cached features
+            if self.feature_cache is not None:
+                print('==> Feature cache: {} hits, {} misses'.format(
+                    self.feature_cache.num_hit, self.feature_cache.num_miss))
+                self.feature_cache.clear()
+
+        # Report skip rate and throughput of video feature reuse
+        if (self.video_reuse is not None) and (self.video_reuse.num_frame > 0):
+            print('==> Video feature reuse (delta_thresh={}, key_interval={}): skip rate {:.4f} ({}/{} frames), {:.2f} frames/s'.format(
+                self.config['video_delta_thresh'], self.config['video_key_interval'],
+                self.video_reuse.skip_rate, self.video_reuse.num_reuse, self.video_reuse.num_frame,
+                self.video_reuse.num_frame / max(time.time() - self.video_start_time, 1e-6)))
+
+        # Report fraction of queries surviving each cascade step
+        if eval_stage in (EvalStage.OBJECT_CENTRIC, EvalStage.QUERY_CENTRIC2):
+            head = getattr(self.model, 'head', None)
+            if hasattr(head, 'get_cascade_stats') and (head.num_cascade_steps > 0):
+                cascade_stat_dict = head.get_cascade_stats()
+                print('==> Cascade survival (box_tol={}, score_thresh={}): {}'.format(
+                    self.config['cascade_exit_box_tol'], self.config['cascade_exit_score_thresh'],
+                    ', '.join(['{}={:.4f}'.format(k, v) for k, v in cascade_stat_dict.items()])))
 
         # Compute metrics
         if eval_stage == EvalStage.CLASSIFIER:
@@ -238,6 +377,8 @@ class PLModule(LightningModule):
                 dataloader,
                 query_lookup, image_lookup,
                 use_amp=self.config['use_amp'],
+                retrieval_eval_mode=self.config['retrieval_eval_mode'],
+                device=self.device,
             )
             # Log results
             if not self.config['test_only']:
@@ -252,6 +393,22 @@ class PLModule(LightningModule):
                 eval_mode = 'oc'
             elif eval_stage == EvalStage.QUERY_CENTRIC2:
                 eval_mode = 'qc'
+            # Store lookups so metrics can be recomputed later without running the model
+            gfn_score_dict = None
+            ## Reuse the GFN scores computed for gated QC search
+            if (eval_mode == 'qc') and (self.gfn_gate is not None):
+                gfn_score_dict = self.gfn_gate.score_dict
+            if self.config['lookup_store_dir'] is not None:
+                if self.config['use_gfn'] and (gfn_score_dict is None):
+                    query_embeddings, query_image_feat_list = evaluate.get_query_embeddings(query_lookup, image_lookup)
+                    gfn_score_dict = evaluate.get_gfn_scores(self.model,
+                        image_lookup, query_embeddings, query_image_feat_list,
+                        use_amp=self.config['use_amp'], use_gfn=True,
+                        tile_bytes=get_gfn_tile_bytes(self.config), score_dir=self.config['gfn_score_dir'])
+                lookup_store.save_lookups(self.config['lookup_store_dir'],
+                    dataloader.sampler, eval_mode,
+                    query_lookup, image_lookup, detection_lookup,
+                    gfn_score_dict=gfn_score_dict, use_fp16=self.config['lookup_store_fp16'])
             metric_dict, value_dict, scores_dict = evaluate.compute_metrics(self.model,
                 dataloader,
                 query_lookup, image_lookup, detection_lookup,
@@ -260,6 +417,15 @@ class PLModule(LightningModule):
                 eval_mode=eval_mode,
                 compute_anchor_metrics=self.compute_anchor_metrics,
                 use_cws=self.config['use_cws'],
+                retrieval_eval_mode=self.config['retrieval_eval_mode'],
+                det_eval_mode=self.config['det_eval_mode'],
+                det_iou_thresh_list=self.config['det_iou_thresh_list'],
+                gfn_score_dict=gfn_score_dict,
+                gfn_tile_bytes=get_gfn_tile_bytes(self.config),
+                gfn_score_dir=self.config['gfn_score_dir'],
+                ann_mode=self.config['ann_mode'],
+                ann_kwargs=get_ann_kwargs(self.config),
+                device=self.device,
             )
             # Log results
             if not self.config['test_only']:
@@ -568,16 +734,22 @@ class QueryCentricValLoop(pl.loops._EvaluationLoop):
         data_fetcher = self._data_fetcher
         prev_eval_stage = None
         assert data_fetcher is not None
-        while True:
+        # Copy the next batch to the device while the current batch is computed
+        pl_module = self.trainer.lightning_module
+        prefetcher = BatchPrefetcher(pl_module.device if pl_module.config['test_prefetch'] else None)
+        next_item = self._prefetch_next(data_fetcher, prefetcher)
+        while next_item is not None:
             try:
-                batch, batch_idx, curr_eval_stage = next(data_fetcher)
+                prefetched_batch, batch_idx, curr_eval_stage = next_item
+                batch = prefetcher.wait(prefetched_batch)
+                next_item = self._prefetch_next(data_fetcher, prefetcher)
                 if prev_eval_stage is None:
                     prev_eval_stage = curr_eval_stage
                 elif prev_eval_stage != curr_eval_stage:
                     self._store_dataloader_outputs()
                     self.on_run_end(prev_eval_stage)
                 prev_eval_stage = curr_eval_stage
-                self.batch_progress.is_last_batch = data_fetcher.done
+                self.batch_progress.is_last_batch = next_item is None
                 # run step hooks
                 self._evaluation_step(batch, batch_idx, curr_eval_stage)
             except StopIteration:
@@ -589,6 +761,14 @@ class QueryCentricValLoop(pl.loops._EvaluationLoop):
         self.on_run_end(prev_eval_stage)
         return []
 
+    def _prefetch_next(self, data_fetcher, prefetcher):
+        """Fetches the next batch, and starts its copy to the device: None when done."""
+        try:
+            batch, batch_idx, eval_stage = next(data_fetcher)
+        except StopIteration:
+            return None
+        return prefetcher.prefetch(batch), batch_idx, eval_stage
+
 class FullFinetuneCallback(BaseFinetuning):
     def __init__(self, unfreeze_at_epoch=10):
         super().__init__()
@@ -616,11 +796,45 @@ class FullFinetuneCallback(BaseFinetuning):
 
 
 Args = collections.namedtuple('Args',
-    ['default_config', 'trial_config', 'test', 'resume'],
+    ['default_config', 'trial_config', 'test', 'test_config', 'resume', 'eval_from_cache'],
     defaults=['./configs/default.yaml', './configs/default.yaml',
-        False, False],
+        False, None, False, None],
 )
 
+# Compute metrics from lookups stored during a previous evaluation pass
+def eval_from_cache(config, store_dir):
+    # Load lookups
+    device = engine_utils.get_device(config)
+    data_loader, eval_mode, query_lookup, image_lookup, detection_lookup, gfn_score_dict = lookup_store.load_lookups(
+        store_dir, retrieval_name_list=config['retrieval_name_list'], device=device)
+    if config['use_gfn'] and (gfn_score_dict is None):
+        raise ValueError('use_gfn is set, but no GFN scores were stored in: {}'.format(store_dir))
+    # Measure the impact of reduced precision embedding storage on stored lookups
+    if config['emb_precision'] != 'fp32':
+        image_lookup = evaluate.quantize_lookup(image_lookup, emb_precision=config['emb_precision'])
+        detection_lookup = evaluate.quantize_lookup(detection_lookup, emb_precision=config['emb_precision'])
+
+    # Compute metrics
+    metric_dict, value_dict, scores_dict = evaluate.compute_metrics(None,
+        data_loader,
+        query_lookup, image_lookup, detection_lookup,
+        use_amp=config['use_amp'], use_gfn=config['use_gfn'],
+        gfn_mode=config['gfn_mode'],
+        eval_mode=eval_mode,
+        compute_anchor_metrics=config['compute_anchor_metrics'],
+        use_cws=config['use_cws'],
+        retrieval_eval_mode=config['retrieval_eval_mode'],
+        det_eval_mode=config['det_eval_mode'],
+        det_iou_thresh_list=config['det_iou_thresh_list'],
+        gfn_score_dict=gfn_score_dict if config['use_gfn'] else None,
+        ann_mode=config['ann_mode'],
+        ann_kwargs=get_ann_kwargs(config),
+        device=device,
+    )
+    print(flush=True)
+    pprint(metric_dict)
+    return metric_dict
+
 # Main function
 def main(parse_config=True, **kwargs):
     # Parse args
@@ -631,6 +845,8 @@ def main(parse_config=True, **kwargs):
         parser.add_argument('--test', action='store_true')
         parser.add_argument('--test_config', default=None)
         parser.add_argument('--resume', action='store_true')
+        parser.add_argument('--eval_from_cache', default=None,
+            help='Lookup store directory: compute metrics from it without running the model')
         args = parser.parse_args()
     else:
         args = Args(**kwargs)
@@ -640,6 +856,14 @@ def main(parse_config=True, **kwargs):
     trial_config, _ = engine_utils.load_config(args.trial_config, tuple_key_list=tuple_key_list)
     config = {**default_config, **trial_config}
 
+    # Evaluate from a lookup store: skip the model and only compute metrics
+    if args.eval_from_cache is not None:
+        if args.test_config is not None:
+            test_config, _ = engine_utils.load_config(args.test_config, tuple_key_list)
+            config.update(test_config)
+        eval_from_cache(config, args.eval_from_cache)
+        return
+
     # For finetuning from pretraining, overwrite some args
     if config['pretrain_dir'] is not None:
         ## Load checkpoint using pretrain_dir and pretrain_epoch
@@ -725,9 +949,14 @@ def main(parse_config=True, **kwargs):
         save_last=True,
     )
 
-    # Set device
-    strategy_device = "cuda:0"
-    trainer_device = "auto"
+    # Set device: mixed precision is only used on the GPU
+    strategy_device = engine_utils.get_device(config)
+    if strategy_device.type == 'cuda':
+        trainer_device = "auto"
+        trainer_precision = "16-mixed"
+    else:
+        trainer_device = "cpu"
+        trainer_precision = "32-true"
 
     # Setup distributed params
     if config['distributed']:
@@ -785,7 +1014,7 @@ def main(parse_config=True, **kwargs):
     # Setup trainer
     trainer = Trainer(
         accelerator=trainer_device,
-        devices=config['world_size'] if torch.cuda.is_available() else None,
+        devices=config['world_size'] if strategy_device.type == 'cuda' else 1,
         max_epochs=warmup_epochs+regular_epochs,
         callbacks=callbacks,
         log_every_n_steps=10,
@@ -793,7 +1022,7 @@ def main(parse_config=True, **kwargs):
         num_sanity_val_steps=0,
         val_check_interval=val_check_interval,
         check_val_every_n_epoch=check_val_every_n_epoch,
-        precision="16-mixed",
+        precision=trainer_precision,
         gradient_clip_val=gradient_clip_val,
         enable_checkpointing=config['ckpt_interval']>0,
         strategy=strategy,
@@ -0,0 +1,126 @@
+# Global imports
+import numpy as np
+## torch
+import torch
+
+
+# Function to convert tensors, arrays, or lists to a flat numpy array
+def _to_numpy(x, dtype):
+    if isinstance(x, torch.Tensor):
+        x = x.detach().cpu()
+        if x.dtype == torch.bfloat16:
+            x = x.float()
+        x = x.numpy()
+    return np.asarray(x, dtype=dtype).reshape(-1)
+
+
+# Function to get the segment index and position within segment for ragged data
+def ragged_range(counts):
+    seg = torch.repeat_interleave(torch.arange(len(counts)), counts)
+    start = counts.cumsum(0) - counts
+    local = torch.arange(len(seg)) - start[seg]
+    return seg, local
+
+
+# Function to get the index of the first max value in each segment
+def segment_argmax(values, seg, num_seg):
+    """
+    Returns the flat index of the first maximal element of each segment, or -1
+    for empty segments. NaN is treated as larger than any other value, which
+    mimics the behavior of torch.argmax and torch.argsort(descending=True).
+    """
+    key = values.double()
+    key = torch.where(torch.isnan(key), torch.full_like(key, float('inf')), key)
+    seg_max = torch.full((num_seg,), -float('inf'), dtype=key.dtype).scatter_reduce(
+        0, seg, key, reduce='amax', include_self=True)
+    num_val = len(key)
+    pos = torch.where(key == seg_max[seg], torch.arange(num_val), num_val)
+    first_idx = torch.full((num_seg,), num_val, dtype=torch.long).scatter_reduce(
+        0, seg, pos, reduce='amin', include_self=True)
+    first_idx[first_idx == num_val] = -1
+    return first_idx
+
+
+# Function to compute average precision separately for each segment
+def segment_average_precision(labels, scores, seg, num_seg, clean=True):
+    """
+    Computes sklearn.metrics.average_precision_score independently for each
+    segment of flat arrays of binary labels and scores, with identical
+    results. Segments without any positive label get an AP of 0.
+
+    Inputs may be torch tensors, numpy arrays or lists. If clean is True, NaN
+    and +/-inf scores are replaced with 0 before ranking.
+    """
+    labels = _to_numpy(labels, np.float64)
+    scores = _to_numpy(scores, np.float64)
+    seg = _to_numpy(seg, np.int64)
+    if clean:
+        scores = np.nan_to_num(scores, nan=0, posinf=0, neginf=0)
+    ap = np.zeros(num_seg, dtype=np.float64)
+    if len(labels) == 0:
+        return ap
+
+    # Sort by segment, then by descending score
+    sort_idx = np.lexsort((-scores, seg))
+    labels, scores, seg = labels[sort_idx], scores[sort_idx], seg[sort_idx]
+
+    # Number of positives in each segment
+    num_pos = np.bincount(seg, weights=labels, minlength=num_seg)
+
+    # Cumulative true positive and false positive counts within each segment
+    seg_start = np.ones(len(seg), dtype=bool)
+    seg_start[1:] = seg[1:] != seg[:-1]
+    start_idx = np.flatnonzero(seg_start)
+    seg_len = np.diff(np.append(start_idx, len(seg)))
+    cum_labels = np.cumsum(labels)
+    tps = cum_labels - np.repeat(cum_labels[start_idx] - labels[start_idx], seg_len)
+    fps = np.arange(len(seg)) - np.repeat(start_idx, seg_len) + 1 - tps
+
+    # Keep only the last element of each run of tied scores (distinct thresholds)
+    thresh_mask = np.ones(len(seg), dtype=bool)
+    thresh_mask[:-1] = (seg[1:] != seg[:-1]) | (scores[1:] != scores[:-1])
+    tps, fps, seg = tps[thresh_mask], fps[thresh_mask], seg[thresh_mask]
+
+    # Step-wise integral of the precision-recall curve
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = tps / (tps + fps)
+        recall = tps / num_pos[seg]
+    thresh_start_idx = np.flatnonzero(np.append(True, seg[1:] != seg[:-1]))
+    prev_recall = np.zeros_like(recall)
+    prev_recall[1:] = recall[:-1]
+    prev_recall[thresh_start_idx] = 0
+    ap_terms = (recall - prev_recall) * precision
+    ## Sum each segment in the same (reversed) order as sklearn for identical results
+    seg_bounds = np.append(thresh_start_idx, len(seg))
+    for start, end in zip(seg_bounds[:-1], seg_bounds[1:]):
+        if num_pos[seg[start]] > 0:
+            ap[seg[start]] = np.sum(np.ascontiguousarray(ap_terms[start:end][::-1]))
+    return ap
+
+
+# Function to compute average precision for each row of padded arrays
+def padded_average_precision(labels, scores, mask=None, clean=True):
+    """
+    Computes average precision for each row of [Q, N] labels and scores.
+    Only elements where mask is True are used, if given.
+    """
+    labels = torch.as_tensor(labels)
+    scores = torch.as_tensor(scores)
+    num_seg = labels.shape[0]
+    seg = torch.arange(num_seg).unsqueeze(1).expand(labels.shape)
+    if mask is not None:
+        mask = torch.as_tensor(mask, dtype=torch.bool)
+        labels, scores, seg = labels[mask], scores[mask], seg[mask]
+    return segment_average_precision(labels, scores, seg, num_seg, clean=clean)
+
+
+# Function to compute average precision for one set of labels and scores
+def average_precision(labels, scores, clean=True):
+    """
+    Drop-in replacement for sklearn.metrics.average_precision_score on binary
+    labels. Returns 0 if there are no positive labels.
+    """
+    labels = _to_numpy(labels, np.float64)
+    return segment_average_precision(labels, scores, np.zeros(len(labels), dtype=np.int64), 1,
+        clean=clean)[0].item()
+
@@ -0,0 +1,146 @@
+# Global imports
+import collections
+## torch
+import torch
+
+
+# Side CUDA streams used for copies, one per device
+_copy_stream_dict = {}
+
+def get_copy_stream(device):
+    device = torch.device(device)
+    if device.type != 'cuda':
+        return None
+    if device not in _copy_stream_dict:
+        _copy_stream_dict[device] = torch.cuda.Stream(device)
+    return _copy_stream_dict[device]
+
+
+# Function to apply a function to all tensors of a nested batch
+def _map_tensors(func, data):
+    if torch.is_tensor(data):
+        return func(data)
+    elif isinstance(data, dict):
+        return type(data)((k, _map_tensors(func, v)) for k, v in data.items())
+    elif isinstance(data, (list, tuple)):
+        return type(data)(_map_tensors(func, v) for v in data)
+    return data
+
+
+def _get_tensors(data):
+    tensor_list = []
+    _map_tensors(tensor_list.append, data)
+    return tensor_list
+
+
+# Functions to pack tensors of one dtype into a flat buffer, and to get views of the tensors back
+def _pack_tensors(tensor_list):
+    return torch.cat([t.reshape(-1) for t in tensor_list])
+
+
+def _unpack_tensors(flat, shape_list):
+    return [t.view(shape) for t, shape in zip(torch.split(flat, [shape.numel() for shape in shape_list]), shape_list)]
+
+
+class BatchPrefetcher:
+    """
+    Copies batches to the device ahead of time: on CUDA devices, the copy of
+    the next batch is issued on a side stream, so that it overlaps with the
+    compute of the current batch. Batches should come from a loader with pinned
+    memory for the copy to be asynchronous. On the CPU, or with device=None,
+    batches are returned as is.
+
+    Usage:
+        prefetcher = BatchPrefetcher(device)
+        next_batch = prefetcher.prefetch(batch)
+        ...
+        batch = prefetcher.wait(next_batch)
+    """
+    def __init__(self, device=None):
+        self.device = None if device is None else torch.device(device)
+        self.stream = None if device is None else get_copy_stream(self.device)
+
+    def prefetch(self, batch):
+        if self.device is None:
+            return batch, None
+        if self.stream is None:
+            return _map_tensors(lambda t: t.to(self.device), batch), None
+        with torch.cuda.stream(self.stream):
+            batch = _map_tensors(lambda t: t.to(self.device, non_blocking=True), batch)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        return batch, event
+
+    def wait(self, prefetched_batch):
+        batch, event = prefetched_batch
+        if event is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(event)
+            # Tensors allocated on the side stream are used on the current stream
+            for tensor in _get_tensors(batch):
+                if tensor.device.type == 'cuda':
+                    tensor.record_stream(current_stream)
+        return batch
+
+
+class PackedHostTransfer:
+    """
+    Copies a list of tensors to the host with one transfer per dtype, instead
+    of one per tensor: the tensors are packed into a flat device buffer, which
+    is copied into pinned host memory on a side stream. The copy runs
+    asynchronously until wait() is called, which returns views of the host
+    buffer with the original shapes. Tensors already on the CPU are returned
+    as is, and tensors on other devices are copied synchronously.
+    """
+    def __init__(self, tensor_list):
+        # Tensors already on the host are kept, only the shapes of the others
+        self.host_list = [t if t.device.type == 'cpu' else None for t in tensor_list]
+        self.shape_list = [t.shape for t in tensor_list]
+        self.event_list = []
+        self.host_dict = {}
+        self.index_dict = collections.defaultdict(list)
+        for i, tensor in enumerate(tensor_list):
+            if tensor.device.type != 'cpu':
+                self.index_dict[(tensor.device, tensor.dtype)].append(i)
+        for (device, dtype), index_list in self.index_dict.items():
+            flat = _pack_tensors([tensor_list[i] for i in index_list])
+            stream = get_copy_stream(device)
+            if stream is None:
+                self.host_dict[(device, dtype)] = flat.cpu()
+                continue
+            host = torch.empty(flat.shape, dtype=dtype, pin_memory=True)
+            stream.wait_stream(torch.cuda.current_stream(device))
+            with torch.cuda.stream(stream):
+                host.copy_(flat, non_blocking=True)
+                flat.record_stream(stream)
+                event = torch.cuda.Event()
+                event.record(stream)
+            self.event_list.append(event)
+            self.host_dict[(device, dtype)] = host
+
+    def wait(self):
+        for event in self.event_list:
+            event.synchronize()
+        host_list = list(self.host_list)
+        for key, index_list in self.index_dict.items():
+            # Outputs may be kept for the whole eval: copy them to pageable memory, so that
+            # the pinned buffer allocated for this transfer is freed along with the transfer
+            host = self.host_dict[key]
+            if host.is_pinned():
+                host = torch.empty(host.shape, dtype=host.dtype).copy_(host)
+            for i, host_tensor in zip(index_list, _unpack_tensors(host, [self.shape_list[i] for i in index_list])):
+                host_list[i] = host_tensor
+        return host_list
+
+
+class PendingOutput:
+    """
+    Output of an eval step whose tensors are still being copied to the host:
+    get() waits for the copy, and builds the output from the host tensors.
+    """
+    def __init__(self, transfer, build_func):
+        self.transfer = transfer
+        self.build_func = build_func
+
+    def get(self):
+        return self.build_func(self.transfer.wait())
@@ -0,0 +1,150 @@
+# Global imports
+import argparse
+import copy
+import json
+import time
+from pprint import pprint
+## torch
+import torch
+from tqdm import tqdm
+
+# Package imports
+from osr.engine import evaluate
+from osr.engine import utils as engine_utils
+from osr.engine.main import get_ann_kwargs, get_gfn_tile_bytes
+from osr.engine.search import load_model
+from osr.models.quantize import QUANT_BACKENDS, SPNetQuantizer
+
+
+# Function to calibrate a quantizer on images from the train loader
+def calibrate(quantizer, train_loader, num_calib=256):
+    num_image = 0
+    with tqdm(total=num_calib, desc='Calibrate') as pbar:
+        for images, _ in train_loader:
+            images = images[:num_calib - num_image]
+            quantizer.calibrate(images)
+            num_image += len(images)
+            pbar.update(len(images))
+            if num_image >= num_calib:
+                break
+    return num_image
+
+
+# Function to compute object-centric metrics of a model on the CPU
+@torch.no_grad()
+def evaluate_oc(model, test_loader, config):
+    query_lookup, image_lookup, detection_lookup = {}, {}, {}
+    for batch in tqdm(test_loader, desc='Evaluate'):
+        _query_lookup, _image_lookup, _detection_lookup = evaluate.run_step(model, batch,
+            test_loader.sampler.query_id_list, emb_precision=config['emb_precision'])
+        query_lookup.update(_query_lookup)
+        image_lookup.update(_image_lookup)
+        detection_lookup.update(_detection_lookup)
+    metric_dict, _, _ = evaluate.compute_metrics(model,
+        test_loader,
+        query_lookup, image_lookup, detection_lookup,
+        use_amp=False, use_gfn=config['use_gfn'],
+        gfn_mode=config['gfn_mode'],
+        eval_mode='oc',
+        use_cws=config['use_cws'],
+        retrieval_eval_mode=config['retrieval_eval_mode'],
+        det_eval_mode=config['det_eval_mode'],
+        det_iou_thresh_list=config['det_iou_thresh_list'],
+        gfn_tile_bytes=get_gfn_tile_bytes(config),
+        gfn_score_dir=config['gfn_score_dir'],
+        ann_mode=config['ann_mode'],
+        ann_kwargs=get_ann_kwargs(config),
+        device='cpu',
+    )
+    return metric_dict
+
+
+# Function to measure the mean per-image detection latency of a model
+@torch.no_grad()
+def get_latency(model, image_list, num_warmup=2):
+    for image in image_list[:num_warmup]:
+        model([image], inference_mode='det')
+    start_time = time.perf_counter()
+    for image in image_list:
+        model([image], inference_mode='det')
+    return (time.perf_counter() - start_time) / len(image_list)
+
+
+# Main function
+def main():
+    parser = argparse.ArgumentParser(description='Post-training INT8 quantization of SPNet for CPU inference')
+    parser.add_argument('--default_config', default='./configs/default.yaml')
+    parser.add_argument('--trial_config', required=True,
+        help='Config of the trained model, e.g., the config.yaml in its log dir')
+    parser.add_argument('--ckpt_path', default=None,
+        help='Checkpoint to quantize: without one, random weights are used (for benchmarking only)')
+    parser.add_argument('--backend', default='x86', choices=QUANT_BACKENDS,
+        help='Quantized engine: x86 or fbgemm for x86 CPUs, qnnpack for ARM CPUs')
+    parser.add_argument('--num_calib', type=int, default=256,
+        help='Number of training images to calibrate activation ranges with')
+    parser.add_argument('--num_latency', type=int, default=20,
+        help='Number of test images to measure latency with')
+    parser.add_argument('--skip_eval', action='store_true',
+        help='Only measure latency, without computing metrics on the test set')
+    parser.add_argument('--num_threads', type=int, default=None)
+    parser.add_argument('--output', default=None,
+        help='Optional JSON path to save the fp32 and int8 metrics and latency to')
+    args = parser.parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    # Load config
+    default_config, tuple_key_list = engine_utils.load_config(args.default_config)
+    trial_config, _ = engine_utils.load_config(args.trial_config, tuple_key_list=tuple_key_list)
+    config = {**default_config, **trial_config}
+
+    # Build fp32 model on the CPU, and the int8 model from a copy
+    if args.ckpt_path is None:
+        print('WARNING: no checkpoint given, quantizing random weights')
+    model = load_model(config, args.ckpt_path, 'cpu')
+    quant_model = copy.deepcopy(model)
+
+    # Calibrate on training images, and convert
+    train_loader, _ = engine_utils.get_train_loader(config, rank=0, world_size=1, partition='train')
+    if config['use_ssl']:
+        index_list = train_loader.batch_sampler.set_epoch(0)
+        train_loader.dataset.set_epoch(0, index_list)
+    elif config['sampler_mode'] in ('repeat', 'pair'):
+        train_loader.batch_sampler.set_epoch(0)
+    quantizer = SPNetQuantizer(quant_model, backend=args.backend)
+    num_calib = calibrate(quantizer, train_loader, num_calib=args.num_calib)
+    quantizer.convert()
+    print('==> Quantized model with {} backend, calibrated on {} training images'.format(args.backend, num_calib))
+
+    # Measure per-image latency on test images
+    test_loader = engine_utils.get_test_loader(config)
+    image_list = []
+    for images, _ in test_loader:
+        image_list.extend(images)
+        if len(image_list) >= args.num_latency:
+            break
+    image_list = image_list[:args.num_latency]
+    result_dict = {
+        'fp32': {'latency_ms': get_latency(model, image_list) * 1000},
+        'int8': {'latency_ms': get_latency(quant_model, image_list) * 1000},
+    }
+    print('==> CPU latency per image ({} threads): fp32={:.1f}ms, int8={:.1f}ms ({:.2f}x)'.format(
+        torch.get_num_threads(), result_dict['fp32']['latency_ms'], result_dict['int8']['latency_ms'],
+        result_dict['fp32']['latency_ms'] / result_dict['int8']['latency_ms']))
+
+    # Compare object-centric metrics (mAP, top-1) of the fp32 and int8 models
+    if not args.skip_eval:
+        for name, _model in (('fp32', model), ('int8', quant_model)):
+            result_dict[name]['metrics'] = evaluate_oc(_model, test_loader, config)
+            print('==> {} metrics:'.format(name))
+            pprint(result_dict[name]['metrics'])
+        print('==> Metric deltas (int8 - fp32):')
+        for k, v in result_dict['fp32']['metrics'].items():
+            print('    {}: {:.4f} -> {:.4f} ({:+.4f})'.format(k, float(v), float(result_dict['int8']['metrics'][k]),
+                float(result_dict['int8']['metrics'][k]) - float(v)))
+
+    # Save results
+    if args.output is not None:
+        with open(args.output, 'w') as fp:
+            json.dump(result_dict, fp, indent=2, default=float)
+        print('==> Saved results to: {}'.format(args.output))
@@ -0,0 +1,449 @@
+# Global imports
+import argparse
+import os
+import json
+import time
+import numpy as np
+from PIL import Image
+## torch
+import torch
+import torch.nn.functional as F
+
+# Package imports
+from osr.engine import utils as engine_utils
+from osr.engine.feature_cache import get_anchor_cache
+from osr.engine.gallery_index import GalleryIndex
+from osr.models.spnet import spnet
+
+
+# Image file extensions to search in a gallery folder
+IMAGE_EXT_TUPLE = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+# Function to list the images in a folder, in sorted order
+def get_image_path_list(image_dir):
+    image_path_list = []
+    for root, _, file_list in os.walk(image_dir):
+        for file_name in file_list:
+            if file_name.lower().endswith(IMAGE_EXT_TUPLE):
+                image_path_list.append(os.path.join(root, file_name))
+    return sorted(image_path_list)
+
+
+# Function to get the list of queries from a folder of crops and/or a JSON file
+def get_query_list(query_dir=None, query_json=None):
+    """
+    Returns a list of dicts with keys: query_id, image (path), box (x1y1x2y2,
+    or None to use the whole image, i.e., a query crop).
+
+    query_json holds a list of {"query_id": ..., "image": ..., "box": [x1, y1, x2, y2]}.
+    Each image in query_dir is one query crop, with its file name as query_id.
+    """
+    query_list = []
+    if query_dir is not None:
+        for image_path in get_image_path_list(query_dir):
+            query_list.append({
+                'query_id': os.path.splitext(os.path.relpath(image_path, query_dir))[0],
+                'image': image_path,
+                'box': None,
+            })
+    if query_json is not None:
+        with open(query_json, 'r') as fp:
+            for query in json.load(fp):
+                query_list.append({
+                    'query_id': str(query['query_id']),
+                    'image': query['image'],
+                    'box': query.get('box'),
+                })
+    query_id_list = [q['query_id'] for q in query_list]
+    assert len(set(query_id_list)) == len(query_id_list), 'Query ids must be unique'
+    return query_list
+
+
+# Dataset of images with optional boxes, using the test transform of a config
+class SearchImageDataset(torch.utils.data.Dataset):
+    def __init__(self, image_path_list, transform, box_list=None):
+        self.image_path_list = image_path_list
+        self.transform = transform
+        self.box_list = box_list
+
+    def __len__(self):
+        return len(self.image_path_list)
+
+    def __getitem__(self, idx):
+        image = Image.open(self.image_path_list[idx]).convert('RGB')
+        w, h = image.size
+        # Build a minimal target in the format expected by the test transform
+        if self.box_list is None:
+            boxes = torch.empty((0, 4), dtype=torch.float32)
+        else:
+            box = self.box_list[idx]
+            if box is None:
+                box = [0, 0, w, h]
+            boxes = torch.FloatTensor([box])
+            boxes[:, 0::2].clamp_(min=0, max=w)
+            boxes[:, 1::2].clamp_(min=0, max=h)
+            ## Convert boxes to x, y, w, h
+            boxes[:, 2:] -= boxes[:, :2]
+        n = boxes.size(0)
+        target = {
+            'boxes': boxes,
+            'labels': torch.ones(n, dtype=torch.long),
+            'person_id': list(range(n)),
+            'id': list(range(n)),
+            'iou_thresh': torch.full((n,), 0.5),
+            'is_known': torch.ones(n, dtype=torch.bool),
+        }
+        image, target = self.transform((image, target))
+        target['image_id'] = torch.tensor([idx])
+        # Scale to map boxes back to the original image
+        target['scale'] = torch.FloatTensor([w / image.shape[-1], h / image.shape[-2]])
+        return image, target
+
+
+# Function to build the model and load checkpoint weights
+def load_model(config, ckpt_path, device):
+    """
+    Builds an SPNet with the spnet() builder, and loads weights from a
+    Lightning checkpoint onto the CPU first, so that checkpoints saved on a
+    GPU can be used on a CPU-only machine. Without a ckpt_path, the model
+    keeps its random weights.
+    """
+    # Weights come from the checkpoint: skip loading pretrained backbone weights
+    config = {**config, 'ckpt_path': None, 'test_only': True, 'backbone_weights': 'random',
+        'test_eval_mode': 'search'}
+    model, _ = spnet(config, oim_lut_size=(1, 1))
+    if ckpt_path is not None:
+        ckpt = torch.load(ckpt_path, map_location='cpu', weights_only=True)
+        ## Strip the 'model.' prefix of the PLModule, and drop training-only OIM buffers
+        state_dict = {k[6:]:v for k, v in ckpt['state_dict'].items() if not k[6:].startswith('head.reid_loss.')}
+        missing_keys, unexpected_keys = model.load_state_dict(state_dict, strict=False)
+        missing_keys = [k for k in missing_keys if not k.startswith('head.reid_loss.')]
+        if len(missing_keys) > 0:
+            print('WARNING: {} model keys missing from checkpoint: {}'.format(len(missing_keys), missing_keys[:10]))
+    model.eval()
+    return model.to(device)
+
+
+# Person search over a gallery of images
+class PersonSearcher:
+    """
+    Python API for query-centric person search with a trained SPNet.
+
+    Usage:
+        searcher = PersonSearcher(model, transform, device)
+        searcher.set_queries(get_query_list(query_dir=...))
+        for result in searcher.search(get_image_path_list(gallery_dir)):
+            ...
+
+    With anchor_cache_mem_gb set, topk search caches the backbone features,
+    anchors and anchor embeddings of each gallery image (see
+    osr.engine.feature_cache.get_anchor_cache). Searching the same images
+    again, e.g., after set_queries() with new queries, then only runs the
+    query-conditioned head. Cache hits need the same batches of images.
+    """
+    def __init__(self, model, transform, device, precision='fp32', search_mode='topk',
+            batch_size=4, num_workers=2, prefetch_factor=2, det_thresh=0.5, top_k=1,
+            anchor_cache_mem_gb=None, anchor_cache_dir=None, anchor_cache_fp16=False):
+        self.model = model
+        self.transform = transform
+        self.device = torch.device(device)
+        self.search_mode = search_mode
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        self.det_thresh = det_thresh
+        self.top_k = top_k
+        # fp16 autocast is poorly supported on the CPU: use bf16 instead
+        if (precision == 'fp16') and (self.device.type == 'cpu'):
+            print('WARNING: fp16 autocast is not supported on the CPU, using bf16')
+            precision = 'bf16'
+        self.precision = precision
+        self.autocast_dtype = {'fp32': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}[precision]
+        self.query_list = None
+        self.query_emb, self.query_loc_emb = None, None
+        self.batch_time_dict = {'search': [], 'detect': []}
+        # Optional cache of gallery anchor embeddings, spilled to anchor_cache_dir beyond anchor_cache_mem_gb
+        if anchor_cache_mem_gb is not None:
+            assert search_mode == 'topk', 'The anchor cache is only used by topk search'
+            self.model.anchor_cache = get_anchor_cache(int(anchor_cache_mem_gb * 1024**3),
+                spill_dir=anchor_cache_dir, use_fp16=anchor_cache_fp16)
+
+    def _get_loader(self, image_path_list, box_list=None):
+        dataset = SearchImageDataset(image_path_list, self.transform, box_list=box_list)
+        loader_kwargs = {}
+        if self.num_workers > 0:
+            loader_kwargs['prefetch_factor'] = self.prefetch_factor
+        return torch.utils.data.DataLoader(dataset,
+            batch_size=self.batch_size, shuffle=False,
+            num_workers=self.num_workers, pin_memory=self.device.type == 'cuda',
+            collate_fn=engine_utils.collate_fn, **loader_kwargs)
+
+    def _autocast(self):
+        return torch.autocast(device_type=self.device.type, dtype=self.autocast_dtype,
+            enabled=self.autocast_dtype is not None)
+
+    def _to_device(self, images, targets):
+        images = [image.to(self.device, non_blocking=True) for image in images]
+        targets = [{'boxes': t['boxes'].to(self.device, non_blocking=True),
+            'image_id': t['image_id'], 'scale': t['scale']} for t in targets]
+        return images, targets
+
+    def _sync(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    @torch.no_grad()
+    def set_queries(self, query_list):
+        """
+        Computes embeddings for a list of queries (see get_query_list).
+        """
+        self.query_list = query_list
+        emb_list, loc_emb_list = [], []
+        loader = self._get_loader([q['image'] for q in query_list], box_list=[q['box'] for q in query_list])
+        for images, targets in loader:
+            assert all([len(t['boxes']) == 1 for t in targets]), 'Query box lost by the transform'
+            images, targets = self._to_device(images, targets)
+            with self._autocast():
+                outputs = self.model(images, targets, inference_mode='gt')
+            emb_list.extend([o['gt_emb'].float() for o in outputs])
+            loc_emb_list.extend([o['gt_loc_emb'].float() for o in outputs])
+        self.query_emb = torch.cat(emb_list)
+        self.query_loc_emb = torch.cat(loc_emb_list)
+
+    @torch.no_grad()
+    def search(self, image_path_list, image_id_list=None, image_query_list=None):
+        """
+        Yields, for each gallery image in order, a dict with the image path
+        and a list of results (query_id, box, score, det_score) sorted by
+        decreasing score. Boxes are x1y1x2y2 in original image coordinates,
+        and scores are the cosine similarity with the query embedding.
+
+        image_id_list gives stable ids for the images, used as keys of the
+        anchor cache (default: the image paths). image_query_list gives the
+        indices of the queries to search for in each image (default: all).
+        """
+        assert self.query_list is not None, 'Call set_queries() first'
+        num_query = len(self.query_list)
+        query_emb_list = list(self.query_emb.split(1))
+        query_loc_emb_list = list(self.query_loc_emb.split(1))
+        norm_query_emb = F.normalize(self.query_emb)
+        loader = self._get_loader(image_path_list)
+        for images, targets in loader:
+            t0 = time.time()
+            images, targets = self._to_device(images, targets)
+            queries = []
+            for t in targets:
+                image_index = t['image_id'].item()
+                if image_query_list is None:
+                    query_idx_list = list(range(num_query))
+                else:
+                    query_idx_list = image_query_list[image_index]
+                queries.append({
+                    'query_id': query_idx_list,
+                    'query_emb': [query_emb_list[i] for i in query_idx_list],
+                    'query_loc_emb': [query_loc_emb_list[i] for i in query_idx_list],
+                    'image_id': image_path_list[image_index] if image_id_list is None else image_id_list[image_index],
+                })
+            with self._autocast():
+                outputs = self.model(images, queries=queries, inference_mode=f'search_{self.search_mode}')
+            result_list = []
+            for query, output in zip(queries, outputs):
+                image_result_list = []
+                for query_idx, query_output in zip(query['query_id'], output):
+                    det_mask = query_output['det_scores'] >= self.det_thresh
+                    if det_mask.sum() == 0:
+                        continue
+                    det_emb = F.normalize(query_output['det_emb'][det_mask].float())
+                    det_sims = (det_emb @ norm_query_emb[query_idx]).cpu()
+                    det_boxes = query_output['det_boxes'][det_mask].float().cpu()
+                    det_scores = query_output['det_scores'][det_mask].float().cpu()
+                    for det_idx in torch.argsort(det_sims, descending=True)[:self.top_k].tolist():
+                        image_result_list.append((det_sims[det_idx].item(), query_idx,
+                            det_boxes[det_idx], det_scores[det_idx].item()))
+                result_list.append(image_result_list)
+            self._sync()
+            self.batch_time_dict['search'].append((time.time() - t0, len(images)))
+            # Yield results for each image, mapping boxes back to original image coordinates
+            for target, image_result_list in zip(targets, result_list):
+                scale = target['scale'].repeat(2)
+                yield {
+                    'image': image_path_list[target['image_id'].item()],
+                    'results': [{
+                        'query_id': self.query_list[query_idx]['query_id'],
+                        'box': [round(x, 2) for x in (box * scale).tolist()],
+                        'score': score,
+                        'det_score': det_score,
+                    } for score, query_idx, box, det_score in sorted(image_result_list, key=lambda r: -r[0])],
+                }
+
+    @torch.no_grad()
+    def detect(self, image_path_list):
+        """
+        Runs object-centric detection, and yields, for each image in order, a
+        dict with the image path, detection boxes (x1y1x2y2 in original image
+        coordinates), scores and embeddings, and the GFN scene embedding (empty
+        if the model has no GFN). Detections below det_thresh are dropped.
+        """
+        loader = self._get_loader(image_path_list)
+        for images, targets in loader:
+            t0 = time.time()
+            images, targets = self._to_device(images, targets)
+            with self._autocast():
+                outputs = self.model(images, inference_mode='det')
+            self._sync()
+            self.batch_time_dict['detect'].append((time.time() - t0, len(images)))
+            for target, output in zip(targets, outputs):
+                det_mask = output['det_scores'] >= self.det_thresh
+                yield {
+                    'image': image_path_list[target['image_id'].item()],
+                    'det_boxes': output['det_boxes'][det_mask].float().cpu() * target['scale'].repeat(2),
+                    'det_scores': output['det_scores'][det_mask].float().cpu(),
+                    'det_emb': output['det_emb'][det_mask].float().cpu(),
+                    'scene_emb': output['scene_emb'].float().cpu(),
+                }
+
+    def get_latency_stats(self, stage='search'):
+        """
+        Returns per-image model latency stats (ms) over the batches of one
+        stage, 'search' or 'detect', excluding data loading.
+        """
+        batch_time_list = self.batch_time_dict[stage]
+        if len(batch_time_list) == 0:
+            return {}
+        image_time_arr = np.array([t / n for t, n in batch_time_list for _ in range(n)]) * 1000
+        return {
+            'num_image': len(image_time_arr),
+            'mean_ms': image_time_arr.mean().item(),
+            'p50_ms': np.percentile(image_time_arr, 50).item(),
+            'p95_ms': np.percentile(image_time_arr, 95).item(),
+        }
+
+
+# Main function
+def main():
+    # Parse args
+    parser = argparse.ArgumentParser(description='Search for query persons in a folder of gallery images')
+    parser.add_argument('--default_config', default='./configs/default.yaml')
+    parser.add_argument('--trial_config', required=True,
+        help='Config of the trained model, e.g., the config.yaml in its log dir')
+    parser.add_argument('--ckpt_path', required=True)
+    parser.add_argument('--gallery_dir', required=True)
+    parser.add_argument('--query_dir', default=None,
+        help='Folder of query crops: each image is one query')
+    parser.add_argument('--query_json', default=None,
+        help='JSON list of {"query_id", "image", "box": [x1, y1, x2, y2]}')
+    parser.add_argument('--output', required=True, help='Output JSONL path')
+    parser.add_argument('--device', default='cuda')
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'fp16', 'bf16'])
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--num_workers', type=int, default=2)
+    parser.add_argument('--prefetch_factor', type=int, default=2)
+    parser.add_argument('--det_thresh', type=float, default=0.5)
+    parser.add_argument('--top_k', type=int, default=1,
+        help='Max number of results per query in each gallery image')
+    parser.add_argument('--index_dir', default=None,
+        help='Gallery index dir: new gallery images are added to the index, which is used to search')
+    parser.add_argument('--search_type', default='qc', choices=['qc', 'oc'],
+        help='With an index: oc=rank indexed detections only, qc=re-score the top_m images of each query with QC search')
+    parser.add_argument('--top_m', type=int, default=100,
+        help='With an index: number of images (qc) or detections (oc) to return for each query')
+    parser.add_argument('--segment_size', type=int, default=1024,
+        help='With an index: number of images per index segment')
+    args = parser.parse_args()
+    assert (args.query_dir is not None) or (args.query_json is not None), 'No queries given'
+
+    # Load config
+    start_time = time.time()
+    default_config, tuple_key_list = engine_utils.load_config(args.default_config)
+    trial_config, _ = engine_utils.load_config(args.trial_config, tuple_key_list=tuple_key_list)
+    config = {**default_config, **trial_config}
+
+    # Fall back to the CPU if no GPU is available
+    device = args.device
+    if device.startswith('cuda') and (not torch.cuda.is_available()):
+        print('WARNING: CUDA is not available, running on the CPU')
+        device = 'cpu'
+
+    # Load model and compute query embeddings
+    model = load_model(config, args.ckpt_path, device)
+    searcher = PersonSearcher(model, engine_utils.get_test_transform(config), device,
+        precision=args.precision, search_mode=config['search_mode'],
+        batch_size=args.batch_size, num_workers=args.num_workers, prefetch_factor=args.prefetch_factor,
+        det_thresh=args.det_thresh, top_k=args.top_k)
+    load_time = time.time()
+    searcher.set_queries(get_query_list(query_dir=args.query_dir, query_json=args.query_json))
+    query_time = time.time()
+    print('==> Startup: {:.2f}s (model load: {:.2f}s, {} query embeddings: {:.2f}s)'.format(
+        query_time - start_time, load_time - start_time, len(searcher.query_list), query_time - load_time))
+
+    # Search gallery, streaming results to JSONL
+    image_path_list = get_image_path_list(args.gallery_dir)
+    num_result = 0
+    ## Time and number of images processed by each stage, for throughput
+    stage_dict = {}
+    if args.index_dir is None:
+        print('==> Searching {} gallery images on: {}'.format(len(image_path_list), device))
+        with open(args.output, 'w') as fp:
+            for image_result in searcher.search(image_path_list):
+                image = os.path.relpath(image_result['image'], args.gallery_dir)
+                for result in image_result['results']:
+                    fp.write(json.dumps({'image': image, **result}) + '\n')
+                    num_result += 1
+        stage_dict['search'] = (time.time() - query_time, len(image_path_list))
+    else:
+        ## Add new gallery images to the index
+        index = GalleryIndex(args.index_dir, segment_size=args.segment_size)
+        new_path_list = [p for p in image_path_list if os.path.relpath(p, args.gallery_dir) not in index]
+        print('==> Indexing {} new gallery images on: {}'.format(len(new_path_list), device))
+        for det in searcher.detect(new_path_list):
+            index.add(os.path.relpath(det['image'], args.gallery_dir),
+                det['det_boxes'], det['det_scores'], det['det_emb'], scene_emb=det['scene_emb'])
+        index.flush()
+        index_time = time.time()
+        stage_dict['detect'] = (index_time - query_time, len(new_path_list))
+        print('==> Searching {} indexed gallery images'.format(len(index)))
+        with open(args.output, 'w') as fp:
+            ## OC: rank indexed detections
+            if args.search_type == 'oc':
+                for query, query_result_list in zip(searcher.query_list,
+                        index.search(searcher.query_emb, top_k=args.top_m, det_thresh=args.det_thresh)):
+                    for result in query_result_list:
+                        fp.write(json.dumps({'image': result['image_key'], 'query_id': query['query_id'],
+                            'box': [round(x, 2) for x in result['box']],
+                            'score': result['score'], 'det_score': result['det_score']}) + '\n')
+                        num_result += 1
+                num_search_image = len(index)
+            ## QC: re-score only the shortlisted images of each query
+            elif args.search_type == 'qc':
+                image_query_dict = {}
+                for query_idx, image_key_list in enumerate(index.shortlist(searcher.query_emb,
+                        top_m=args.top_m, det_thresh=args.det_thresh)):
+                    for image_key in image_key_list:
+                        image_query_dict.setdefault(image_key, []).append(query_idx)
+                image_key_list = sorted(image_query_dict)
+                for image_result in searcher.search([os.path.join(args.gallery_dir, k) for k in image_key_list],
+                        image_id_list=image_key_list, image_query_list=[image_query_dict[k] for k in image_key_list]):
+                    image = os.path.relpath(image_result['image'], args.gallery_dir)
+                    for result in image_result['results']:
+                        fp.write(json.dumps({'image': image, **result}) + '\n')
+                        num_result += 1
+                num_search_image = len(image_key_list)
+        stage_dict['search'] = (time.time() - index_time, num_search_image)
+    print('==> Wrote {} results to: {}'.format(num_result, args.output))
+
+    # Report throughput and latency of each stage, over the images it processed
+    ## OC search over an index ranks indexed detections, without running the model
+    for stage, (stage_time, num_image) in stage_dict.items():
+        stage_name = {'detect': 'Indexing', 'search': 'Search'}[stage]
+        print('==> {}: {:.2f}s, {} images, {:.2f} images/s'.format(stage_name,
+            stage_time, num_image, num_image / max(stage_time, 1e-9)))
+        latency_dict = searcher.get_latency_stats(stage=stage)
+        if len(latency_dict) > 0:
+            print('==> {} per-image model latency: mean={mean_ms:.1f}ms, p50={p50_ms:.1f}ms, p95={p95_ms:.1f}ms'.format(
+                stage_name, **latency_dict))
+
+
+# Run as module
+if __name__ == '__main__':
+    main()
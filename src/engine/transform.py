@@ -462,6 +462,16 @@ def get_transform_wrs(train, stat_dict, min_size=900, max_size=1500):
     albu_transform_dict = {'test': albu_transform}
     return AlbuWrapper(albu_transform, stat_dict)
 
+# No resize, for tiled inference on frames at native resolution
+def get_transform_native(stat_dict):
+    albu_transform = albu.Compose([],
+        bbox_params=albu.BboxParams(
+            format='coco', label_fields=['category_ids', 'person_id', 'id', 'iou_thresh', 'is_known'],
+            min_visibility=0.4,
+        )
+    )
+    return AlbuWrapper(albu_transform, stat_dict)
+
 # Resize augmentation
 def get_transform_rs(train, stat_dict, height=512, width=512):
     transform_list = [albu.Resize(height, width)]
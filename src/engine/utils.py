@@ -33,6 +33,18 @@ def to_device(images, targets, device):
     return images, targets
 
 
+# Function to get the device of a config
+def get_device(config):
+    device = torch.device(config['device'])
+    # Fall back to the CPU on hosts without a GPU
+    if (device.type == 'cuda') and (not torch.cuda.is_available()):
+        print('WARNING: CUDA is not available, using the CPU')
+        device = torch.device('cpu')
+    elif (device.type == 'cuda') and (device.index is None):
+        device = torch.device('cuda', 0)
+    return device
+
+
 # Helper to delete keys from torch module state dict
 def _del_key(state_dict, key):
     if key in state_dict:
@@ -82,7 +94,7 @@ def _seed_worker(worker_id):
     random.seed(worker_seed)
 
 
-def get_test_loader(config):
+def get_test_transform(config):
     # Use ImageNet stats to standardize the data
     stat_dict = {
         'mean': config['image_mean'],
@@ -90,8 +102,11 @@ def get_test_loader(config):
     }
 
     # Set transform
+    ## Tiled inference runs on frames at native resolution
+    if config['test_tile_size'] is not None:
+        test_transform = transform.get_transform_native(stat_dict=stat_dict)
     ## IFN transform
-    if config['aug_mode'] == 'wrs':
+    elif config['aug_mode'] == 'wrs':
         test_transform = transform.get_transform_wrs(train=False, stat_dict=stat_dict)
     elif config['aug_mode'] == 'wrsrrc':
         test_transform = transform.get_transform_wrsrrc(train=False, stat_dict=stat_dict)
@@ -126,6 +141,14 @@ def get_test_loader(config):
     elif config['aug_mode'] == 'rrcin1k':
         test_transform = transform.get_transform_rrcin1k(train=False, stat_dict=stat_dict)
 
+    # Return transform
+    return test_transform
+
+
+def get_test_loader(config):
+    # Set transform
+    test_transform = get_test_transform(config)
+
     assert len(config['test_dataset']) == 1, 'Only one test dataset permitted.'
 
     test_dataset_name = list(config['test_dataset'].keys())[0]
@@ -151,13 +174,14 @@ def get_test_loader(config):
     retrieval_dir = os.path.join(test_dataset_dict['dir'], 'retrieval')
     test_sampler = det_utils.TestSampler(test_dataset_dict['subset'],
         test_dataset, retrieval_dir,
-        config['retrieval_name_list'])
+        config['retrieval_name_list'], video_order=config['video_feature_reuse'])
 
     # Get loader
     test_loader = torch.utils.data.DataLoader(
         test_dataset, batch_size=config['val_batch_size'],
         sampler=test_sampler, num_workers=config['workers'], persistent_workers=True,
-        collate_fn=collate_fn)
+        collate_fn=collate_fn,
+        pin_memory=config['test_prefetch'] and (get_device(config).type == 'cuda'))
 
     # Return loader
     return test_loader
@@ -246,7 +246,7 @@ class SoliderSwinBackbone(nn.Sequential):
         if self.swin.semantic_weight >= 0:
             w = torch.ones(x.shape[0],1) * self.swin.semantic_weight
             w = torch.cat([w, 1-w], axis=-1)
-            semantic_weight = w.cuda()
+            semantic_weight = w.to(x.device)
 
         x, hw_shape = self.swin.patch_embed(x)
 
@@ -281,7 +281,7 @@ class SoliderSwinHead(nn.Sequential):
         if self.swin.semantic_weight >= 0:
             w = torch.ones(x.shape[0],1) * self.swin.semantic_weight
             w = torch.cat([w, 1-w], axis=-1)
-            semantic_weight = w.cuda()
+            semantic_weight = w.to(x.device)
 
         feat = x
         hw_shape = x.shape[-2:]
@@ -0,0 +1,282 @@
+# Global imports
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import torch
+from torch import nn, Tensor
+import torch.nn.functional as F
+from torchvision.ops import boxes as box_ops
+from torchvision.models.detection import _utils as det_utils
+from torchvision.models.detection.image_list import ImageList
+
+
+# Inference modes which have an export wrapper
+EXPORT_MODES = ('det', 'search_topk')
+# Names of the output tensors of each export wrapper, in order
+EXPORT_OUTPUT_NAMES = {
+    'det': ('boxes', 'scores', 'labels', 'embeddings', 'scene_emb'),
+    'search_topk': ('boxes', 'scores', 'labels', 'query_index', 'embeddings'),
+}
+
+
+# Base class for tensor-only SPNet inference graphs
+class SPNetExportBase(nn.Module):
+    """
+    Wraps the inference path of an eval-mode SPNet for one image, with
+    tensor-only inputs and outputs: the inference mode is fixed at construction.
+    The wrapper shares its submodules with the SPNet, and can be traced with
+    torch.jit.trace or exported to ONNX.
+
+    Images are expected to be transformed as for the SPNet (normalized). With a
+    fixed image_size (multiples of 32), the anchors are computed once and stored
+    as a buffer. With image_size=None, images of any size are padded to a
+    multiple of 32 and the anchors are computed in the graph, as in SPNet.forward.
+    """
+    def __init__(self, model, image_size=None):
+        super().__init__()
+        if model.training:
+            raise ValueError('Export requires a model in eval mode')
+        if (model.head.cascade_exit_box_tol is not None) or (model.head.cascade_exit_score_thresh is not None):
+            raise ValueError('Export does not support cascade early exit (cascade_exit_box_tol, cascade_exit_score_thresh)')
+        if model.use_moco or model.use_classifier_test:
+            raise ValueError('Export does not support use_moco or use_classifier_test')
+        self.backbone = model.backbone
+        self.anchor_generator = model.anchor_generator
+        self.head = model.head
+        self.box_coder = model.box_coder
+        self.use_classifier_train = model.use_classifier_train
+        self.score_thresh = model.score_thresh
+        self.nms_thresh = model.nms_thresh
+        self.detections_per_img = model.detections_per_img
+        self.topk_candidates = model.topk_candidates
+        self.num_cascade_steps = model.num_cascade_steps
+        self.emb_align_sep = self.head.emb_align_sep
+        self.cascade_mode = self.head.train_mode
+
+        # Compute the anchors once for a fixed image size
+        if image_size is None:
+            self.image_size = None
+            self.register_buffer('anchors', None, persistent=False)
+        else:
+            height, width = image_size
+            if (height % 32) or (width % 32):
+                raise ValueError('Export image size must be a multiple of 32, got: {}'.format(image_size))
+            self.image_size = (height, width)
+            param = next(model.parameters())
+            with torch.no_grad():
+                dummy_images = torch.zeros(1, 3, height, width, dtype=param.dtype, device=param.device)
+                anchors = self.anchor_generator(ImageList(dummy_images, [self.image_size]),
+                    self.get_features(dummy_images))
+            self.register_buffer('anchors', anchors[0], persistent=False)
+
+    def pad_images(self, images):
+        # type: (Tensor) -> Tuple[Tensor, Tuple[int, int]]
+        """
+        Pads images to a multiple of 32 as GeneralizedRCNNTransform, and returns
+        them with the image size before padding.
+        """
+        if self.image_size is not None:
+            return images, self.image_size
+        height, width = images.shape[-2:]
+        images = F.pad(images, (0, (32 - width % 32) % 32, 0, (32 - height % 32) % 32))
+        return images, (height, width)
+
+    def get_anchors(self, images, features, image_size):
+        # type: (Tensor, List[Tensor], Tuple[int, int]) -> Tensor
+        if self.anchors is not None:
+            return self.anchors
+        return self.anchor_generator(ImageList(images, [image_size]), features)[0]
+
+    def get_features(self, images):
+        # type: (Tensor) -> List[Tensor]
+        if self.use_classifier_train:
+            features, _ = self.backbone(images)
+        else:
+            features = self.backbone(images)
+        if isinstance(features, torch.Tensor):
+            features = OrderedDict([("0", features)])
+        return [v for k, v in features.items() if k != 'pool']
+
+    def get_embeddings(self, features, boxes, image_size, emb_type='reid', cascade_idx=0):
+        # type: (List[Tensor], Tensor, Tuple[int, int], str, int) -> Tensor
+        """
+        Embeddings of the boxes of one image, as in SPNetHead.get_gt_embeddings,
+        without splitting by image: this keeps the number of boxes dynamic when traced.
+        """
+        # Add a dummy box, so that the embedding heads never see an empty batch (unsupported by ONNX)
+        boxes = torch.cat([boxes, boxes.new_tensor([[0.0, 0.0, 1.0, 1.0]])])
+        if (emb_type == 'reid') or (not self.emb_align_sep):
+            features = OrderedDict(zip(self.head.featmap_names, features))
+            box_feat = self.head.roi_align(features, [boxes], [image_size])
+            return self.head.align_emb_head(box_feat).flatten(1)[:-1]
+        else:
+            features = OrderedDict(zip(self.head.loc_featmap_names, features))
+            box_feat = self.head.loc_roi_align(features, [boxes], [image_size])
+            return self.head.align_emb_loc_head[str(cascade_idx+1)](box_feat).flatten(1)[:-1]
+
+    def cascade(self, features, boxes, emb, group_idx, image_size, query_loc_emb=None):
+        # type: (List[Tensor], Tensor, Tensor, Tensor, Tuple[int, int], Optional[Tensor]) -> Tuple[Tensor, Tensor, Tensor, Tensor, Tensor]
+        """
+        Cascaded box refinement as in SPNetHead.test_cascade_groups without early
+        exit, for all groups at once: group_idx is the group (query) of each box.
+        Boxes stay sorted by group, then by descending score within each group.
+        Without query_loc_emb, all boxes are in a single group.
+        """
+        # Add a dummy box in its own group, so that reductions never see an empty batch (unsupported by ONNX)
+        boxes = torch.cat([boxes, boxes.new_tensor([[0.0, 0.0, 1.0, 1.0]])])
+        emb = torch.cat([emb, emb.new_zeros((1, emb.shape[1]))])
+        group_idx = torch.cat([group_idx, group_idx.new_full((1,), -1)])
+        for cascade_idx in range(self.num_cascade_steps):
+            # Offset embeddings, and new boxes
+            if self.cascade_mode == 'qc':
+                offset_emb = self.head.combiner.forward(query_loc_emb[group_idx], emb)
+            else:
+                offset_emb = self.head.bridge_layer[str(cascade_idx+1)](emb)
+            bbox_regression = self.head.regression_head[str(cascade_idx+1)](offset_emb)
+            cls_logits = self.head.classification_head[str(cascade_idx+1)](offset_emb)
+            new_boxes = self.head.box_coder.decode_single(bbox_regression, boxes)
+            new_boxes = box_ops.clip_boxes_to_image(new_boxes, image_size)
+            # NMS within each group
+            nms_idx = box_ops.batched_nms(new_boxes, cls_logits[:, 1], group_idx, 0.5)
+            if query_loc_emb is not None:
+                nms_idx = nms_idx[torch.sort(group_idx[nms_idx], stable=True).indices]
+            boxes, cls_logits, group_idx = new_boxes[nms_idx], cls_logits[nms_idx], group_idx[nms_idx]
+            # New embeddings: reid embeddings after the final step
+            if cascade_idx == (self.num_cascade_steps - 1):
+                emb = self.get_embeddings(features, boxes, image_size)
+            else:
+                emb = self.get_embeddings(features, boxes, image_size, emb_type='loc', cascade_idx=cascade_idx+1)
+        scores, labels = cls_logits.max(dim=1)
+        # Remove the dummy box
+        keep = group_idx >= 0
+        return boxes[keep], torch.sigmoid(scores[keep]), labels[keep], emb[keep], group_idx[keep]
+
+
+# Object-centric detection graph: SPNet.forward(..., inference_mode='det')
+class SPNetDetExport(SPNetExportBase):
+    """
+    Inputs: images [1, 3, H, W].
+    Outputs: boxes [K, 4], scores [K], labels [K], embeddings [K, D], and
+    scene_emb [1, S] (S=0 without a GFN), for the K detections after NMS.
+    """
+    def __init__(self, model, image_size=None):
+        super().__init__(model, image_size)
+        self.use_gfn = self.head.use_gfn
+
+    def forward(self, images):
+        # type: (Tensor) -> Tuple[Tensor, Tensor, Tensor, Tensor, Tensor]
+        images, image_size = self.pad_images(images)
+        features = self.get_features(images)
+
+        # Head outputs for the top anchors by offset norm
+        head_outputs = self.head(features, a=[self.get_anchors(images, features, image_size)])
+        logits = head_outputs['cls_logits'][0]
+        box_regression = head_outputs['bbox_regression']
+        anchors = head_outputs['topk_anchors']
+        num_classes = logits.shape[-1]
+
+        # Remove low scoring boxes, and keep only topk scoring predictions
+        scores = torch.sigmoid(logits).flatten()
+        topk_idxs = torch.where(scores > self.score_thresh)[0]
+        scores = scores[topk_idxs]
+        num_topk = det_utils._topk_min(topk_idxs, self.topk_candidates, 0)
+        scores, idxs = scores.topk(num_topk)
+        topk_idxs = topk_idxs[idxs]
+        anchor_idxs = torch.div(topk_idxs, num_classes, rounding_mode="floor")
+        labels = topk_idxs % num_classes
+
+        # Decode boxes, and apply non-maximum suppression
+        boxes = self.box_coder.decode_single(box_regression[anchor_idxs], anchors[anchor_idxs])
+        boxes = box_ops.clip_boxes_to_image(boxes, image_size)
+        keep = box_ops.batched_nms(boxes, scores, labels, self.nms_thresh)
+        keep = keep[:self.detections_per_img]
+        boxes, scores, labels = boxes[keep], scores[keep], labels[keep]
+
+        # Embeddings of the detections, with optional cascaded box refinement
+        if self.num_cascade_steps > 0:
+            embeddings = self.get_embeddings(features, boxes, image_size, emb_type='loc')
+            boxes, scores, labels, embeddings, _ = self.cascade(features, boxes, embeddings,
+                torch.zeros_like(labels), image_size)
+        else:
+            embeddings = self.get_embeddings(features, boxes, image_size)
+
+        # Embeddings of the scene
+        if self.use_gfn:
+            scene_emb = self.head.gfn.get_scene_emb(OrderedDict(zip(self.head.featmap_names, features)))
+        else:
+            scene_emb = images.new_zeros(1, 0)
+        return boxes, scores, labels, embeddings, scene_emb
+
+
+# Query-centric search graph: SPNet.forward(..., inference_mode='search_topk')
+class SPNetSearchExport(SPNetExportBase):
+    """
+    Inputs: images [1, 3, H, W], and query_loc_emb [Q, D] (the gt_loc_emb of the queries).
+    Outputs: boxes [K, 4], scores [K], labels [K], query_index [K], and
+    embeddings [K, D] for the K detections of all queries after NMS, sorted by query.
+    """
+    def __init__(self, model, image_size=None, k=100):
+        super().__init__(model, image_size)
+        self.k = k
+        self.use_posnorm = self.head.use_posnorm
+
+    def forward(self, images, query_loc_emb):
+        # type: (Tensor, Tensor) -> Tuple[Tensor, Tensor, Tensor, Tensor, Tensor]
+        images, image_size = self.pad_images(images)
+        features = self.get_features(images)
+
+        # Top anchors of each query by offset norm, and query-conditioned head outputs
+        anchor_emb, _ = self.head.feature_head(features)
+        anchor_emb = anchor_emb[0]
+        _, anchor_idx = self.head.combiner.norm(query_loc_emb, anchor_emb).topk(
+            k=self.k, dim=1, largest=self.use_posnorm)
+        offset_emb = self.head.combiner.forward(query_loc_emb.unsqueeze(1), anchor_emb[anchor_idx])
+        logits = self.head.classification_head["0"](offset_emb)
+        box_regression = self.head.regression_head["0"](offset_emb)
+        anchors = self.get_anchors(images, features, image_size)[anchor_idx]
+        num_query, num_classes = logits.shape[0], logits.shape[-1]
+
+        # Keep only topk scoring predictions
+        if self.topk_candidates < self.k:
+            scores = torch.sigmoid(logits).reshape(num_query, -1)
+            scores = scores * (scores > self.score_thresh)
+            scores, topk_idxs = scores.topk(self.topk_candidates, dim=1)
+            anchor_idxs = torch.div(topk_idxs, num_classes, rounding_mode="floor").unsqueeze(2).repeat(1, 1, 4)
+            labels = topk_idxs % num_classes
+            box_regression = box_regression.gather(1, anchor_idxs)
+            anchors = anchors.gather(1, anchor_idxs)
+        else:
+            scores, labels = torch.sigmoid(logits).max(dim=2)
+
+        # Remove low scoring boxes
+        query_index = torch.arange(num_query, device=scores.device).unsqueeze(1).expand_as(scores).flatten()
+        scores, labels = scores.flatten(), labels.flatten()
+        score_idxs = torch.where(scores > self.score_thresh)[0]
+        scores, labels, query_index = scores[score_idxs], labels[score_idxs], query_index[score_idxs]
+
+        # Decode boxes, and apply non-maximum suppression separately for each query
+        boxes = self.box_coder.decode_single(box_regression.reshape(-1, 4)[score_idxs],
+            anchors.reshape(-1, 4)[score_idxs])
+        boxes = box_ops.clip_boxes_to_image(boxes, image_size)
+        keep = box_ops.batched_nms(boxes, scores, labels + query_index * num_classes, self.nms_thresh)
+        keep = keep.sort().values
+        boxes, scores, labels, query_index = boxes[keep], scores[keep], labels[keep], query_index[keep]
+
+        # Embeddings of the detections, with optional cascaded box refinement
+        if self.num_cascade_steps > 0:
+            embeddings = self.get_embeddings(features, boxes, image_size, emb_type='loc')
+            boxes, scores, labels, embeddings, query_index = self.cascade(features, boxes, embeddings,
+                query_index, image_size, query_loc_emb=query_loc_emb)
+        else:
+            embeddings = self.get_embeddings(features, boxes, image_size)
+        return boxes, scores, labels, query_index, embeddings
+
+
+# Function to build the export wrapper of an inference mode
+def get_export_model(model, inference_mode, image_size=None):
+    if inference_mode == 'det':
+        return SPNetDetExport(model, image_size)
+    elif inference_mode == 'search_topk':
+        return SPNetSearchExport(model, image_size)
+    else:
+        raise ValueError('Export supports inference modes: {}, got: {}'.format(EXPORT_MODES, inference_mode))
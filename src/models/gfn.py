@@ -299,6 +299,62 @@ class GalleryFilterNetwork(nn.Module):
             raise Exception
         return gfn_scores
 
+    @torch.jit.ignore
+    def get_scores_tiled(self, source_box_feats: Tensor, source_img_feats: Tensor, target_img_feats: Tensor,
+            out=None, tile_bytes=256*1024**2) -> Tensor:
+        """
+        Same as get_scores, but computed over (query block x image block)
+        tiles, so that no intermediate is larger than about tile_bytes.
+
+        Scores are written to out, a preallocated [Q, I] CPU tensor, which may
+        be a view (e.g., the transpose of an [I, Q] memory-mapped tensor).
+        """
+        Q, I = source_box_feats.size(0), target_img_feats.size(0)
+        if out is None:
+            out = torch.empty((Q, I), dtype=torch.float32)
+        assert tuple(out.shape) == (Q, I)
+        if (Q == 0) or (I == 0):
+            return out
+
+        # Size tiles: the combined mode holds a few fp32 [i, q, D] tensors per tile
+        if self.gfn_mode == 'combined':
+            pair_bytes = 3 * 4 * target_img_feats.size(1)
+        else:
+            pair_bytes = 4
+        tile_elems = max(1, tile_bytes // pair_bytes)
+        query_block = min(Q, max(1, int(tile_elems ** 0.5)))
+        image_block = min(I, max(1, tile_elems // query_block))
+
+        # Normalize features once
+        if self.gfn_mode == 'separate':
+            source_feats = F.normalize(source_box_feats, p=2.0, dim=-1)
+            target_feats = F.normalize(target_img_feats, p=2.0, dim=-1)
+        elif self.gfn_mode == 'image':
+            source_feats = F.normalize(source_img_feats.float(), p=2.0, dim=-1)
+            target_feats = F.normalize(target_img_feats.float(), p=2.0, dim=-1)
+        elif self.gfn_mode != 'combined':
+            raise Exception
+
+        # Fill the score matrix one tile at a time
+        for q0 in range(0, Q, query_block):
+            q1 = min(Q, q0 + query_block)
+            if self.gfn_mode == 'combined':
+                query_features = source_box_feats[q0:q1]
+                fused_query_features = F.normalize(
+                    self.fuser(query_features, source_img_feats[q0:q1]).float(), p=2.0, dim=-1)
+            for i0 in range(0, I, image_block):
+                i1 = min(I, i0 + image_block)
+                if self.gfn_mode == 'combined':
+                    _alt_fused_features = self.fuser(query_features, target_img_feats[i0:i1], p=True)
+                    _gfn_scores = torch.sigmoid(torch.einsum('qd,iqd->qi',
+                        fused_query_features,
+                        F.normalize(_alt_fused_features.float(), p=2.0, dim=-1),
+                    ))
+                else:
+                    _gfn_scores = torch.sigmoid(torch.mm(source_feats[q0:q1], target_feats[i0:i1].T))
+                out[q0:q1, i0:i1] = _gfn_scores.cpu()
+        return out
+
     @torch.jit.ignore
     def forward(self, features, targets, image_shapes):
         # Get device
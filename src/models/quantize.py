@@ -0,0 +1,122 @@
+# Global imports
+import torch
+from torch import nn
+import torch.nn.functional as F
+from torch.ao.quantization import QConfigMapping, get_default_qconfig, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+# Package imports
+from osr.models.backbone_utils import ResnetSPBackbone, ConvnextSPBackbone
+
+
+# Quantized engines for CPU inference: x86 and fbgemm for x86 CPUs, qnnpack for ARM CPUs
+QUANT_BACKENDS = ('x86', 'fbgemm', 'qnnpack')
+
+
+# Backbone body and FPN as a single module, so that FX traces the feature dict between them
+class BackboneFeatures(nn.Module):
+    def __init__(self, backbone):
+        super().__init__()
+        self.body = backbone.body
+        self.fpn = backbone.fpn
+
+    def forward(self, x):
+        y = self.body(x)
+        z = self.fpn(y)
+        return z
+
+
+# Backbone with quantized features, as a drop-in replacement of the SP backbones
+class QuantizedSPBackbone(nn.Module):
+    def __init__(self, features, out_channels):
+        super().__init__()
+        self.features = features
+        self.out_channels = out_channels
+        self.use_classifier = False
+
+    def forward(self, x, shortcut=False):
+        return self.features(x)
+
+
+# Function to get the static quantization config for convs
+def get_static_qconfig_mapping(backend='x86'):
+    """
+    Convs (with their batchnorm and activation), pooling and residual adds
+    are quantized statically. Linear layers are left to dynamic quantization,
+    and layer norms are kept in fp32.
+    """
+    qconfig_mapping = QConfigMapping().set_global(get_default_qconfig(backend))
+    for object_type in (nn.Linear, F.linear, nn.LayerNorm, F.layer_norm):
+        qconfig_mapping.set_object_type(object_type, None)
+    return qconfig_mapping
+
+
+# Post-training INT8 quantization of an SPNet for CPU inference
+class SPNetQuantizer:
+    """
+    Post-training INT8 quantization of an eval-mode SPNet on the CPU:
+    - prepare: insert observers after the convs of the backbone and FPN, the
+      feature head, and the conv heads of the reid and loc embeddings
+    - calibrate: run the SPNet on calibration images to record activation ranges
+    - convert: replace observed convs with quantized convs, then dynamically
+      quantize all linear layers of the backbone and head
+
+    Usage:
+        quantizer = SPNetQuantizer(model, backend='x86')
+        for images in calib_loader:
+            quantizer.calibrate(images)
+        quantizer.convert()
+    """
+    def __init__(self, model, backend='x86'):
+        if model.training:
+            raise ValueError('Quantization requires a model in eval mode')
+        if not isinstance(model.backbone, (ResnetSPBackbone, ConvnextSPBackbone)):
+            raise ValueError('Quantization supports ResNet and ConvNeXt backbones only, not: {}'.format(
+                type(model.backbone).__name__))
+        if model.use_moco or model.use_classifier_test:
+            raise ValueError('Quantization does not support use_moco or use_classifier_test')
+        if model.head.emb_align_mode != 'conv5':
+            raise ValueError('Quantization supports emb_align_mode=conv5 only')
+        self.model = model
+        self.backend = backend
+        torch.backends.quantized.engine = backend
+        qconfig_mapping = get_static_qconfig_mapping(backend)
+
+        # Prepare the backbone
+        example_image = torch.randn(1, 3, 64, 64)
+        model.backbone = QuantizedSPBackbone(
+            prepare_fx(BackboneFeatures(model.backbone), qconfig_mapping, (example_image,)),
+            model.backbone.out_channels)
+
+        # Prepare the feature head
+        feature_head = model.head.feature_head
+        example_features = torch.randn(1, feature_head.emb_pred.in_channels, 8, 8)
+        feature_head.emb_pred = prepare_fx(feature_head.emb_pred, qconfig_mapping, (example_features,))
+
+        # Prepare the conv heads of the reid and loc embeddings
+        for emb_head in self.get_emb_heads():
+            example_features = torch.randn(1, emb_head.out_channels[0], 8, 8)
+            emb_head.head = prepare_fx(emb_head.head, qconfig_mapping, (example_features,))
+
+    def get_emb_heads(self):
+        emb_head_list = [self.model.head.align_emb_head.emb_head]
+        if self.model.head.emb_align_sep:
+            emb_head_list.extend([h.emb_head for h in self.model.head.align_emb_loc_head.values()])
+        return emb_head_list
+
+    @torch.no_grad()
+    def calibrate(self, images):
+        self.model(images, inference_mode='det')
+
+    def convert(self):
+        model = self.model
+        model.backbone.features = convert_fx(model.backbone.features)
+        model.head.feature_head.emb_pred = convert_fx(model.head.feature_head.emb_pred)
+        for emb_head in self.get_emb_heads():
+            emb_head.head = convert_fx(emb_head.head)
+
+        # Dynamic quantization of linear layers: the reid loss is only used for training
+        linear_name_set = {n for n, m in model.named_modules()
+            if isinstance(m, nn.Linear) and n.startswith(('backbone.', 'head.')) and not n.startswith('head.reid_loss.')}
+        quantize_dynamic(model, qconfig_spec=linear_name_set, dtype=torch.qint8, inplace=True)
+        return model
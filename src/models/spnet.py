@@ -298,6 +298,49 @@ def _recover_feats2(emb, shape_list, num_anchors):
     _features = torch.cat(_features, dim=1)
     return _features, features
 
+def _get_image_features(features, image_index):
+    # features in L * [N, C, H, W] -> L * [1, C, H, W]
+    # Used when RoIAlign boxes are given for a single image of the batch
+    return [f[image_index:image_index+1] for f in features]
+
+# Rough number of live [emb_dim] tensors per (query, anchor) pair during search: combiner output and head activations
+SEARCH_EMB_MEM_FACTOR = 4
+# Number of live tensors per (query, anchor) pair when computing norm logits: x + y - 2xy
+SEARCH_NORM_MEM_FACTOR = 3
+
+def _plan_chunk_size(num_item, bytes_per_item, mem_bytes, max_chunk_size=None):
+    # Largest chunk of items which fits in mem_bytes, at least 1
+    chunk_size = max(1, int(mem_bytes // max(bytes_per_item, 1)))
+    if max_chunk_size is not None:
+        chunk_size = min(chunk_size, max_chunk_size)
+    return min(chunk_size, max(num_item, 1))
+
+def _is_oom_error(e):
+    return isinstance(e, RuntimeError) and ('out of memory' in str(e))
+
+# Inference modes which can be run on tiles of a high-resolution frame
+TILE_INFERENCE_MODES = ('gt', 'det', 'both', 'search_topk', 'search_all')
+# Per-detection outputs, filtered by the cross-tile NMS
+TILE_DET_KEYS = ('det_boxes', 'det_scores', 'det_cws', 'det_labels', 'det_emb', 'det_anchor_boxes', 'det_anchor_scores')
+# Box outputs, shifted from tile to frame coordinates
+TILE_BOX_KEYS = ('det_boxes', 'det_anchors', 'det_anchor_boxes')
+# Detections within this many pixels of a tile edge inside the frame are considered cut by the tile
+TILE_EDGE_MARGIN = 2
+
+def _get_tile_starts(size, tile_size, tile_overlap):
+    # Evenly strided tile starts, with the last tile aligned to the frame edge
+    if size <= tile_size:
+        return [0]
+    stride = tile_size - tile_overlap
+    num_tile = math.ceil((size - tile_size) / stride) + 1
+    return [min(i * stride, size - tile_size) for i in range(num_tile)]
+
+def get_tile_windows(height, width, tile_size, tile_overlap):
+    # (x1, y1, x2, y2) windows of overlapping tiles covering a frame
+    return [(x, y, min(x + tile_size, width), min(y + tile_size, height))
+        for y in _get_tile_starts(height, tile_size, tile_overlap)
+        for x in _get_tile_starts(width, tile_size, tile_overlap)]
+
 class AlignEmbHead(nn.Module):
     def __init__(self, emb_head, nae_head):
         super().__init__()
@@ -336,7 +379,8 @@ class DifferenceCombiner(nn.Module):
             x = torch.einsum('ik,ik->i', q, q).unsqueeze(1)
             y = torch.einsum('jk,jk->j', a, a).unsqueeze(0)
             xy = torch.einsum('ik,jk->ij', q, a)
-            norm = torch.sqrt(x + y - 2*xy)
+            # rounding can make the squared distance of near-identical embeddings negative
+            norm = torch.sqrt((x + y - 2*xy).clamp(min=0))
         return norm
 
     def forward(self, q, a):
@@ -408,7 +452,8 @@ class ProductCombiner(nn.Module):
             x = torch.einsum('ik,ik->i', q, q).unsqueeze(1)
             y = torch.einsum('jk,jk->j', a, a).unsqueeze(0)
             xy = torch.einsum('ik,jk->ij', q, a)
-            norm = torch.sqrt(x + y - 2*xy)
+            # rounding can make the squared distance of near-identical embeddings negative
+            norm = torch.sqrt((x + y - 2*xy).clamp(min=0))
         return norm
 
     def forward(self, q, a):
@@ -463,6 +508,10 @@ class SPNetHead(nn.Module):
         self.moco_copy_teacher = config['moco_copy_teacher']
         self.num_anchors = num_anchors
         self.num_cascade_steps = config['num_cascade_steps']
+        self.cascade_exit_box_tol = config['cascade_exit_box_tol']
+        self.cascade_exit_score_thresh = config['cascade_exit_score_thresh']
+        ## Number of query groups entering each cascade step during inference
+        self.cascade_stage_count = [0] * self.num_cascade_steps
         self.emb_loc_dim = config['emb_dim']
         self.emb_reid_dim = config['emb_reid_dim']
         self.reid_loss_weight = config['reid_loss_weight']
@@ -648,6 +697,14 @@ class SPNetHead(nn.Module):
         elif config['combiner'] == 'prod':
             self.combiner = ProductCombiner()
 
+        ### Memory budget for query chunks during search: None=all queries for topk, 16 for all
+        if config['search_chunk_mem_mb'] is None:
+            self.search_chunk_bytes = None
+        else:
+            self.search_chunk_bytes = int(config['search_chunk_mem_mb'] * 1024**2)
+        ## Max query chunk size after backing off on OOM, for each search mode
+        self.search_chunk_cap = {}
+
         # Gallery-Filter Network
         if self.use_gfn:
             ## Build Gallery Filter Network
@@ -1083,16 +1140,57 @@ class SPNetHead(nn.Module):
 
         return cascade_dict
 
+    def get_cascade_stats(self, reset=True):
+        """
+        Fraction of query groups surviving into each cascade step since the
+        last reset.
+        """
+        num_group = self.cascade_stage_count[0] if self.num_cascade_steps > 0 else 0
+        stat_dict = {'cascade_step{}_survival'.format(i+1): c / max(num_group, 1)
+            for i, c in enumerate(self.cascade_stage_count)}
+        if reset:
+            self.cascade_stage_count = [0] * self.num_cascade_steps
+        return stat_dict
+
     def test_cascade(self, features, pred_emb, query_emb, pred_box, 
             image_shape):
+        query_emb_list = None if query_emb is None else [query_emb]
+        pred_box_list, pred_emb_list, cls_logits_list = self.test_cascade_groups(features,
+            [pred_emb], query_emb_list, [pred_box], image_shape)
+        return pred_box_list[0], pred_emb_list[0], cls_logits_list[0]
+
+    def test_cascade_groups(self, features, pred_emb_list, query_emb_list, pred_box_list,
+            image_shape):
+        """
+        Cascaded box refinement for groups of detections in one image: one group
+        per query for QC, or one group of all detections for OC. Surviving groups
+        are batched through each stage. A group exits early once no box moves by
+        more than cascade_exit_box_tol pixels, or once its max score drops below
+        cascade_exit_score_thresh; its reid embeddings are then extracted from the
+        current boxes.
+        """
         features_dict = dict(zip(self.featmap_names, features))
         if self.emb_align_sep:
             loc_features_dict = dict(zip(self.loc_featmap_names, features))
         else:
             loc_features_dict = features_dict
+        pred_box_list, pred_emb_list = list(pred_box_list), list(pred_emb_list)
+        num_group = len(pred_box_list)
+        out_box_list, out_emb_list, out_logits_list = [None]*num_group, [None]*num_group, [None]*num_group
+        active_list = list(range(num_group))
+        self.cascade_stage_count[0] += num_group
         for cascade_idx in range(self.num_cascade_steps):
+            # 0) batch boxes of all surviving groups
+            split_lens = [pred_box_list[g].shape[0] for g in active_list]
+            pred_box = torch.cat([pred_box_list[g] for g in active_list])
+            pred_emb = torch.cat([pred_emb_list[g] for g in active_list])
+            group_idx = torch.repeat_interleave(
+                torch.arange(len(active_list), device=pred_box.device),
+                torch.tensor(split_lens, device=pred_box.device))
             # 1) get offset embeddings
             if self.train_mode == 'qc':
+                query_emb = torch.cat([query_emb_list[g].reshape(1, -1).expand(n, -1)
+                    for g, n in zip(active_list, split_lens)])
                 offset_emb = self.combiner.forward(query_emb, pred_emb)
             elif self.train_mode == 'oc':
                 offset_emb = self.bridge_layer[str(cascade_idx+1)](pred_emb)
@@ -1102,28 +1200,70 @@ class SPNetHead(nn.Module):
             bbox_regression = self.regression_head[str(cascade_idx+1)](offset_emb)
             cls_logits = self.classification_head[str(cascade_idx+1)](offset_emb)
             # 3) build new boxes
-            pred_box = self.box_coder.decode_single(
+            new_box = self.box_coder.decode_single(
                 bbox_regression, pred_box,
             )
             ## clip boxes to image
-            pred_box = box_ops.clip_boxes_to_image(pred_box, image_shape)
-            ## nms
-            nms_idx = box_ops.batched_nms(pred_box, cls_logits[:, 1],
-                torch.ones(pred_box.shape[0], dtype=torch.long).to(pred_box.device),
-                0.5)
-            pred_box = pred_box[nms_idx]
+            new_box = box_ops.clip_boxes_to_image(new_box, image_shape)
+            ## early exit: final cascade step exits all groups
+            if cascade_idx == (self.num_cascade_steps - 1):
+                exit_mask = torch.ones(len(active_list), dtype=torch.bool, device=pred_box.device)
+            else:
+                exit_mask = torch.zeros(len(active_list), dtype=torch.bool, device=pred_box.device)
+                if self.cascade_exit_box_tol is not None:
+                    box_delta = (new_box - pred_box).abs().amax(dim=1)
+                    group_delta = torch.zeros(len(active_list), device=pred_box.device).scatter_reduce(
+                        0, group_idx, box_delta, reduce='amax')
+                    exit_mask |= group_delta <= self.cascade_exit_box_tol
+                if self.cascade_exit_score_thresh is not None:
+                    score = torch.sigmoid(cls_logits.max(dim=1).values)
+                    group_score = torch.zeros(len(active_list), device=pred_box.device).scatter_reduce(
+                        0, group_idx, score, reduce='amax')
+                    exit_mask |= group_score < self.cascade_exit_score_thresh
+            ## nms within each group, keeping boxes grouped in descending score order
+            nms_idx = box_ops.batched_nms(new_box, cls_logits[:, 1], group_idx, 0.5)
+            nms_idx = nms_idx[torch.sort(group_idx[nms_idx], stable=True).indices]
+            pred_box = new_box[nms_idx]
             cls_logits = cls_logits[nms_idx]
-            # 4) predict new embeddings
-            # Final cascade step only extracts reid embedding
-            if self.emb_align_sep and (cascade_idx < (self.num_cascade_steps-1)):
-                box_feat = self.loc_roi_align(loc_features_dict, [pred_box], [image_shape])
-                box_emb = self.align_emb_loc_head[str(cascade_idx+2)](box_feat)
+            group_lens = torch.bincount(group_idx[nms_idx], minlength=len(active_list)).tolist()
+            # 4) split outputs back into groups
+            exit_list, next_active_list = [], []
+            for g, _exit, _box, _logits in zip(active_list, exit_mask.tolist(),
+                    pred_box.split(group_lens), cls_logits.split(group_lens)):
+                if _exit:
+                    out_box_list[g], out_logits_list[g] = _box, _logits
+                    exit_list.append(g)
+                else:
+                    pred_box_list[g] = _box
+                    next_active_list.append(g)
+            # 5) predict new embeddings
+            # Exiting groups only extract reid embeddings
+            if self.emb_align_sep:
+                loc_list = next_active_list
+                reid_list = exit_list
             else:
-                box_feat = self.roi_align(features_dict, [pred_box], [image_shape])
-                box_emb = self.align_emb_head(box_feat)
-            N, D, *_ = box_emb.shape
-            pred_emb = box_emb.reshape(N, D)
-        return pred_box, pred_emb, cls_logits
+                loc_list = []
+                reid_list = exit_list + next_active_list
+            if len(loc_list) > 0:
+                loc_box_list = [pred_box_list[g] for g in loc_list]
+                box_feat = self.loc_roi_align(loc_features_dict, [torch.cat(loc_box_list)], [image_shape])
+                box_emb = self.align_emb_loc_head[str(cascade_idx+2)](box_feat).flatten(1)
+                for g, _emb in zip(loc_list, box_emb.split([b.shape[0] for b in loc_box_list])):
+                    pred_emb_list[g] = _emb
+            if len(reid_list) > 0:
+                reid_box_list = [out_box_list[g] if g in exit_list else pred_box_list[g] for g in reid_list]
+                box_feat = self.roi_align(features_dict, [torch.cat(reid_box_list)], [image_shape])
+                box_emb = self.align_emb_head(box_feat).flatten(1)
+                for g, _emb in zip(reid_list, box_emb.split([b.shape[0] for b in reid_box_list])):
+                    if g in exit_list:
+                        out_emb_list[g] = _emb
+                    else:
+                        pred_emb_list[g] = _emb
+            active_list = next_active_list
+            if len(active_list) == 0:
+                break
+            self.cascade_stage_count[cascade_idx+1] += len(active_list)
+        return out_box_list, out_emb_list, out_logits_list
             
     def train_cascade(self, head_outputs, targets, use_nms=False):
         # Get stuff
@@ -1200,11 +1340,68 @@ class SPNetHead(nn.Module):
         ###
         return offset_emb_per_chunk, anchor_per_chunk, anchor_logits_per_chunk, _norm_logits_per_chunk
 
+    def norm_topk(self, query_emb_per_chunk, anchor_emb_per_image, k1):
+        """
+        Top-k norm logits of each query over all anchors. With a search memory
+        budget, anchors are scanned in blocks with a running top-k, instead of
+        materializing all Q x A norm logits.
+        """
+        num_query, num_anchor = query_emb_per_chunk.shape[0], anchor_emb_per_image.shape[0]
+        if self.search_chunk_bytes is None:
+            anchor_block_size = num_anchor
+        else:
+            bytes_per_anchor = num_query * anchor_emb_per_image.element_size() * SEARCH_NORM_MEM_FACTOR
+            anchor_block_size = max(k1, _plan_chunk_size(num_anchor, bytes_per_anchor, self.search_chunk_bytes))
+        if anchor_block_size >= num_anchor:
+            return self.combiner.norm(query_emb_per_chunk, anchor_emb_per_image).topk(
+                k=k1, dim=1, largest=self.use_posnorm)
+        topk_logits, topk_idx = None, None
+        for start in range(0, num_anchor, anchor_block_size):
+            _norm_logits = self.combiner.norm(query_emb_per_chunk, anchor_emb_per_image[start:start+anchor_block_size])
+            _logits, _idx = _norm_logits.topk(k=min(k1, _norm_logits.shape[1]), dim=1, largest=self.use_posnorm)
+            _idx = _idx + start
+            if topk_logits is not None:
+                _logits = torch.cat([topk_logits, _logits], dim=1)
+                _idx = torch.cat([topk_idx, _idx], dim=1)
+                _logits, _merge_idx = _logits.topk(k=min(k1, _logits.shape[1]), dim=1, largest=self.use_posnorm)
+                _idx = _idx.gather(1, _merge_idx)
+            topk_logits, topk_idx = _logits, _idx
+        return topk_logits, topk_idx
+
+    def iter_query_chunks(self, query_emb_per_image, bytes_per_query, default_chunk_size, search_mode, chunk_func):
+        """
+        Yields chunk_func(query_emb_per_chunk) for chunks of queries. With a
+        search memory budget, the chunk size is the largest which fits given
+        the estimated bytes per query. On OOM, the chunk is retried at half
+        the size, which is also used as the cap for later images.
+        """
+        num_query = query_emb_per_image.shape[0]
+        if self.search_chunk_bytes is None:
+            chunk_size = min(default_chunk_size, max(num_query, 1))
+        else:
+            chunk_size = _plan_chunk_size(num_query, bytes_per_query, self.search_chunk_bytes)
+        if search_mode in self.search_chunk_cap:
+            chunk_size = min(chunk_size, self.search_chunk_cap[search_mode])
+        start = 0
+        while start < num_query:
+            end = min(start + chunk_size, num_query)
+            try:
+                output = chunk_func(query_emb_per_image[start:end])
+            except RuntimeError as e:
+                if (not _is_oom_error(e)) or (end - start == 1):
+                    raise
+                chunk_size = max(1, (end - start) // 2)
+                self.search_chunk_cap[search_mode] = chunk_size
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+                continue
+            yield output
+            start = end
+
     def filter_topk(self, query_emb_per_chunk, anchor_emb_per_image, anchor_per_image, k1, image_shapes=None):
         image_shapes = torch.stack([torch.tensor(list(image_shape)) for image_shape in image_shapes]).repeat(1, 2).reshape(1, 1, 4).to(anchor_emb_per_image)
-        _norm_logits_per_chunk = self.combiner.norm(query_emb_per_chunk, anchor_emb_per_image)
         ###
-        anchor_logits_per_chunk, query_anchor_idx = _norm_logits_per_chunk.topk(k=k1, dim=1, largest=self.use_posnorm)
+        anchor_logits_per_chunk, query_anchor_idx = self.norm_topk(query_emb_per_chunk, anchor_emb_per_image, k1)
         anchor_emb_per_chunk = anchor_emb_per_image[query_anchor_idx]
         offset_emb_per_chunk = self.combiner.forward(query_emb_per_chunk.unsqueeze(1),  anchor_emb_per_chunk)
         anchor_per_chunk = anchor_per_image[query_anchor_idx]
@@ -1297,50 +1494,67 @@ class SPNetHead(nn.Module):
                     "offset_emb": all_offset_emb,
                 }
 
-    def search_topk(self, x, a=None, q=None, k=100, image_shapes=None):
-        ### Compute anchor embeddings
-        _anchor_emb, _ = self.feature_head(x)
-
-        ### 243621
-        query_emb = self.read_gt_embeddings(q)
-        for query_emb_per_image, anchor_emb_per_image, anchor_per_image in zip(
-            query_emb, _anchor_emb, a
-        ):
-            query_chunk_size = query_emb_per_image.shape[0]
-            for query_emb_per_chunk in torch.split(query_emb_per_image, query_chunk_size):
-                offset_emb_per_chunk, anchor_per_chunk, anchor_logits_per_chunk = self.filter_topk(query_emb_per_chunk, anchor_emb_per_image, anchor_per_image, k, image_shapes=image_shapes)
+    def search_topk(self, x, a=None, q=None, k=100, image_shapes=None, anchor_emb=None):
+        ### Compute anchor embeddings, unless precomputed
+        if anchor_emb is None:
+            _anchor_emb, _ = self.feature_head(x)
+        else:
+            _anchor_emb = anchor_emb
+
+        ### Each image in the batch has its own list of queries
+        for image_index, (query_per_image, anchor_emb_per_image, anchor_per_image) in enumerate(zip(
+            q, _anchor_emb, a
+        )):
+            # Skip images with no queries to search for
+            if len(query_per_image['query_loc_emb']) == 0:
+                continue
+            query_emb_per_image = self.read_gt_embeddings([query_per_image])[0]
+            def _search_chunk(query_emb_per_chunk):
+                offset_emb_per_chunk, anchor_per_chunk, anchor_logits_per_chunk = self.filter_topk(query_emb_per_chunk, anchor_emb_per_image, anchor_per_image, k, image_shapes=[image_shapes[image_index]])
                 ###
                 cls_logits = self.classification_head["0"](offset_emb_per_chunk)
                 bbox_regression = self.regression_head["0"](offset_emb_per_chunk)
                 anchor_cls_logits = anchor_logits_per_chunk
-
-                # Return results
-                yield k, {
+                return {
                     "cls_logits": cls_logits,
                     "bbox_regression": bbox_regression,
                     "anchors": anchor_per_chunk,
                     "anchor_cls_logits": anchor_cls_logits,
                 }
+            ## Memory per query: k combined embeddings and head activations
+            bytes_per_query = k * anchor_emb_per_image.shape[-1] * anchor_emb_per_image.element_size() * SEARCH_EMB_MEM_FACTOR
+            for head_outputs in self.iter_query_chunks(query_emb_per_image, bytes_per_query,
+                    query_emb_per_image.shape[0], 'topk', _search_chunk):
+                # Return results
+                yield image_index, k, head_outputs
 
     def search_all(self, x, q=None):
         ### Compute anchor embeddings
         _anchor_emb, shape_list = self.feature_head(x)
 
-        ###
+        ### Each image in the batch has its own list of queries
         query_chunk_size = 16
-        query_emb = self.read_gt_embeddings(q)
-        for query_emb_per_image, anchor_emb_per_image in zip(
-            query_emb, _anchor_emb
-        ):
-            for query_emb_per_chunk in torch.split(query_emb_per_image, query_chunk_size):
+        for image_index, (query_per_image, anchor_emb_per_image) in enumerate(zip(
+            q, _anchor_emb
+        )):
+            # Skip images with no queries to search for
+            if len(query_per_image['query_loc_emb']) == 0:
+                continue
+            query_emb_per_image = self.read_gt_embeddings([query_per_image])[0]
+            def _search_chunk(query_emb_per_chunk):
                 offset_emb_per_chunk = self.combiner.forward(query_emb_per_chunk.unsqueeze(1),  anchor_emb_per_image.unsqueeze(0))
                 offset_emb_per_chunk = _recover_feats1(offset_emb_per_chunk, shape_list, self.num_anchors)
-                # Return results
-                yield {
+                return {
                     "cls_logits": _recover_feats2(self.classification_head["0"](offset_emb_per_chunk), shape_list, self.num_anchors)[0],
                     "bbox_regression": _recover_feats2(self.regression_head["0"](offset_emb_per_chunk), shape_list, self.num_anchors)[0],
                     "anchor_features": _anchor_emb,
                 }
+            ## Memory per query: combined embeddings and head activations for every anchor
+            bytes_per_query = anchor_emb_per_image.numel() * anchor_emb_per_image.element_size() * SEARCH_EMB_MEM_FACTOR
+            for head_outputs in self.iter_query_chunks(query_emb_per_image, bytes_per_query,
+                    query_chunk_size, 'all', _search_chunk):
+                # Return results
+                yield image_index, head_outputs
 
     def forward(self, x, a=None, q=None, moco_features=None, 
             subsample=True, use_all_pos=False):
@@ -2317,6 +2531,25 @@ class SPNet(nn.Module):
         # used only on torchscript mode
         self._has_warned = False
 
+        # Optional cache of backbone features shared by the QC eval stages (set by the engine)
+        self.feature_cache = None
+        # Optional cache of gallery features, anchors and anchor embeddings for search_topk
+        # (see osr.engine.feature_cache.get_anchor_cache): searching new queries in cached
+        # images only runs the query-conditioned head and postprocessing
+        self.anchor_cache = None
+
+        # Optional reuse of backbone features across near-static video frames
+        # (see osr.engine.feature_cache.TemporalFeatureReuse)
+        self.video_reuse = None
+
+        # Tiled inference for high-resolution frames: the feature caches are keyed by frame, so they are not used
+        self.tile_size = config['test_tile_size']
+        self.tile_overlap = config['test_tile_overlap']
+        self.tile_batch_size = config['test_tile_batch_size']
+        if (self.tile_size is not None) and (self.tile_overlap >= self.tile_size):
+            raise ValueError('test_tile_overlap ({}) must be smaller than test_tile_size ({})'.format(
+                self.tile_overlap, self.tile_size))
+
     def compute_loss(self, targets, head_outputs, anchors, image_shapes=None):
         # type: (List[Dict[str, Tensor]], Dict[str, Tensor], List[Tensor]) -> Dict[str, Tensor]
         matched_idxs = []
@@ -2332,14 +2565,12 @@ class SPNet(nn.Module):
 
         return self.head.compute_loss(targets, head_outputs, matched_idxs, image_shapes=image_shapes)
 
-    def postprocess_detections_emb(self, head_outputs, anchors, image_shapes, features, index_by_query=False):
+    def postprocess_detections_emb(self, head_outputs, anchors, image_shapes, features, index_by_query=False, image_index=0):
         # type: (Dict[str, List[Tensor]], List[List[Tensor]], List[Tuple[int, int]]) -> List[Dict[str, Tensor]]
         class_logits = head_outputs["cls_logits"]
         box_regression = head_outputs["bbox_regression"]
 
-        num_images = len(image_shapes)
-        assert num_images == 1
-        image_index = 0
+        # head outputs are for the queries of a single image in the batch
         num_queries = len(class_logits[0])
 
         detections: List[Dict[str, Tensor]] = []
@@ -2406,14 +2637,14 @@ class SPNet(nn.Module):
                 }
             )
         # Extract embeddings
-        assert len(image_shapes) == 1
+        image_features = _get_image_features(features, image_index)
         boxes = torch.cat([d['boxes'] for d in detections])
         box_lens = [len(d['boxes']) for d in detections]
         boxes_dict = [{
             'boxes': boxes,
-            'image_shape': image_shapes[0],
+            'image_shape': image_shapes[image_index],
         }]
-        emb = self.head.get_gt_embeddings(features, boxes_dict)
+        emb = self.head.get_gt_embeddings(image_features, boxes_dict)
         emb_list = torch.split(emb[0], box_lens)
         for e, d in zip(emb_list, detections):
             d['embeddings'] = e
@@ -2423,79 +2654,72 @@ class SPNet(nn.Module):
 
     def postprocess_detections_tfm_oc(self, head_outputs, image_shapes, features):
         # type: (Dict[str, List[Tensor]], List[List[Tensor]], List[Tuple[int, int]]) -> List[Dict[str, Tensor]]
-        class_logits = head_outputs["cls_logits"]
-        box_regression = head_outputs["bbox_regression"]
-        anchors = head_outputs["topk_anchors"]
-
         num_images = len(image_shapes)
-        assert num_images == 1
-        image_shape = image_shapes[0]
+        class_logits = head_outputs["cls_logits"]
+        box_regression = head_outputs["bbox_regression"].reshape(num_images, -1, 4)
+        anchors = head_outputs["topk_anchors"].reshape(num_images, -1, 4)
 
         detections: List[Dict[str, Tensor]] = []
 
-        box_regression_per_level = box_regression
-        logits_per_level = class_logits
-        anchors_per_level = anchors
-        #
-        num_classes = logits_per_level.shape[-1]
+        for box_regression_per_level, logits_per_level, anchors_per_level, image_shape in zip(
+            box_regression, class_logits, anchors, image_shapes
+        ):
+            num_classes = logits_per_level.shape[-1]
 
-        # remove low scoring boxes
-        scores_per_level = torch.sigmoid(logits_per_level).flatten()
-        keep_idxs = scores_per_level > self.score_thresh
-        scores_per_level = scores_per_level[keep_idxs]
-        topk_idxs = torch.where(keep_idxs)[0]
+            # remove low scoring boxes
+            scores_per_level = torch.sigmoid(logits_per_level).flatten()
+            keep_idxs = scores_per_level > self.score_thresh
+            scores_per_level = scores_per_level[keep_idxs]
+            topk_idxs = torch.where(keep_idxs)[0]
 
-        # keep only topk scoring predictions
-        num_topk = det_utils._topk_min(topk_idxs, self.topk_candidates, 0)
-        scores_per_level, idxs = scores_per_level.topk(num_topk)
-        topk_idxs = topk_idxs[idxs]
+            # keep only topk scoring predictions
+            num_topk = det_utils._topk_min(topk_idxs, self.topk_candidates, 0)
+            scores_per_level, idxs = scores_per_level.topk(num_topk)
+            topk_idxs = topk_idxs[idxs]
 
-        anchor_idxs = torch.div(topk_idxs, num_classes, rounding_mode="floor")
-        labels_per_level = topk_idxs % num_classes
+            anchor_idxs = torch.div(topk_idxs, num_classes, rounding_mode="floor")
+            labels_per_level = topk_idxs % num_classes
 
-        boxes_per_level = self.box_coder.decode_single(
-            box_regression_per_level[anchor_idxs], anchors_per_level[anchor_idxs]
-        )
-        boxes_per_level = box_ops.clip_boxes_to_image(boxes_per_level, image_shape)
+            boxes_per_level = self.box_coder.decode_single(
+                box_regression_per_level[anchor_idxs], anchors_per_level[anchor_idxs]
+            )
+            boxes_per_level = box_ops.clip_boxes_to_image(boxes_per_level, image_shape)
 
-        image_boxes = boxes_per_level
-        image_scores = scores_per_level
-        image_labels = labels_per_level
+            image_boxes = boxes_per_level
+            image_scores = scores_per_level
+            image_labels = labels_per_level
 
-        # non-maximum suppression
-        keep = box_ops.batched_nms(image_boxes, image_scores, image_labels, self.nms_thresh)
-        keep = keep[: self.detections_per_img]
-
-        detections.append(
-            {
-                "boxes": image_boxes[keep],
-                "scores": image_scores[keep],
-                "cws": image_scores[keep],
-                "labels": image_labels[keep],
-            }
-        )
-        # Extract embeddings
-        assert len(image_shapes) == 1
-        boxes = torch.cat([d['boxes'] for d in detections])
-        box_lens = [len(d['boxes']) for d in detections]
+            # non-maximum suppression
+            keep = box_ops.batched_nms(image_boxes, image_scores, image_labels, self.nms_thresh)
+            keep = keep[: self.detections_per_img]
+
+            detections.append(
+                {
+                    "boxes": image_boxes[keep],
+                    "scores": image_scores[keep],
+                    "cws": image_scores[keep],
+                    "labels": image_labels[keep],
+                }
+            )
+        # Extract embeddings for all images in the batch at once
         boxes_dict = [{
-            'boxes': boxes,
-            'image_shape': image_shapes[0],
-        }]
+            'boxes': d['boxes'],
+            'image_shape': image_shape,
+        } for d, image_shape in zip(detections, image_shapes)]
         if self.num_cascade_steps > 0:
-            emb = self.head.get_gt_embeddings(features, boxes_dict, emb_type='loc')
+            emb_list = self.head.get_gt_embeddings(features, boxes_dict, emb_type='loc')
         else:
-            emb = self.head.get_gt_embeddings(features, boxes_dict)
-        emb_list = torch.split(emb[0], box_lens)
+            emb_list = self.head.get_gt_embeddings(features, boxes_dict)
         for e, d in zip(emb_list, detections):
             d['embeddings'] = e
 
         # Optional cascaded box refinement
         if self.num_cascade_steps > 0:
-            for d in detections:
+            for image_index, d in enumerate(detections):
                 if d['scores'].shape[0] > 0:
-                    new_box, new_emb, cls_logits = self.head.test_cascade(features,
-                        d['embeddings'], None, d['boxes'], image_shapes[0])
+                    new_box, new_emb, cls_logits = self.head.test_cascade(
+                        _get_image_features(features, image_index),
+                        d['embeddings'], None, d['boxes'], image_shapes[image_index])
                     d['boxes'] = new_box
                     d['embeddings'] = new_emb
                     d['scores'] = torch.sigmoid(cls_logits.max(dim=1).values)
@@ -2507,16 +2731,18 @@ class SPNet(nn.Module):
 
     def postprocess_detections_emb_query(self, head_outputs, anchors, image_shapes,
             features,
-            use_sim_as_det_score=False, queries=None, top_only=False, store_anchors=True):
+            use_sim_as_det_score=False, queries=None, top_only=False, store_anchors=True,
+            image_index=0, query_start=0):
         # type: (Dict[str, List[Tensor]], List[List[Tensor]], List[Tuple[int, int]]) -> List[Dict[str, Tensor]]
-        num_images = len(image_shapes)
-        assert num_images == 1
+        # head outputs are for the chunk of queries of the image at image_index in the batch,
+        # starting at query_start
         anchor_class_logits = head_outputs["anchor_cls_logits"][0]
         class_logits = head_outputs["cls_logits"][0]
         box_regression = head_outputs["bbox_regression"][0]
 
-        image_index = 0
         image_shape = image_shapes[image_index]
+        image_queries = queries[image_index]
+        image_features = _get_image_features(features, image_index)
 
         detections: List[Dict[str, Tensor]] = []
 
@@ -2564,7 +2790,7 @@ class SPNet(nn.Module):
 
         ###
         label_offsets = (torch.arange(Q).unsqueeze(1).repeat(1, K).reshape(-1).to(image_labels) * num_classes)[score_mask]
-        image_index = torch.arange(Q).unsqueeze(1).repeat(1, K).reshape(-1).to(image_labels)[score_mask]
+        query_index = torch.arange(Q).unsqueeze(1).repeat(1, K).reshape(-1).to(image_labels)[score_mask]
         image_labels = image_labels.reshape(-1)[score_mask] + label_offsets
         
         assert box_regression_per_level.shape == anchors_per_level.shape
@@ -2580,9 +2806,9 @@ class SPNet(nn.Module):
         _keep = box_ops.batched_nms(image_boxes, image_scores, image_labels, self.nms_thresh)
         keep = _keep.sort().values
 
-        keep_image_index = image_index[keep]
+        keep_query_index = query_index[keep]
         split_sections_dict = dict(zip(range(Q), Q*[0]))
-        unique_vals, unique_counts = keep_image_index.unique(return_counts=True)
+        unique_vals, unique_counts = keep_query_index.unique(return_counts=True)
         _split_sections_dict = dict(zip(unique_vals.tolist(), unique_counts.tolist()))
         split_sections_dict = {**split_sections_dict, **_split_sections_dict}
         split_sections = list(split_sections_dict.values())
@@ -2618,26 +2844,25 @@ class SPNet(nn.Module):
                 )
 
         # Extract embeddings
-        assert len(image_shapes) == 1
         boxes = torch.cat([d['boxes'] for d in detections])
         box_lens = [len(d['boxes']) for d in detections]
         boxes_dict = [{
             'boxes': boxes,
-            'image_shape': image_shapes[0],
+            'image_shape': image_shape,
         }]
 
         ## reid embeddings
         if self.num_cascade_steps > 0:
-            emb = self.head.get_gt_embeddings(features, boxes_dict, emb_type='loc')
+            emb = self.head.get_gt_embeddings(image_features, boxes_dict, emb_type='loc')
         else:
-            emb = self.head.get_gt_embeddings(features, boxes_dict)
+            emb = self.head.get_gt_embeddings(image_features, boxes_dict)
         emb_list = torch.split(emb[0], box_lens)
         for e, d in zip(emb_list, detections):
             d['embeddings'] = e
 
         ###
         if use_sim_as_det_score:
-            query_emb = queries[0]['query_emb']
+            query_emb = image_queries['query_emb'][query_start:query_start+Q]
             for q, e, d in zip(query_emb, emb_list, detections):
                 d['scores'] = torch.sigmoid((F.normalize(e, dim=1)@F.normalize(q, dim=1).T).squeeze(1)) #* d['scores']
 
@@ -2652,24 +2877,155 @@ class SPNet(nn.Module):
 
         # Optional cascaded box refinement
         if self.num_cascade_steps > 0:
-            query_loc_emb = queries[0]['query_loc_emb']
-            for q, d in zip(query_loc_emb, detections):
-                if d['scores'].shape[0] > 0:
-                    new_box, new_emb, cls_logits = self.head.test_cascade(
-                        features, d['embeddings'], q,    d['boxes'], image_shapes[0])
+            query_loc_emb = image_queries['query_loc_emb'][query_start:query_start+Q]
+            ## Refine the detections of all queries for this image together
+            cascade_idx_list = [i for i, d in enumerate(detections) if d['scores'].shape[0] > 0]
+            if len(cascade_idx_list) > 0:
+                new_box_list, new_emb_list, cls_logits_list = self.head.test_cascade_groups(image_features,
+                    [detections[i]['embeddings'] for i in cascade_idx_list],
+                    [query_loc_emb[i] for i in cascade_idx_list],
+                    [detections[i]['boxes'] for i in cascade_idx_list], image_shape)
+                for i, new_box, new_emb, cls_logits in zip(cascade_idx_list,
+                        new_box_list, new_emb_list, cls_logits_list):
+                    d = detections[i]
                     d['boxes'] = new_box
                     d['embeddings'] = new_emb
                     d['scores'] = torch.sigmoid(cls_logits.max(dim=1).values)
                     # Use final stage scores for CWS by default
                     d['cws'] = d['scores']
                     d['labels'] = cls_logits.max(dim=1).indices
-                else:
-                    d['embeddings'] = torch.zeros(0, queries[0]['query_emb'][0].shape[-1]).to(query_loc_emb[0])
+            for d in detections:
+                if d['scores'].shape[0] == 0:
+                    d['embeddings'] = torch.zeros(0, image_queries['query_emb'][0].shape[-1]).to(query_loc_emb[0])
 
         # Return list of detections
         return detections
 
-    def forward(self, images, targets=None, queries=None, inference_mode='both'):
+    def _merge_tile_detections(self, tile_output_list, window_list, image_shape):
+        # Shift detections of the tiles of one frame to frame coordinates, and merge them with NMS
+        output = {}
+        offset_list = [torch.tensor(w[:2] * 2, dtype=torch.float, device=tile_output_list[0]['det_boxes'].device)
+            for w in window_list]
+        for key in tile_output_list[0]:
+            if key.startswith('det_'):
+                output[key] = torch.cat([(o[key] + offset) if key in TILE_BOX_KEYS else o[key]
+                    for o, offset in zip(tile_output_list, offset_list)])
+        ## Detections cut by a tile edge inside the frame
+        height, width = image_shape
+        cut_list = []
+        for o, (x1, y1, x2, y2) in zip(tile_output_list, window_list):
+            boxes = o['det_boxes']
+            cut_list.append(((boxes[:, 0] <= TILE_EDGE_MARGIN) & (x1 > 0))
+                | ((boxes[:, 1] <= TILE_EDGE_MARGIN) & (y1 > 0))
+                | ((boxes[:, 2] >= (x2 - x1 - TILE_EDGE_MARGIN)) & (x2 < width))
+                | ((boxes[:, 3] >= (y2 - y1 - TILE_EDGE_MARGIN)) & (y2 < height)))
+        cut = torch.cat(cut_list)
+        keep = box_ops.batched_nms(output['det_boxes'], output['det_scores'], output['det_labels'], self.nms_thresh)
+        ## Drop cut detections mostly covered by an uncut detection of a neighboring tile
+        keep_cut = cut[keep]
+        if keep_cut.any() and (~keep_cut).any():
+            cut_boxes = output['det_boxes'][keep[keep_cut]]
+            uncut_boxes = output['det_boxes'][keep[~keep_cut]]
+            lt = torch.max(cut_boxes[:, None, :2], uncut_boxes[None, :, :2])
+            rb = torch.min(cut_boxes[:, None, 2:], uncut_boxes[None, :, 2:])
+            inter = (rb - lt).clamp(min=0).prod(dim=2)
+            cover = inter.max(dim=1).values / box_ops.box_area(cut_boxes).clamp(min=1e-6)
+            drop = torch.zeros_like(keep_cut)
+            drop[keep_cut] = cover >= self.nms_thresh
+            keep = keep[~drop]
+        ## Keep the best detections, as for whole frames: keep is sorted by score
+        keep = keep[:self.detections_per_img]
+        for key in TILE_DET_KEYS:
+            if key in output:
+                output[key] = output[key][keep]
+        # Average the GFN scene embedding over tiles
+        if 'scene_emb' in tile_output_list[0]:
+            scene_emb_list = [o['scene_emb'] for o in tile_output_list]
+            if scene_emb_list[0].numel() > 0:
+                output['scene_emb'] = torch.cat(scene_emb_list).mean(dim=0, keepdim=True)
+            else:
+                output['scene_emb'] = scene_emb_list[0]
+        return output
+
+    def forward_tiled(self, images, targets=None, queries=None, inference_mode='both'):
+        """
+        Inference on overlapping tiles of tile_size pixels, batched
+        tile_batch_size at a time, for frames too large to process whole.
+        Detections are shifted to frame coordinates and merged across tiles
+        with NMS. Each GT box is embedded from the tile covering most of it.
+        """
+        use_gt = inference_mode in ('gt', 'both')
+
+        # Get tiles for each frame
+        tile_list = []
+        gt_tile_idx_list = []
+        for image_index, image in enumerate(images):
+            window_list = get_tile_windows(image.shape[-2], image.shape[-1], self.tile_size, self.tile_overlap)
+            if use_gt:
+                ## Assign each GT box to the tile with the largest intersection
+                gt_boxes = targets[image_index]['boxes']
+                windows = torch.tensor(window_list, dtype=gt_boxes.dtype, device=gt_boxes.device)
+                lt = torch.max(gt_boxes[:, None, :2], windows[None, :, :2])
+                rb = torch.min(gt_boxes[:, None, 2:], windows[None, :, 2:])
+                gt_tile_idx = (rb - lt).clamp(min=0).prod(dim=2).argmax(dim=1)
+                gt_tile_idx_list.append(gt_tile_idx)
+            for tile_index, window in enumerate(window_list):
+                tile = {'image_index': image_index, 'window': window}
+                if use_gt:
+                    tile['gt_mask'] = gt_tile_idx == tile_index
+                    ## Only GT embeddings needed: skip tiles without GT boxes, keeping one tile per frame
+                    if (inference_mode == 'gt') and (tile_index > 0) and (not tile['gt_mask'].any()):
+                        continue
+                tile_list.append(tile)
+
+        # Run the model on batches of tiles
+        tile_output_list = []
+        for batch_start in range(0, len(tile_list), self.tile_batch_size):
+            batch_tile_list = tile_list[batch_start:batch_start+self.tile_batch_size]
+            tile_images, tile_targets, tile_queries = [], None, None
+            for tile in batch_tile_list:
+                x1, y1, x2, y2 = tile['window']
+                tile_images.append(images[tile['image_index']][:, y1:y2, x1:x2])
+            if use_gt:
+                tile_targets = []
+                for tile in batch_tile_list:
+                    x1, y1, x2, y2 = tile['window']
+                    target = targets[tile['image_index']]
+                    tile_boxes = target['boxes'][tile['gt_mask']].clone()
+                    tile_boxes[:, 0::2] = tile_boxes[:, 0::2].clamp(x1, x2) - x1
+                    tile_boxes[:, 1::2] = tile_boxes[:, 1::2].clamp(y1, y2) - y1
+                    tile_targets.append({'boxes': tile_boxes, 'image_id': target['image_id']})
+            if queries is not None:
+                tile_queries = [queries[tile['image_index']] for tile in batch_tile_list]
+            tile_output_list.extend(self.forward(tile_images, targets=tile_targets, queries=tile_queries,
+                inference_mode=inference_mode, use_tiling=False))
+
+        # Merge tile outputs for each frame
+        output_list = []
+        for image_index in range(len(images)):
+            image_tile_list, image_output_list = zip(*[(t, o) for t, o in zip(tile_list, tile_output_list)
+                if t['image_index'] == image_index])
+            window_list = [t['window'] for t in image_tile_list]
+            image_shape = tuple(images[image_index].shape[-2:])
+            if inference_mode.startswith('search'):
+                ## One list of outputs per query
+                output_list.append([self._merge_tile_detections(list(o), window_list, image_shape)
+                    for o in zip(*image_output_list)])
+                continue
+            output = {}
+            if inference_mode != 'gt':
+                output.update(self._merge_tile_detections(image_output_list, window_list, image_shape))
+            if use_gt:
+                gt_tile_idx = gt_tile_idx_list[image_index]
+                for key in ('gt_emb', 'gt_loc_emb'):
+                    emb = image_output_list[0][key]
+                    output[key] = emb.new_empty(len(gt_tile_idx), emb.shape[1])
+                    for tile, o in zip(image_tile_list, image_output_list):
+                        output[key][tile['gt_mask']] = o[key]
+            output_list.append(output)
+        return output_list
+
+    def forward(self, images, targets=None, queries=None, inference_mode='both', use_tiling=True):
         # type: (List[Tensor], Optional[List[Dict[str, Tensor]]]) -> Tuple[Dict[str, Tensor], List[Dict[str, Tensor]]]
         """
         Args:
@@ -2695,6 +3051,13 @@ class SPNet(nn.Module):
                         "Expected target boxes to be a tensor of shape [N, 4].",
                     )
 
+        # split high-resolution frames into tiles
+        use_tiling = use_tiling and (self.tile_size is not None) and (not self.training)
+        ## scene classification runs on whole frames
+        use_tiling = use_tiling and (inference_mode in TILE_INFERENCE_MODES) and not (self.use_classifier_train and self.use_classifier_test)
+        if use_tiling:
+            return self.forward_tiled(images, targets=targets, queries=queries, inference_mode=inference_mode)
+
         # get the original image sizes
         original_image_sizes: List[Tuple[int, int]] = []
         for img in images:
@@ -2727,21 +3090,58 @@ class SPNet(nn.Module):
                         f" Found invalid box {degen_bb} for target at index {target_idx}.",
                     )
 
+        # reuse backbone features, anchors and anchor embeddings from a previous search of the same images
+        features = None
+        cached_anchors, cached_anchor_emb = None, None
+        use_anchor_cache = (self.anchor_cache is not None) and (not self.training) and (inference_mode == 'search_topk') and (self.tile_size is None)
+        if use_anchor_cache:
+            features = self.anchor_cache.get([q['image_id'] for q in queries],
+                images.tensors.shape[-2:], images.tensors.device)
+            if features is not None:
+                cached_anchors = list(features.pop('_anchors'))
+                cached_anchor_emb = features.pop('_anchor_emb')
+
+        # reuse backbone features cached when computing query embeddings
+        use_feature_cache = (self.feature_cache is not None) and (not self.training) and (self.tile_size is None)
+        if (features is None) and use_feature_cache and (queries is not None) and inference_mode.startswith('search'):
+            features = self.feature_cache.get([q['image_id'] for q in queries],
+                images.tensors.shape[-2:], images.tensors.device)
+
+        # reuse backbone features of near-static video frames
+        ## GT boxes are always embedded from the features of their own frame
+        use_video_reuse = ((self.video_reuse is not None) and (not self.training) and (self.tile_size is None)
+            and ((inference_mode == 'det') or inference_mode.startswith('search')))
+        if use_video_reuse:
+            if targets is not None:
+                image_id_list = [t['image_id'].item() for t in targets]
+            elif queries is not None:
+                image_id_list = [q['image_id'] for q in queries]
+            else:
+                use_video_reuse = False
+
         # get the features from the backbone (and optional class_logits)
-        if self.use_classifier_train:
-            if self.use_classifier_test and (not self.training):
-                class_logits = self.backbone(images.tensors, shortcut=True)
-                return class_logits
+        if features is None:
+            if self.use_classifier_train:
+                if self.use_classifier_test and (not self.training):
+                    class_logits = self.backbone(images.tensors, shortcut=True)
+                    return class_logits
+                else:
+                    features, class_logits = self.backbone(images.tensors)
+            elif use_video_reuse:
+                features = self.video_reuse.get_features(image_id_list, images.tensors, self.backbone)
             else:
-                features, class_logits = self.backbone(images.tensors)
-        else:
-            features = self.backbone(images.tensors)
+                features = self.backbone(images.tensors)
+
+            # restructure features if needed
+            if 'pool' in features:
+                features.pop('pool')
+            if isinstance(features, torch.Tensor):
+                features = OrderedDict([("0", features)])
 
-        # restructure features if needed
-        if 'pool' in features:
-            features.pop('pool')
-        if isinstance(features, torch.Tensor):
-            features = OrderedDict([("0", features)])
+            # cache features for the search stage
+            if use_feature_cache and (inference_mode == 'gt'):
+                self.feature_cache.put([t['image_id'].item() for t in targets],
+                    features, images.tensors.shape[-2:])
 
         # List of features
         feature_keys = features.keys()
@@ -2815,12 +3215,23 @@ class SPNet(nn.Module):
             return output_list
             
         if inference_mode == 'search_topk':
-            # create the set of anchors
-            anchors = self.anchor_generator(images, features)
+            if cached_anchors is None:
+                # create the set of anchors
+                anchors = self.anchor_generator(images, features)
+                anchor_emb = None
+                # cache the query-independent outputs for later searches
+                if use_anchor_cache:
+                    anchor_emb, _ = self.head.feature_head(features)
+                    self.anchor_cache.put([q['image_id'] for q in queries],
+                        OrderedDict([*zip(feature_keys, features),
+                            ('_anchors', torch.stack(anchors)), ('_anchor_emb', anchor_emb)]),
+                        images.tensors.shape[-2:])
+            else:
+                anchors, anchor_emb = cached_anchors, cached_anchor_emb
 
             # compute the spnet heads outputs using the features
-            output_list = []
-            for num_anchors_per_level, head_outputs in self.head.search_topk(features, a=anchors, q=queries, image_shapes=image_shapes):
+            output_list = [[] for _ in range(len(image_shapes))]
+            for image_index, num_anchors_per_level, head_outputs in self.head.search_topk(features, a=anchors, q=queries, image_shapes=image_shapes, anchor_emb=anchor_emb):
                 # split outputs per level
                 split_head_outputs: Dict[str, List[Tensor]] = {}
                 for k in head_outputs:
@@ -2829,7 +3240,8 @@ class SPNet(nn.Module):
                             split_head_outputs[k] = list(head_outputs[k].split(num_anchors_per_level, dim=1))
 
                 # compute the detections
-                detections = self.postprocess_detections_emb_query(split_head_outputs, split_head_outputs['anchors'], image_shapes, features, queries=queries, store_anchors=self.store_anchors)
+                detections = self.postprocess_detections_emb_query(split_head_outputs, split_head_outputs['anchors'], image_shapes, features, queries=queries, store_anchors=self.store_anchors, image_index=image_index,
+                    query_start=len(output_list[image_index]))
                 for i, d in enumerate(detections):
                     new_d = {
                         'det_boxes': d['boxes'],
@@ -2843,16 +3255,15 @@ class SPNet(nn.Module):
                         new_d['det_anchors'] = d['anchors']
                         new_d['det_anchor_boxes'] = d['anchor_boxes']
                         new_d['det_anchor_scores'] = d['anchor_scores']
-                    output_list.append(new_d)
-            output_list = [output_list]
+                    output_list[image_index].append(new_d)
 
         if inference_mode == 'search_all':
             # create the set of anchors
             anchors = self.anchor_generator(images, features)
 
             # compute the spnet heads outputs using the features
-            output_list = []
-            for head_outputs in self.head.search_all(features, q=queries):
+            output_list = [[] for _ in range(len(image_shapes))]
+            for image_index, head_outputs in self.head.search_all(features, q=queries):
                 # recover level sizes
                 num_anchors_per_level = [x.size(2) * x.size(3) for x in features]
                 HW = 0
@@ -2871,15 +3282,14 @@ class SPNet(nn.Module):
                 split_anchors = [list(a.split(num_anchors_per_level)) for a in anchors]
 
                 # compute the detections
-                detections = self.postprocess_detections_emb(split_head_outputs, split_anchors, image_shapes, features)
+                detections = self.postprocess_detections_emb(split_head_outputs, split_anchors, image_shapes, features, image_index=image_index)
                 for i, d in enumerate(detections):
-                    output_list.append({
+                    output_list[image_index].append({
                         'det_boxes': d['boxes'],
                         'det_scores': d['scores'],
                         'det_labels': d['labels'],
                         'det_emb': d['embeddings'],#*d['scores'].unsqueeze(1),
                     })
-            output_list = [output_list]
 
         if inference_mode in ('det', 'both'):
             # create the set of anchors
@@ -0,0 +1,154 @@
+# Global imports
+import os
+import copy
+import json
+import pytest
+## torch
+import torch
+
+# Package imports
+from osr.engine import evaluate
+from osr.engine import lookup_store
+from osr.engine import utils as engine_utils
+from osr.engine.search import load_model
+
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'configs')
+
+
+# Function to get random boxes
+def get_boxes(num_box, generator):
+    xy1 = torch.rand(num_box, 2, generator=generator) * 200
+    wh = 20 + torch.rand(num_box, 2, generator=generator) * 60
+    return torch.cat([xy1, xy1 + wh], dim=1)
+
+
+# Function to build a synthetic test set with its evaluation lookups
+def get_synthetic_eval(retrieval_dir, num_image=40, num_person=8, num_query=10, emb_dim=128, seed=0):
+    """
+    Returns a stand-in test loader, and the query, image, OC detection and
+    QC detection lookups of a tiny synthetic test set. Embeddings of the
+    same person are noisy copies of a person prototype, and each image has
+    detections of its GT boxes with jitter, plus distractors.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    person_emb = torch.randn(num_person, emb_dim, generator=generator)
+    def _get_emb(person_ids):
+        return person_emb[person_ids] + 1.5 * torch.randn(len(person_ids), emb_dim, generator=generator)
+    def _get_detection(gt_boxes, gt_person_ids, num_distractor=4):
+        boxes = torch.cat([gt_boxes + 4 * torch.rand(gt_boxes.shape, generator=generator),
+            get_boxes(num_distractor, generator)])
+        embeddings = torch.cat([_get_emb(gt_person_ids), torch.randn(num_distractor, emb_dim, generator=generator)])
+        scores = torch.cat([0.5 + 0.5 * torch.rand(len(gt_boxes), generator=generator),
+            torch.rand(num_distractor, generator=generator)])
+        return evaluate.DetectionLookupEntry(boxes=boxes, scores=scores, cws=torch.ones(len(boxes)),
+            labels=torch.ones(len(boxes), dtype=torch.long), embeddings=embeddings,
+            anchors=boxes + 2, anchor_boxes=boxes + 1, anchor_scores=scores.flip(0))
+    # Image and OC detection lookups
+    image_lookup, oc_detection_lookup = {}, {}
+    gt_id = 0
+    for image_id in range(num_image):
+        num_gt = 1 + image_id % 3
+        person_ids = torch.randint(num_person, (num_gt,), generator=generator)
+        boxes = get_boxes(num_gt, generator)
+        image_lookup[image_id] = evaluate.ImageLookupEntry(id=torch.arange(gt_id, gt_id + num_gt),
+            person_ids=person_ids, iou_thresh=torch.full((num_gt,), 0.5), boxes=boxes,
+            scores=torch.ones(num_gt), cws=torch.ones(num_gt), embeddings=_get_emb(person_ids))
+        oc_detection_lookup[image_id] = _get_detection(boxes, person_ids)
+        gt_id += num_gt
+    # Query lookup: the first GT box of the first images
+    query_lookup = {}
+    for image_id in range(num_query):
+        image_entry = image_lookup[image_id]
+        query_lookup[int(image_entry.id[0])] = evaluate.QueryLookupEntry(image_id=image_id,
+            person_id=image_entry.person_ids[0], embedding=image_entry.embeddings[:1].clone(),
+            box=image_entry.boxes[0])
+    # QC detection lookup: detections for each (gallery image, query) pair
+    qc_detection_lookup = {image_id:{query_id:_get_detection(image_entry.boxes, image_entry.person_ids)
+        for query_id in query_lookup} for image_id, image_entry in image_lookup.items()}
+    # Retrieval protocols: a fixed gallery for all queries, and a gallery for each query
+    query_id_list = list(query_lookup)
+    with open(str(retrieval_dir / 'fixed.json'), 'w') as fp:
+        json.dump({'queries': query_id_list, 'images': list(range(0, num_image, 2))}, fp)
+    with open(str(retrieval_dir / 'per_query.json'), 'w') as fp:
+        json.dump({'queries': {str(q):[i for i in range(num_image) if (i + q) % 3 != 0] for q in query_id_list}}, fp)
+    sampler = lookup_store.StoreSampler(partition_name='test', query_id_list=query_id_list,
+        retrieval_dir=str(retrieval_dir), retrieval_name_list=('all', 'fixed', 'per_query'))
+    return lookup_store.StoreLoader(sampler=sampler), query_lookup, image_lookup, oc_detection_lookup, qc_detection_lookup
+
+
+@pytest.fixture
+def synthetic_eval(tmp_path):
+    retrieval_dir = tmp_path / 'retrieval'
+    retrieval_dir.mkdir()
+    return get_synthetic_eval(retrieval_dir)
+
+
+# Function to run compute_metrics on the CPU on copies of the lookups
+def _compute_metrics_cpu(data_loader, query_lookup, image_lookup, detection_lookup, **kwargs):
+    metric_dict, _, _ = evaluate.compute_metrics(None, data_loader,
+        copy.deepcopy(query_lookup), image_lookup, detection_lookup, device='cpu', **kwargs)
+    return {k:float(v) for k, v in metric_dict.items()}
+
+
+@pytest.fixture
+def compute_metrics_cpu():
+    return _compute_metrics_cpu
+
+
+# Function to scale the bridge layer outputs to the norm of trained embeddings
+def scale_bridge_layers(model, emb_dim, image_size=(256, 320)):
+    """
+    With random weights, embedding norms, and thus detection scores, are
+    near 0. The outputs of each bridge layer are scaled to a median norm of
+    sqrt(emb_dim), with the scale fixed at the first call, so that the model
+    outputs detections with a spread of scores.
+    """
+    scale_dict = {}
+    def _get_hook(layer_name):
+        def _hook(module, inputs, output):
+            if layer_name not in scale_dict:
+                scale_dict[layer_name] = emb_dim ** 0.5 / output.norm(dim=-1).median().item()
+            return output * scale_dict[layer_name]
+        return _hook
+    for layer_name, bridge_layer in model.head.bridge_layer.items():
+        bridge_layer.register_forward_hook(_get_hook(layer_name))
+    with torch.no_grad():
+        model([torch.randn(3, *image_size)], inference_mode='det')
+
+
+# Random-weight ResNet50 SPNet with 2 cascade steps on the CPU, shared by all tests: use monkeypatch to change it
+@pytest.fixture(scope='session')
+def spnet_config():
+    default_config, tuple_key_list = engine_utils.load_config(os.path.join(CONFIG_DIR, 'default.yaml'))
+    trial_config, _ = engine_utils.load_config(os.path.join(CONFIG_DIR, 'benchmark', 'cuhk_final_r1024_rn50.yaml'),
+        tuple_key_list=tuple_key_list)
+    return {**default_config, **trial_config}
+
+
+@pytest.fixture(scope='session')
+def spnet_model(spnet_config):
+    torch.manual_seed(0)
+    model = load_model(spnet_config, None, 'cpu')
+    scale_bridge_layers(model, spnet_config['emb_dim'])
+    return model
+
+
+# Function to get search queries which match anchors of an image
+def _get_anchor_queries(model, image, num_query, generator):
+    """
+    Queries from another random image are too far from every anchor of a
+    random-weight model to give detections: the queries are instead the
+    embeddings of random anchors of the image.
+    """
+    with torch.no_grad():
+        features = model.backbone(image.unsqueeze(0))
+        features.pop('pool', None)
+        anchor_emb, _ = model.head.feature_head(list(features.values()))
+    anchor_idx = torch.randint(anchor_emb.shape[1], (num_query,), generator=generator)
+    return anchor_emb[0, anchor_idx]
+
+
+@pytest.fixture
+def get_anchor_queries():
+    return _get_anchor_queries
@@ -0,0 +1,61 @@
+# Global imports
+import numpy as np
+from PIL import Image
+## torch
+import torch
+
+# Package imports
+from osr.engine import transform
+from osr.engine.search import PersonSearcher, SearchImageDataset
+
+
+# Function to write random gallery images
+def write_images(image_dir, num_image, image_size=(256, 320)):
+    rng = np.random.default_rng(0)
+    image_path_list = []
+    for image_index in range(num_image):
+        image_path = str(image_dir / '{}.png'.format(image_index))
+        Image.fromarray(rng.integers(0, 256, (*image_size, 3), dtype=np.uint8)).save(image_path)
+        image_path_list.append(image_path)
+    return image_path_list
+
+
+# Function to get a searcher with queries which match anchors of the gallery images
+def get_searcher(model, config, image_path_list, get_anchor_queries, seed, **kwargs):
+    """
+    The searcher runs at native resolution. Query loc embeddings, used to
+    search, are replaced by anchor embeddings of the gallery images, so that
+    the random-weight model gives detections.
+    """
+    searcher = PersonSearcher(model, transform.get_transform_native(
+        stat_dict={'mean': config['image_mean'], 'std': config['image_std']}),
+        'cpu', batch_size=2, num_workers=0, det_thresh=0.0, top_k=5, **kwargs)
+    searcher.set_queries([{'query_id': str(i), 'image': p, 'box': None} for i, p in enumerate(image_path_list)])
+    dataset = SearchImageDataset(image_path_list, searcher.transform)
+    generator = torch.Generator().manual_seed(seed)
+    searcher.query_loc_emb = torch.cat([get_anchor_queries(model, dataset[i][0], 1, generator)
+        for i in range(len(dataset))])
+    return searcher
+
+
+# Searches with the anchor cache give the same results as without, including for new queries
+def test_anchor_cache_matches_uncached(spnet_model, spnet_config, get_anchor_queries, tmp_path, monkeypatch):
+    monkeypatch.setattr(spnet_model, 'anchor_cache', None)
+    image_path_list = write_images(tmp_path, 3)
+    result_list_dict = {}
+    for seed in (0, 1):
+        searcher = get_searcher(spnet_model, spnet_config, image_path_list, get_anchor_queries, seed)
+        result_list_dict[seed] = list(searcher.search(image_path_list))
+        assert sum([len(r['results']) for r in result_list_dict[seed]]) > 0
+    # Fill the cache, then search cached images with the same and with new queries
+    searcher = get_searcher(spnet_model, spnet_config, image_path_list, get_anchor_queries, 0,
+        anchor_cache_mem_gb=1.0)
+    anchor_cache = spnet_model.anchor_cache
+    assert anchor_cache is not None
+    assert list(searcher.search(image_path_list)) == result_list_dict[0]
+    assert (anchor_cache.num_hit, anchor_cache.num_miss) == (0, 3)
+    assert list(searcher.search(image_path_list)) == result_list_dict[0]
+    new_searcher = get_searcher(spnet_model, spnet_config, image_path_list, get_anchor_queries, 1)
+    searcher.query_loc_emb = new_searcher.query_loc_emb
+    assert list(searcher.search(image_path_list)) == result_list_dict[1]
+    assert (anchor_cache.num_hit, anchor_cache.num_miss) == (6, 3)
@@ -0,0 +1,104 @@
+# Global imports
+import pytest
+## torch
+import torch
+from torchvision.ops import boxes as box_ops
+
+
+# Reference per-query cascade: one query's detections at a time, through every step
+def cascade_loop(head, features, pred_emb, query_emb, pred_box, image_shape, num_steps):
+    features_dict = dict(zip(head.featmap_names, features))
+    loc_features_dict = dict(zip(head.loc_featmap_names, features)) if head.emb_align_sep else features_dict
+    for cascade_idx in range(num_steps):
+        if head.train_mode == 'qc':
+            offset_emb = head.combiner.forward(query_emb, pred_emb)
+        else:
+            offset_emb = head.bridge_layer[str(cascade_idx+1)](pred_emb)
+        bbox_regression = head.regression_head[str(cascade_idx+1)](offset_emb)
+        cls_logits = head.classification_head[str(cascade_idx+1)](offset_emb)
+        pred_box = box_ops.clip_boxes_to_image(head.box_coder.decode_single(bbox_regression, pred_box), image_shape)
+        nms_idx = box_ops.batched_nms(pred_box, cls_logits[:, 1],
+            torch.ones(pred_box.shape[0], dtype=torch.long), 0.5)
+        pred_box, cls_logits = pred_box[nms_idx], cls_logits[nms_idx]
+        if head.emb_align_sep and (cascade_idx < (num_steps - 1)):
+            box_emb = head.align_emb_loc_head[str(cascade_idx+2)](
+                head.loc_roi_align(loc_features_dict, [pred_box], [image_shape]))
+        else:
+            box_emb = head.align_emb_head(head.roi_align(features_dict, [pred_box], [image_shape]))
+        pred_emb = box_emb.flatten(1)
+    return pred_box, pred_emb, cls_logits
+
+
+# Function to get random detection groups, one per query, for one image
+def get_cascade_inputs(model, num_group, generator, image_size=(256, 320)):
+    height, width = image_size
+    image = torch.randn(3, height, width, generator=generator)
+    with torch.no_grad():
+        features = model.backbone(image.unsqueeze(0))
+        features.pop('pool', None)
+        features = list(features.values())
+        pred_box_list, pred_emb_list = [], []
+        for num_box in torch.randint(1, 8, (num_group,), generator=generator).tolist():
+            xy = torch.rand(num_box, 2, generator=generator) * torch.tensor([width - 64, height - 128])
+            wh = 16 + torch.rand(num_box, 2, generator=generator) * torch.tensor([48, 112])
+            pred_box = torch.cat([xy, xy + wh], dim=1)
+            pred_box_list.append(pred_box)
+            pred_emb_list.append(model.head.get_gt_embeddings(features,
+                [{'boxes': pred_box, 'image_shape': image_size}], emb_type='loc')[0])
+        query_emb_list = list(torch.randn(num_group, 1, model.head.emb_loc_dim, generator=generator))
+    return features, pred_emb_list, query_emb_list, pred_box_list, image_size
+
+
+# Function to check cascade outputs of each group against the per-query loop
+def assert_cascade_equal(output_tuple, ref_output_tuple):
+    for output, ref_output in zip(output_tuple, ref_output_tuple):
+        assert output.shape == ref_output.shape
+        assert torch.allclose(output, ref_output, rtol=1e-4, atol=1e-3)
+
+
+# With early exit off, grouped refinement matches the per-query loop
+def test_cascade_groups_matches_loop(spnet_model):
+    head = spnet_model.head
+    assert (head.cascade_exit_box_tol is None) and (head.cascade_exit_score_thresh is None)
+    assert head.num_cascade_steps == 2
+    generator = torch.Generator().manual_seed(0)
+    features, pred_emb_list, query_emb_list, pred_box_list, image_shape = get_cascade_inputs(
+        spnet_model, 5, generator)
+    head.get_cascade_stats()
+    with torch.no_grad():
+        output_list = head.test_cascade_groups(features, pred_emb_list, query_emb_list, pred_box_list, image_shape)
+        for g, output_tuple in enumerate(zip(*output_list)):
+            assert_cascade_equal(output_tuple, cascade_loop(head, features,
+                pred_emb_list[g], query_emb_list[g], pred_box_list[g], image_shape, head.num_cascade_steps))
+            assert_cascade_equal(head.test_cascade(features,
+                pred_emb_list[g], query_emb_list[g], pred_box_list[g], image_shape), output_tuple)
+    assert head.get_cascade_stats() == {'cascade_step1_survival': 1.0, 'cascade_step2_survival': 1.0}
+
+
+# Groups exit after the first step when their max score is below the threshold
+@pytest.mark.parametrize('exit_mode', ['none', 'some', 'all'])
+def test_cascade_groups_early_exit(spnet_model, monkeypatch, exit_mode):
+    head = spnet_model.head
+    num_group = 6
+    generator = torch.Generator().manual_seed(1)
+    features, pred_emb_list, query_emb_list, pred_box_list, image_shape = get_cascade_inputs(
+        spnet_model, num_group, generator)
+    with torch.no_grad():
+        ref_output_list = [[cascade_loop(head, features, pred_emb_list[g], query_emb_list[g], pred_box_list[g],
+            image_shape, num_steps) for g in range(num_group)] for num_steps in (1, 2)]
+    ## Exit threshold from the max score of each group after the first step
+    score_list = sorted([torch.sigmoid(logits.max(dim=1).values).max().item()
+        for _, _, logits in ref_output_list[0]])
+    exit_thresh = {'none': 0.0, 'some': (score_list[1] + score_list[2]) / 2, 'all': 1.1}[exit_mode]
+    exit_list = [torch.sigmoid(logits.max(dim=1).values).max().item() < exit_thresh
+        for _, _, logits in ref_output_list[0]]
+    assert sum(exit_list) == {'none': 0, 'some': 2, 'all': num_group}[exit_mode]
+    monkeypatch.setattr(head, 'cascade_exit_score_thresh', exit_thresh)
+    head.get_cascade_stats()
+    with torch.no_grad():
+        output_list = head.test_cascade_groups(features, pred_emb_list, query_emb_list, pred_box_list, image_shape)
+    for g, output_tuple in enumerate(zip(*output_list)):
+        assert_cascade_equal(output_tuple, ref_output_list[0 if exit_list[g] else 1][g])
+    assert head.get_cascade_stats() == {'cascade_step1_survival': 1.0,
+        'cascade_step2_survival': (num_group - sum(exit_list)) / num_group}
+    assert head.get_cascade_stats() == {'cascade_step1_survival': 0.0, 'cascade_step2_survival': 0.0}
@@ -0,0 +1,65 @@
+# Global imports
+import pytest
+## torch
+import torch
+
+# Package imports
+from osr.engine import evaluate
+
+
+# Max change of mAP and top-1 vs fp32 storage
+METRIC_TOL_DICT = {'fp16': 1e-3, 'int8': 5e-3}
+
+# Bytes per stored embedding of dim D: int8 adds a float32 scale
+def get_emb_bytes(emb_precision, emb_dim):
+    return {'fp32': 4 * emb_dim, 'fp16': 2 * emb_dim, 'int8': emb_dim + 4}[emb_precision]
+
+
+# Function to get the stored embedding bytes of all entries of a lookup
+def get_lookup_bytes(lookup):
+    num_bytes = 0
+    for value in lookup.values():
+        for entry in ([value] if isinstance(value, tuple) else value.values()):
+            num_bytes += entry.embeddings.numel() * entry.embeddings.element_size()
+            if entry.emb_scale is not None:
+                num_bytes += entry.emb_scale.numel() * entry.emb_scale.element_size()
+    return num_bytes
+
+
+# Embeddings are stored compactly, with a per-vector scale for int8
+@pytest.mark.parametrize('emb_precision', ['fp16', 'int8'])
+def test_quantize_lookup_storage(synthetic_eval, emb_precision):
+    _, _, image_lookup, oc_detection_lookup, qc_detection_lookup = synthetic_eval
+    for lookup in (image_lookup, oc_detection_lookup, qc_detection_lookup):
+        quantized_lookup = evaluate.quantize_lookup(lookup, emb_precision=emb_precision)
+        entry_list = [v for value in quantized_lookup.values()
+            for v in ([value] if isinstance(value, tuple) else value.values())]
+        num_emb = sum([len(e.embeddings) for e in entry_list])
+        emb_dim = entry_list[0].embeddings.shape[1]
+        assert get_lookup_bytes(quantized_lookup) == num_emb * get_emb_bytes(emb_precision, emb_dim)
+        assert get_lookup_bytes(lookup) == num_emb * get_emb_bytes('fp32', emb_dim)
+        for entry in entry_list:
+            if emb_precision == 'int8':
+                assert entry.embeddings.dtype == torch.int8
+                assert (entry.emb_scale is not None) and (entry.emb_scale.shape == (len(entry.embeddings),))
+            else:
+                assert entry.embeddings.dtype == torch.float16
+                assert entry.emb_scale is None
+
+
+# mAP and top-1 with reduced precision storage stay within tolerance of fp32
+@pytest.mark.parametrize('eval_mode', ['oc', 'qc'])
+@pytest.mark.parametrize('emb_precision', ['fp16', 'int8'])
+def test_quantize_lookup_metrics(synthetic_eval, compute_metrics_cpu, eval_mode, emb_precision):
+    data_loader, query_lookup, image_lookup, oc_detection_lookup, qc_detection_lookup = synthetic_eval
+    detection_lookup = oc_detection_lookup if eval_mode == 'oc' else qc_detection_lookup
+    metric_dict = compute_metrics_cpu(data_loader, query_lookup, image_lookup, detection_lookup,
+        eval_mode=eval_mode)
+    quantized_metric_dict = compute_metrics_cpu(data_loader, query_lookup,
+        evaluate.quantize_lookup(image_lookup, emb_precision=emb_precision),
+        evaluate.quantize_lookup(detection_lookup, emb_precision=emb_precision),
+        eval_mode=eval_mode)
+    metric_key_list = [k for k in metric_dict if k.endswith(('_mAP', '_top1'))]
+    assert len(metric_key_list) == 12
+    for k in metric_key_list:
+        assert abs(quantized_metric_dict[k] - metric_dict[k]) <= METRIC_TOL_DICT[emb_precision], k
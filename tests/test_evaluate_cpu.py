@@ -0,0 +1,70 @@
+# Global imports
+import os
+import pytest
+## torch
+import torch
+
+# Package imports
+from osr.engine import lookup_store
+from osr.engine import utils as engine_utils
+from osr.engine.main import eval_from_cache
+
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'configs')
+
+
+# Function to check that two metric dicts have the same keys and values
+def assert_metrics_equal(metric_dict, ref_metric_dict, atol=1e-6):
+    assert metric_dict.keys() == ref_metric_dict.keys()
+    for k, v in ref_metric_dict.items():
+        assert abs(metric_dict[k] - v) <= atol, (k, metric_dict[k], v)
+
+
+# All detection and retrieval eval modes give the same metrics on the CPU
+@pytest.mark.parametrize('eval_mode', ['oc', 'qc'])
+def test_compute_metrics_modes(synthetic_eval, compute_metrics_cpu, eval_mode):
+    data_loader, query_lookup, image_lookup, oc_detection_lookup, qc_detection_lookup = synthetic_eval
+    detection_lookup = oc_detection_lookup if eval_mode == 'oc' else qc_detection_lookup
+    ref_metric_dict = None
+    for det_eval_mode in ('orig', 'device'):
+        for retrieval_eval_mode in ('orig', 'fast'):
+            metric_dict = compute_metrics_cpu(data_loader, query_lookup, image_lookup, detection_lookup,
+                eval_mode=eval_mode, compute_anchor_metrics=(eval_mode == 'qc'),
+                det_eval_mode=det_eval_mode, retrieval_eval_mode=retrieval_eval_mode)
+            if ref_metric_dict is None:
+                ref_metric_dict = metric_dict
+                ## Detection and retrieval metrics of each protocol
+                assert 'test_ap@0.5' in metric_dict
+                for protocol_name in ('all', 'fixed', 'per_query'):
+                    assert 0 < metric_dict['test_{}_det_mAP'.format(protocol_name)] < 1
+            assert_metrics_equal(metric_dict, ref_metric_dict)
+
+
+# Metrics from stored lookups match metrics from the lookups in memory
+@pytest.mark.parametrize('eval_mode', ['oc', 'qc'])
+def test_eval_from_cache(synthetic_eval, compute_metrics_cpu, tmp_path, eval_mode):
+    data_loader, query_lookup, image_lookup, oc_detection_lookup, qc_detection_lookup = synthetic_eval
+    detection_lookup = oc_detection_lookup if eval_mode == 'oc' else qc_detection_lookup
+    store_dir = str(tmp_path / 'store')
+    lookup_store.save_lookups(store_dir, data_loader.sampler, eval_mode,
+        query_lookup, image_lookup, detection_lookup, use_fp16=False)
+    default_config, _ = engine_utils.load_config(os.path.join(CONFIG_DIR, 'default.yaml'))
+    config = {**default_config,
+        'device': 'cpu',
+        'retrieval_name_list': data_loader.sampler.retrieval_name_list,
+        'use_gfn': False,
+        'compute_anchor_metrics': eval_mode == 'qc',
+    }
+    ref_metric_dict = compute_metrics_cpu(data_loader, query_lookup, image_lookup, detection_lookup,
+        eval_mode=eval_mode, compute_anchor_metrics=config['compute_anchor_metrics'],
+        use_cws=config['use_cws'], det_eval_mode=config['det_eval_mode'],
+        retrieval_eval_mode=config['retrieval_eval_mode'], det_iou_thresh_list=config['det_iou_thresh_list'])
+    metric_dict = eval_from_cache(config, store_dir)
+    assert_metrics_equal({k:float(v) for k, v in metric_dict.items()}, ref_metric_dict)
+
+
+# A CUDA device falls back to the CPU on hosts without a GPU
+def test_get_device_fallback(monkeypatch):
+    monkeypatch.setattr(torch.cuda, 'is_available', lambda: False)
+    assert engine_utils.get_device({'device': 'cuda'}) == torch.device('cpu')
+    assert engine_utils.get_device({'device': 'cpu'}) == torch.device('cpu')
@@ -0,0 +1,72 @@
+# Global imports
+import io
+import pytest
+## torch
+import torch
+
+# Package imports
+from osr.engine.export import get_example_inputs, get_parity_image_size, check_parity, load_onnx_session
+from osr.models.export import EXPORT_OUTPUT_NAMES, get_export_model
+
+
+# Tracing size: parity is checked on random inputs other than the tracing inputs
+IMAGE_SIZE = (256, 320)
+NUM_QUERY = 4
+PARITY_SEED_LIST = [1, 2]
+
+
+# Random inputs, with search queries which match anchors of the image
+@pytest.fixture
+def get_inputs(get_anchor_queries):
+    def _get_inputs(model, inference_mode, image_size, seed=0):
+        if inference_mode == 'det':
+            return get_example_inputs(model, inference_mode, image_size, seed=seed)
+        generator = torch.Generator().manual_seed(seed)
+        image = torch.randn(1, 3, *image_size, generator=generator)
+        return (image, get_anchor_queries(model, image[0], NUM_QUERY + seed, generator))
+    return _get_inputs
+
+
+# Function to check parity of an exported graph with eager mode on inputs other than the tracing inputs
+def check_export_parity(model, export_model, inference_mode, get_inputs, dynamic=False, **kwargs):
+    for seed in PARITY_SEED_LIST:
+        image_size = get_parity_image_size(IMAGE_SIZE, seed, dynamic=dynamic)
+        inputs = get_inputs(model, inference_mode, image_size, seed=seed)
+        result_dict = check_parity(model, export_model, inference_mode, inputs, **kwargs)
+        assert result_dict['num_det'] > 0, result_dict
+        assert result_dict['match'], result_dict
+
+
+# The saved TorchScript graph matches eager mode
+@pytest.mark.parametrize('inference_mode', ['det', 'search_topk'])
+def test_torchscript_parity(spnet_model, get_inputs, inference_mode):
+    model = spnet_model
+    export_model = get_export_model(model, inference_mode, IMAGE_SIZE).eval()
+    trace_inputs = get_inputs(model, inference_mode, IMAGE_SIZE, seed=0)
+    with torch.no_grad():
+        traced_model = torch.jit.trace(export_model, trace_inputs, check_trace=False)
+    buffer = io.BytesIO()
+    torch.jit.save(traced_model, buffer)
+    buffer.seek(0)
+    check_export_parity(model, torch.jit.load(buffer), inference_mode, get_inputs, atol=1e-4, rtol=1e-5)
+
+
+# The ONNX det graph matches eager mode with onnxruntime, on image sizes other than the tracing size
+def test_onnx_parity(spnet_model, get_inputs, tmp_path):
+    model = spnet_model
+    pytest.importorskip('onnx')
+    pytest.importorskip('onnxruntime')
+    onnx_path = str(tmp_path / 'det.onnx')
+    export_model = get_export_model(model, 'det', None).eval()
+    trace_inputs = get_inputs(model, 'det', IMAGE_SIZE, seed=0)
+    output_names = EXPORT_OUTPUT_NAMES['det']
+    with torch.no_grad():
+        torch.onnx.export(export_model, trace_inputs, onnx_path, dynamo=False,
+            opset_version=17, input_names=['images'], output_names=list(output_names),
+            dynamic_axes={'images': {2: 'height', 3: 'width'},
+                **{k:{0: 'num_det'} for k in output_names if k != 'scene_emb'}})
+    for seed in PARITY_SEED_LIST:
+        height, width = get_parity_image_size(IMAGE_SIZE, seed, dynamic=True)
+        assert (height % 32 != 0) and (width % 32 != 0) and ((height, width) != IMAGE_SIZE)
+    check_export_parity(model, load_onnx_session(onnx_path), 'det', get_inputs,
+        dynamic=True, atol=1e-3, rtol=1e-4)
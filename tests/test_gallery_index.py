@@ -0,0 +1,90 @@
+# Global imports
+import os
+import numpy as np
+import pytest
+## torch
+import torch
+import torch.nn.functional as F
+
+# Package imports
+from osr.engine.gallery_index import GalleryIndex
+
+
+# Function to add random detections for a list of image keys
+def add_images(index, image_key_list, emb_dim=16):
+    for image_key in image_key_list:
+        index.add(image_key, torch.rand(3, 4), torch.rand(3), torch.randn(3, emb_dim))
+
+
+# An index stays writable after a crash between the segment rename and the manifest update
+def test_gallery_index_interrupted_flush(tmp_path, monkeypatch):
+    torch.manual_seed(0)
+    index_dir = str(tmp_path / 'index')
+    index = GalleryIndex(index_dir, segment_size=4)
+    add_images(index, ['a', 'b'])
+    index.flush()
+    ## Crash after the new segment is renamed into place, before the manifest is written
+    add_images(index, ['c', 'd'])
+    def _crash(segment_name_list):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(index, '_write_manifest', _crash)
+    with pytest.raises(KeyboardInterrupt):
+        index.flush()
+    ## Leftover of a write interrupted before the rename
+    os.makedirs(os.path.join(index_dir, 'seg_000002.tmp'))
+    assert sorted(os.listdir(index_dir)) == ['index.json', 'seg_000000', 'seg_000001', 'seg_000002.tmp']
+    # Reopen: orphans are removed, and new segments do not reuse their names
+    index = GalleryIndex(index_dir, segment_size=4)
+    assert sorted(os.listdir(index_dir)) == ['index.json', 'seg_000000']
+    assert sorted(index.image_lookup) == ['a', 'b']
+    add_images(index, ['c', 'd'])
+    index.flush()
+    index = GalleryIndex(index_dir, segment_size=4)
+    assert index.manifest['segment_list'] == ['seg_000000', 'seg_000003']
+    assert len(index) == 4
+
+
+# Function to read the live detections of each image of an index
+def get_index_entries(index):
+    entry_dict = {}
+    for image_key, (segment_index, image_index) in index.image_lookup.items():
+        segment = index.segment_list[segment_index]
+        det_mask = np.asarray(segment.det_image) == image_index
+        entry_dict[image_key] = (segment.det_boxes[det_mask], segment.det_scores[det_mask],
+            segment.det_emb[det_mask], segment.scene_emb[image_index])
+    return entry_dict
+
+
+# Size-tiered compaction bounds the segments per tier, and keeps the latest entry of each image
+def test_gallery_index_tiered_compaction(tmp_path):
+    torch.manual_seed(0)
+    merge_factor = 3
+    index = GalleryIndex(str(tmp_path / 'index'), segment_size=2, merge_factor=merge_factor, use_fp16=False)
+    ref_entry_dict = {}
+    for step in range(60):
+        ## Every 5th step re-adds an earlier image, superseding its entry
+        image_key = 'img_{}'.format(step - 3 if step % 5 == 4 else step)
+        num_det = step % 4
+        entry = (torch.rand(num_det, 4), torch.rand(num_det), F.normalize(torch.randn(num_det, 8), dim=-1),
+            torch.randn(8))
+        index.add(image_key, *entry[:3], scene_emb=entry[3])
+        ref_entry_dict[image_key] = entry
+        tier_list = [index._get_tier(s) for s in index.segment_list]
+        assert all([tier_list.count(t) < merge_factor for t in tier_list])
+    index.flush()
+    assert len(ref_entry_dict) == 48
+    assert len(index.segment_list) < len(ref_entry_dict) // 2
+    # Reopen, and compare with the latest added entries
+    index = GalleryIndex(str(tmp_path / 'index'), segment_size=2, merge_factor=merge_factor, use_fp16=False)
+    entry_dict = get_index_entries(index)
+    assert sorted(entry_dict) == sorted(ref_entry_dict)
+    for image_key, entry in entry_dict.items():
+        for arr, ref_arr in zip(entry, ref_entry_dict[image_key]):
+            assert np.allclose(arr, ref_arr.numpy(), atol=1e-6)
+    # A full compaction keeps the same entries
+    index.compact(full=True)
+    assert len(index.segment_list) == 1
+    full_entry_dict = get_index_entries(index)
+    for image_key, entry in entry_dict.items():
+        for arr, full_arr in zip(entry, full_entry_dict[image_key]):
+            assert np.array_equal(arr, full_arr)
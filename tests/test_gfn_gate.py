@@ -0,0 +1,149 @@
+# Global imports
+import pytest
+## torch
+import torch
+
+# Package imports
+from osr.engine import evaluate
+
+
+# The top-M gate excludes the query's own image, as the top-M point of the gate curve
+@pytest.mark.parametrize('top_m', [1, 3])
+def test_gfn_gate_top_m_matches_curve(top_m):
+    torch.manual_seed(0)
+    num_image, num_query = 10, 4
+    query_lookup = {100 + q:evaluate.QueryLookupEntry(image_id=q, person_id=torch.tensor(q), idx=q)
+        for q in range(num_query)}
+    image_lookup = {i:evaluate.ImageLookupEntry(person_ids=torch.tensor([i % num_query]))
+        for i in range(num_image)}
+    ## Each query scores highest on its own image
+    gfn_score_mat = torch.rand(num_image, num_query)
+    gfn_score_mat[torch.arange(num_query), torch.arange(num_query)] = 2.0
+    gfn_score_dict = dict(zip(range(num_image), gfn_score_mat))
+    gfn_gate = evaluate.get_gfn_gate(gfn_score_dict, query_lookup=query_lookup, top_m=top_m)
+    gate_op, top_m_op = evaluate.get_gfn_gate_curve(gfn_gate, query_lookup, image_lookup,
+        top_m_list=(top_m,))
+    assert gate_op['pair_frac'] == top_m_op['pair_frac'] == top_m / (num_image - 1)
+    assert gate_op['recall'] == top_m_op['recall']
+
+
+# Stand-in QC search model, which returns the synthetic detections of each (image, query) pair
+class SearchStub:
+    def __init__(self, qc_detection_lookup):
+        self.qc_detection_lookup = qc_detection_lookup
+        self.pair_list = []
+
+    def __call__(self, images, queries=None, inference_mode=None):
+        output_list = []
+        for query in queries:
+            image_output_list = []
+            for query_id in query['query_id']:
+                self.pair_list.append((query['image_id'], query_id))
+                detection = self.qc_detection_lookup[query['image_id']][query_id]
+                image_output_list.append({
+                    'det_boxes': detection.boxes, 'det_scores': detection.scores,
+                    'det_cws': detection.cws, 'det_labels': detection.labels,
+                    'det_emb': detection.embeddings, 'det_anchors': detection.anchors,
+                    'det_anchor_boxes': detection.anchor_boxes, 'det_anchor_scores': detection.anchor_scores,
+                })
+            output_list.append(image_output_list)
+        return output_list
+
+
+# Function to run gated QC search over the synthetic gallery, in batches of images
+def run_search(model, data_loader, query_lookup, image_lookup, gfn_gate, batch_size=4, **kwargs):
+    protocol_list = evaluate.get_protocol_list(data_loader)
+    image_id_list = list(image_lookup)
+    detection_lookup = {}
+    for batch_start in range(0, len(image_id_list), batch_size):
+        targets = [{'image_id': torch.tensor([i]), 'id': image_lookup[i].id}
+            for i in image_id_list[batch_start:batch_start + batch_size]]
+        detection_lookup.update(evaluate.run_step_search(model, ([None] * len(targets), targets),
+            list(query_lookup), query_lookup, image_lookup, protocol_list, gfn_gate=gfn_gate, **kwargs))
+    return detection_lookup
+
+
+# Function to get a gate from random GFN scores
+def get_random_gate(query_lookup, image_lookup, thresh):
+    generator = torch.Generator().manual_seed(0)
+    gfn_score_dict = {i:torch.rand(len(query_lookup), generator=generator) for i in image_lookup}
+    return evaluate.get_gfn_gate(gfn_score_dict, query_lookup=query_lookup, thresh=thresh)
+
+
+# Function to index queries as in compute_metrics
+def get_indexed_query_lookup(query_lookup):
+    return {q:e._replace(idx=i) for i, (q, e) in enumerate(query_lookup.items())}
+
+
+# Gated pairs skip the model, and get empty entries in the precision of the searched pairs
+@pytest.mark.parametrize('emb_precision', ['fp32', 'fp16', 'int8'])
+def test_gfn_gate_skips_pairs(synthetic_eval, emb_precision):
+    data_loader, query_lookup, image_lookup, _, qc_detection_lookup = synthetic_eval
+    query_lookup = get_indexed_query_lookup(query_lookup)
+    gfn_gate = get_random_gate(query_lookup, image_lookup, thresh=0.5)
+    model = SearchStub(qc_detection_lookup)
+    detection_lookup = run_search(model, data_loader, query_lookup, image_lookup, gfn_gate,
+        compute_anchor_metrics=True, emb_precision=emb_precision)
+    # Pairs to search, with and without the gate
+    image_query_dict = evaluate.get_image_query_dict(evaluate.get_protocol_list(data_loader), list(query_lookup),
+        [{'image_id': torch.tensor([i]), 'id': image_lookup[i].id} for i in image_lookup])
+    pair_list = [(i, q) for i, query_id_list in image_query_dict.items() for q in query_id_list]
+    keep_pair_set = {(i, q) for i, q in pair_list
+        if gfn_gate.score_dict[i][query_lookup[q].idx] >= gfn_gate.query_thresh[query_lookup[q].idx]}
+    assert 0 < len(keep_pair_set) < len(pair_list)
+    assert sorted(model.pair_list) == sorted(keep_pair_set)
+    assert sorted([(i, q) for i in detection_lookup for q in detection_lookup[i]]) == sorted(pair_list)
+    # Entries of gated and searched pairs
+    emb_dim = next(iter(query_lookup.values())).embedding.shape[-1]
+    emb_dtype = {'fp32': torch.float32, 'fp16': torch.float16, 'int8': torch.int8}[emb_precision]
+    for image_id, query_id in pair_list:
+        detection = detection_lookup[image_id][query_id]
+        if (image_id, query_id) in keep_pair_set:
+            assert len(detection.boxes) == len(qc_detection_lookup[image_id][query_id].boxes)
+        else:
+            assert detection.boxes.shape == (0, 4)
+            assert detection.scores.shape == detection.cws.shape == detection.labels.shape == (0,)
+            assert detection.anchors.shape == detection.anchor_boxes.shape == (0, 4)
+            assert detection.anchor_scores.shape == (0,)
+        assert detection.embeddings.shape == (len(detection.boxes), emb_dim)
+        assert detection.embeddings.dtype == emb_dtype
+        if emb_precision == 'int8':
+            assert detection.emb_scale.dtype == torch.float32
+            assert detection.emb_scale.shape == (len(detection.boxes),)
+        else:
+            assert detection.emb_scale is None
+
+
+# With every pair of a batch gated, the model is not run
+def test_gfn_gate_skips_model(synthetic_eval):
+    data_loader, query_lookup, image_lookup, _, _ = synthetic_eval
+    query_lookup = get_indexed_query_lookup(query_lookup)
+    gfn_gate = get_random_gate(query_lookup, image_lookup, thresh=2.0)
+    def _model(*args, **kwargs):
+        raise AssertionError('Model run with every pair gated')
+    detection_lookup = run_search(_model, data_loader, query_lookup, image_lookup, gfn_gate)
+    assert sorted(detection_lookup) == sorted(image_lookup)
+    assert all([len(d.boxes) == 0 for entry in detection_lookup.values() for d in entry.values()])
+
+
+# The GT of gated pairs counts as missed: detection recall is additive over disjoint sets of searched pairs
+def test_gfn_gate_counts_gated_gt(synthetic_eval, compute_metrics_cpu):
+    data_loader, query_lookup, image_lookup, _, qc_detection_lookup = synthetic_eval
+    query_lookup = get_indexed_query_lookup(query_lookup)
+    gfn_gate = get_random_gate(query_lookup, image_lookup, thresh=0.5)
+    ## Complement of the gate: keeps exactly the pairs it gates
+    inv_gfn_gate = evaluate.GFNGate(score_dict={i:-s for i, s in gfn_gate.score_dict.items()},
+        query_thresh=torch.nextafter(-gfn_gate.query_thresh, torch.tensor(float('inf'))))
+    metric_dict_dict = {}
+    for gate_name, _gfn_gate in [('none', None), ('gate', gfn_gate), ('inv', inv_gfn_gate),
+            ('all', get_random_gate(query_lookup, image_lookup, thresh=2.0))]:
+        detection_lookup = run_search(SearchStub(qc_detection_lookup), data_loader,
+            query_lookup, image_lookup, _gfn_gate)
+        metric_dict_dict[gate_name] = compute_metrics_cpu(data_loader, query_lookup, image_lookup,
+            detection_lookup, eval_mode='qc')
+    recall_dict = {k:v['test_recall@0.5'] for k, v in metric_dict_dict.items()}
+    assert 0 < recall_dict['gate'] < recall_dict['none']
+    assert recall_dict['gate'] + recall_dict['inv'] == pytest.approx(recall_dict['none'])
+    for k, v in metric_dict_dict['all'].items():
+        if k.startswith('test_') and k.endswith(('recall@0.5', 'ap@0.5', '_det_mAP', '_det_top1')):
+            assert v == 0, k
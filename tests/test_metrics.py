@@ -0,0 +1,83 @@
+# Global imports
+import numpy as np
+import pytest
+from sklearn.metrics import average_precision_score
+## torch
+import torch
+
+# Package imports
+from osr.engine.metrics import average_precision, segment_average_precision, padded_average_precision, ragged_range
+
+
+# Function to compute the sklearn AP of each segment, with 0 for segments without positives
+def get_reference_ap(labels, scores, seg, num_seg):
+    scores = np.nan_to_num(np.asarray(scores, dtype=np.float64), nan=0, posinf=0, neginf=0)
+    ref_ap = np.zeros(num_seg)
+    for i in range(num_seg):
+        seg_mask = seg == i
+        if labels[seg_mask].sum() > 0:
+            ref_ap[i] = average_precision_score(labels[seg_mask].tolist(), scores[seg_mask])
+    return ref_ap
+
+
+# Function to compute AP of each segment with the segmented, padded and single-query layouts
+def get_ap_list(labels, scores, seg, num_seg):
+    counts = np.bincount(seg, minlength=num_seg)
+    ## Segmented layout, with shuffled order
+    perm = np.random.default_rng(0).permutation(len(seg))
+    seg_ap = segment_average_precision(torch.from_numpy(labels[perm]), torch.from_numpy(scores[perm]),
+        torch.from_numpy(seg[perm]), num_seg)
+    ## Padded layout: sort by segment to place elements in their rows
+    sort_idx = np.argsort(seg, kind='stable')
+    _, local = ragged_range(torch.from_numpy(counts))
+    max_count = max(int(counts.max()), 1)
+    pad_labels = torch.zeros(num_seg, max_count, dtype=torch.float64)
+    pad_scores = torch.zeros(num_seg, max_count, dtype=torch.float32)
+    pad_mask = torch.zeros(num_seg, max_count, dtype=torch.bool)
+    pad_seg = torch.from_numpy(seg[sort_idx])
+    pad_labels[pad_seg, local] = torch.from_numpy(labels[sort_idx])
+    pad_scores[pad_seg, local] = torch.from_numpy(scores[sort_idx])
+    pad_mask[pad_seg, local] = True
+    pad_ap = padded_average_precision(pad_labels, pad_scores, mask=pad_mask)
+    ## Single query
+    single_ap = np.array([average_precision(labels[seg == i], scores[seg == i]) for i in range(num_seg)])
+    return [seg_ap, pad_ap, single_ap]
+
+
+# Random inputs with ties, invalid scores, all-negative and empty segments
+@pytest.mark.parametrize('seed', range(5))
+def test_average_precision_random(seed):
+    rng = np.random.default_rng(seed)
+    for _ in range(100):
+        num_seg = int(rng.integers(1, 8))
+        counts = rng.integers(0, 64, size=num_seg)
+        seg = np.repeat(np.arange(num_seg), counts)
+        labels = (rng.random(len(seg)) < rng.random()).astype(np.float64)
+        ## Coarse scores to produce ties, and a few invalid scores
+        scores = np.round(rng.normal(size=len(seg)), int(rng.integers(0, 3))).astype(np.float32)
+        scores[rng.random(len(seg)) < 0.05] = np.nan
+        scores[rng.random(len(seg)) < 0.02] = np.inf
+        ref_ap = get_reference_ap(labels, scores, seg, num_seg)
+        for ap in get_ap_list(labels, scores, seg, num_seg):
+            assert np.array_equal(ap, ref_ap), (ap, ref_ap)
+
+
+# Hand-written edge cases: all tied, all negative, empty and single-element segments
+def test_average_precision_edge_cases():
+    seg = np.array([0, 0, 0, 0, 1, 1, 1, 3, 4, 4, 4])
+    labels = np.array([1, 0, 1, 0, 0, 0, 0, 1, 1, 0, 1], dtype=np.float64)
+    scores = np.array([0.5, 0.5, 0.5, 0.5, 0.9, 0.1, 0.3, 0.2, 0.7, 0.7, 0.1], dtype=np.float32)
+    num_seg = 5
+    ref_ap = get_reference_ap(labels, scores, seg, num_seg)
+    ## All tied scores give the positive rate, all-negative and empty segments give 0
+    assert ref_ap[0] == 0.5
+    assert ref_ap[1] == ref_ap[2] == 0
+    assert ref_ap[3] == 1
+    for ap in get_ap_list(labels, scores, seg, num_seg):
+        assert np.array_equal(ap, ref_ap), (ap, ref_ap)
+
+
+# No inputs at all
+def test_average_precision_empty():
+    assert np.array_equal(segment_average_precision([], [], [], 3), np.zeros(3))
+    assert average_precision([], []) == 0
@@ -0,0 +1,117 @@
+# Global imports
+import pytest
+## torch
+import torch
+import pytorch_lightning as pl
+
+# Package imports
+from osr.engine.main import QueryCentricValLoop
+from osr.engine.pipeline import PackedHostTransfer, PendingOutput, _pack_tensors, _unpack_tensors
+
+
+# Function to get tensors of mixed dtypes and shapes, including empty tensors
+def get_mixed_tensors(device):
+    generator = torch.Generator().manual_seed(0)
+    tensor_list = [
+        torch.randn(3, 4, generator=generator),
+        torch.randn(5, generator=generator).half(),
+        torch.zeros(0, 4, dtype=torch.long),
+        torch.randint(10, (2, 3), generator=generator),
+        torch.rand(2, 3, generator=generator) > 0.5,
+        torch.zeros(0),
+        torch.tensor(7),
+        torch.randn(2, 2, 2, generator=generator),
+        torch.zeros(0, dtype=torch.half),
+    ]
+    return [t.to(device) for t in tensor_list]
+
+
+# Function to check that host tensors match the per-tensor copies
+def assert_tensors_equal(tensor_list, ref_tensor_list):
+    assert len(tensor_list) == len(ref_tensor_list)
+    for tensor, ref_tensor in zip(tensor_list, ref_tensor_list):
+        assert tensor.device.type == 'cpu'
+        assert tensor.dtype == ref_tensor.dtype
+        assert torch.equal(tensor, ref_tensor)
+
+
+# Packed transfers give the same host tensors as a .cpu() copy of each tensor
+@pytest.mark.parametrize('device', ['cpu',
+    pytest.param('cuda', marks=pytest.mark.skipif(not torch.cuda.is_available(), reason='no CUDA device'))])
+def test_packed_host_transfer(device):
+    tensor_list = get_mixed_tensors(device)
+    ref_tensor_list = [t.cpu() for t in tensor_list]
+    assert_tensors_equal(PackedHostTransfer(tensor_list).wait(), ref_tensor_list)
+    ## Packing and unpacking the tensors of each dtype
+    for dtype in set([t.dtype for t in tensor_list]):
+        index_list = [i for i, t in enumerate(tensor_list) if t.dtype == dtype]
+        flat = _pack_tensors([tensor_list[i] for i in index_list]).cpu()
+        assert flat.dim() == 1
+        assert_tensors_equal(_unpack_tensors(flat, [tensor_list[i].shape for i in index_list]),
+            [ref_tensor_list[i] for i in index_list])
+    ## Outputs of the same transfer can be built asynchronously
+    pending_output = PendingOutput(PackedHostTransfer(tensor_list), lambda host_list: host_list[::-1])
+    assert_tensors_equal(pending_output.get(), ref_tensor_list[::-1])
+
+
+# Eval module which builds a lookup per eval stage from its batches, like PLModule
+class LookupModule(pl.LightningModule):
+    def __init__(self, test_prefetch):
+        super().__init__()
+        self.config = {'test_prefetch': test_prefetch}
+        self.layer = torch.nn.Linear(4, 2)
+        self.lookup_dict = {}
+        self.batch_device_list = []
+
+    def test_step(self, batch, batch_idx, dataloader_idx=0):
+        if batch_idx == 0:
+            self.step_output_list = []
+            self.pending_output = None
+        self.batch_device_list.append(batch['image'].device)
+        emb = self.layer(batch['image'])
+        image_id_list = batch['image_id'].tolist()
+        ## With prefetching, the outputs are copied to the host while the next step runs
+        if self.config['test_prefetch']:
+            if self.pending_output is not None:
+                self.step_output_list.append(self.pending_output.get())
+            self.pending_output = PendingOutput(PackedHostTransfer(list(emb)),
+                lambda host_list: dict(zip(image_id_list, host_list)))
+        else:
+            self.step_output_list.append(dict(zip(image_id_list, emb.cpu())))
+
+    def on_test_epoch_end(self, eval_stage=None):
+        if self.pending_output is not None:
+            self.step_output_list.append(self.pending_output.get())
+            self.pending_output = None
+        self.lookup_dict[eval_stage] = {k: v for d in self.step_output_list for k, v in d.items()}
+
+
+# Function to run the query-centric eval loop on two eval stages
+def run_loop(test_prefetch, loader_list):
+    torch.manual_seed(0)
+    module = LookupModule(test_prefetch)
+    trainer = pl.Trainer(accelerator='auto', devices=1, logger=False, enable_checkpointing=False,
+        enable_progress_bar=False, enable_model_summary=False)
+    trainer.test_loop = QueryCentricValLoop(trainer)
+    trainer.test(module, dataloaders=loader_list, verbose=False)
+    return module
+
+
+# The eval loop gives the same lookups with and without prefetching
+def test_query_centric_val_loop_prefetch():
+    loader_list = []
+    for num_image in (10, 4):
+        dataset = [{'image': torch.randn(4), 'image_id': torch.tensor(i)} for i in range(num_image)]
+        loader_list.append(torch.utils.data.DataLoader(dataset, batch_size=3))
+    module_dict = {test_prefetch: run_loop(test_prefetch, loader_list) for test_prefetch in (False, True)}
+    ref_lookup_dict = module_dict[False].lookup_dict
+    assert list(ref_lookup_dict) == [0, 1]
+    assert [list(ref_lookup_dict[k]) for k in ref_lookup_dict] == [list(range(10)), list(range(4))]
+    lookup_dict = module_dict[True].lookup_dict
+    assert lookup_dict.keys() == ref_lookup_dict.keys()
+    for eval_stage, ref_lookup in ref_lookup_dict.items():
+        assert lookup_dict[eval_stage].keys() == ref_lookup.keys()
+        assert_tensors_equal(list(lookup_dict[eval_stage].values()), list(ref_lookup.values()))
+    ## Prefetched batches are on the device of the module
+    module = module_dict[True]
+    assert all([device == module.device for device in module.batch_device_list])
@@ -0,0 +1,80 @@
+# Global imports
+import pytest
+## torch
+import torch
+
+# Package imports
+from osr.models.spnet import _plan_chunk_size
+
+
+# The planned chunk is the largest which fits the budget, and at least 1
+@pytest.mark.parametrize('num_item', [0, 1, 7, 1000])
+@pytest.mark.parametrize('bytes_per_item', [0, 1, 100, 10**9])
+@pytest.mark.parametrize('mem_bytes', [0, 99, 100, 1024**3])
+@pytest.mark.parametrize('max_chunk_size', [None, 5])
+def test_plan_chunk_size(num_item, bytes_per_item, mem_bytes, max_chunk_size):
+    chunk_size = _plan_chunk_size(num_item, bytes_per_item, mem_bytes, max_chunk_size=max_chunk_size)
+    assert chunk_size >= 1
+    assert chunk_size <= max(num_item, 1)
+    if max_chunk_size is not None:
+        assert chunk_size <= max_chunk_size
+    bytes_per_item = max(bytes_per_item, 1)
+    if chunk_size > 1:
+        assert chunk_size * bytes_per_item <= mem_bytes
+    if (chunk_size < num_item) and (chunk_size != max_chunk_size):
+        assert (chunk_size + 1) * bytes_per_item > mem_bytes
+
+
+# Query chunks follow the budget, and back off on OOM
+def test_iter_query_chunks(spnet_model, monkeypatch):
+    head = spnet_model.head
+    monkeypatch.setattr(head, 'search_chunk_cap', {})
+    query_emb = torch.zeros(10, 4)
+    monkeypatch.setattr(head, 'search_chunk_bytes', 350)
+    assert list(head.iter_query_chunks(query_emb, 100, 16, 'topk', len)) == [3, 3, 3, 1]
+    monkeypatch.setattr(head, 'search_chunk_bytes', None)
+    assert list(head.iter_query_chunks(query_emb, 100, 4, 'topk', len)) == [4, 4, 2]
+    ## OOM for chunks of more than 2 queries
+    def _chunk_func(query_emb_per_chunk):
+        if len(query_emb_per_chunk) > 2:
+            raise RuntimeError('CUDA out of memory')
+        return len(query_emb_per_chunk)
+    monkeypatch.setattr(head, 'search_chunk_bytes', 400)
+    assert list(head.iter_query_chunks(query_emb, 100, 16, 'topk', _chunk_func)) == [2, 2, 2, 2, 2]
+    assert head.search_chunk_cap == {'topk': 2}
+    assert list(head.iter_query_chunks(query_emb, 100, 16, 'topk', len)) == [2, 2, 2, 2, 2]
+
+
+# Searching queries in chunks of 1 gives the same outputs as in a single chunk
+def test_chunked_search_matches_single_chunk(spnet_model, get_anchor_queries, monkeypatch):
+    num_query = 6
+    generator = torch.Generator().manual_seed(0)
+    image = torch.randn(3, 256, 320, generator=generator)
+    query_emb = get_anchor_queries(spnet_model, image, num_query, generator)
+    queries = [{'query_id': list(range(num_query)), 'query_emb': list(query_emb.split(1)),
+        'query_loc_emb': list(query_emb.split(1)), 'image_id': 0}]
+    # Record the size of each searched chunk
+    head = spnet_model.head
+    iter_query_chunks = head.iter_query_chunks
+    chunk_size_list = []
+    def _iter_query_chunks(query_emb_per_image, bytes_per_query, default_chunk_size, search_mode, chunk_func):
+        def _chunk_func(query_emb_per_chunk):
+            chunk_size_list.append(len(query_emb_per_chunk))
+            return chunk_func(query_emb_per_chunk)
+        return iter_query_chunks(query_emb_per_image, bytes_per_query, default_chunk_size, search_mode, _chunk_func)
+    monkeypatch.setattr(head, 'iter_query_chunks', _iter_query_chunks)
+    monkeypatch.setattr(head, 'search_chunk_cap', {})
+    output_list_dict = {}
+    for chunk_name, chunk_bytes in [('single', 1024**4), ('chunked', 1)]:
+        monkeypatch.setattr(head, 'search_chunk_bytes', chunk_bytes)
+        chunk_size_list.clear()
+        with torch.no_grad():
+            output_list_dict[chunk_name] = spnet_model([image], queries=queries, inference_mode='search_topk')[0]
+        assert chunk_size_list == ([num_query] if chunk_name == 'single' else [1] * num_query)
+    assert len(output_list_dict['single']) == len(output_list_dict['chunked']) == num_query
+    assert all([len(o['det_scores']) > 0 for o in output_list_dict['single']])
+    for output, chunked_output in zip(output_list_dict['single'], output_list_dict['chunked']):
+        assert output.keys() == chunked_output.keys()
+        for k in output:
+            assert output[k].shape == chunked_output[k].shape, k
+            assert torch.allclose(output[k].float(), chunked_output[k].float(), rtol=1e-4, atol=1e-3), k
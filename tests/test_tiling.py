@@ -0,0 +1,117 @@
+# Global imports
+import pytest
+## torch
+import torch
+
+
+# Function to run the model on one image, with or without tiling
+def run_model(model, monkeypatch, image, tile_size, **kwargs):
+    monkeypatch.setattr(model, 'tile_size', tile_size)
+    with torch.no_grad():
+        return model([image], **kwargs)[0]
+
+
+# Function to check that two model outputs have the same keys and values
+def assert_outputs_equal(output, ref_output):
+    assert output.keys() == ref_output.keys()
+    for k in ref_output:
+        assert output[k].shape == ref_output[k].shape, k
+        assert torch.allclose(output[k].float(), ref_output[k].float(), rtol=1e-4, atol=1e-3), k
+
+
+# A frame which fits in one tile gives the same outputs as the untiled model
+@pytest.mark.parametrize('inference_mode', ['det', 'both', 'gt', 'search_topk'])
+def test_single_tile_matches_forward(spnet_model, get_anchor_queries, monkeypatch, inference_mode):
+    generator = torch.Generator().manual_seed(0)
+    image = torch.randn(3, 256, 320, generator=generator)
+    kwargs = {'inference_mode': inference_mode}
+    if inference_mode in ('gt', 'both'):
+        kwargs['targets'] = [{'boxes': torch.tensor([[10., 20., 80., 200.], [150., 30., 300., 250.]]), 'image_id': 0}]
+    if inference_mode == 'search_topk':
+        query_emb = get_anchor_queries(spnet_model, image, 3, generator)
+        kwargs['queries'] = [{'query_id': list(range(3)), 'query_emb': list(query_emb.split(1)),
+            'query_loc_emb': list(query_emb.split(1)), 'image_id': 0}]
+    ref_output = run_model(spnet_model, monkeypatch, image, None, **kwargs)
+    ## Record the frames run through the tiled forward
+    forward_tiled = spnet_model.forward_tiled
+    frame_shape_list = []
+    def _forward_tiled(images, **_kwargs):
+        frame_shape_list.append(tuple(images[0].shape[-2:]))
+        return forward_tiled(images, **_kwargs)
+    monkeypatch.setattr(spnet_model, 'forward_tiled', _forward_tiled)
+    output = run_model(spnet_model, monkeypatch, image, 512, **kwargs)
+    assert frame_shape_list == [(256, 320)]
+    if inference_mode == 'search_topk':
+        assert len(output) == len(ref_output) == 3
+        assert all([len(o['det_scores']) > 0 for o in ref_output])
+        for _output, _ref_output in zip(output, ref_output):
+            assert_outputs_equal(_output, _ref_output)
+    else:
+        if inference_mode != 'gt':
+            assert len(ref_output['det_scores']) > 0
+        assert_outputs_equal(output, ref_output)
+
+
+# Detections of overlapping tiles are shifted to frame coordinates, merged, and capped
+def test_merge_tile_detections(spnet_model, monkeypatch):
+    monkeypatch.setattr(spnet_model, 'detections_per_img', 4)
+    window_list = [(0, 0, 200, 256), (120, 0, 320, 256)]
+    ## Tile boxes in tile coordinates, and their frame boxes
+    tile_det_list = [
+        [((130., 50., 180., 150.), 0.9), ((170., 60., 200., 160.), 0.7),
+            ((10., 10., 40., 80.), 0.6), ((10., 150., 40., 230.), 0.4)],
+        [((10., 50., 60., 150.), 0.8), ((50., 60., 110., 160.), 0.5), ((130., 10., 170., 80.), 0.3)],
+    ]
+    tile_output_list = []
+    for tile_index, tile_det in enumerate(tile_det_list):
+        boxes, scores = zip(*tile_det)
+        scores = torch.tensor(scores)
+        tile_output_list.append({
+            'det_boxes': torch.tensor(boxes),
+            'det_scores': scores,
+            'det_cws': scores,
+            'det_labels': torch.ones(len(scores), dtype=torch.long),
+            'det_emb': scores.unsqueeze(1).repeat(1, 8),
+        })
+    output = spnet_model._merge_tile_detections(tile_output_list, window_list, (256, 320))
+    ## Both tiles see the first box, and the box cut by the first tile is covered by the second tile,
+    ## so the 5 merged detections are capped at 4
+    assert torch.equal(output['det_boxes'], torch.tensor([[130., 50., 180., 150.], [10., 10., 40., 80.],
+        [170., 60., 230., 160.], [10., 150., 40., 230.]]))
+    assert torch.equal(output['det_scores'], torch.tensor([0.9, 0.6, 0.5, 0.4]))
+    assert torch.equal(output['det_cws'], output['det_scores'])
+    assert torch.equal(output['det_emb'], output['det_scores'].unsqueeze(1).repeat(1, 8))
+    assert output['det_labels'].tolist() == [1, 1, 1, 1]
+
+
+# Tiled detections of a frame split into 4 tiles are tile detections in frame coordinates, capped by score
+def test_forward_tiled_overlap(spnet_model, monkeypatch):
+    generator = torch.Generator().manual_seed(0)
+    image = torch.randn(3, 256, 320, generator=generator)
+    monkeypatch.setattr(spnet_model, 'tile_overlap', 64)
+    ## Record the detections of each tile
+    forward = spnet_model.forward
+    tile_output_list = []
+    def _forward(images, **kwargs):
+        output_list = forward(images, **kwargs)
+        if not kwargs.get('use_tiling', True):
+            assert [tuple(i.shape[-2:]) for i in images] == [(192, 192)] * 4
+            tile_output_list.extend(output_list)
+        return output_list
+    monkeypatch.setattr(spnet_model, 'forward', _forward)
+    output = run_model(spnet_model, monkeypatch, image, 192, inference_mode='det')
+    assert len(tile_output_list) == 4
+    window_list = [(x, y, x + 192, y + 192) for x, y in [(0, 0), (128, 0), (0, 64), (128, 64)]]
+    tile_boxes = torch.cat([o['det_boxes'] + torch.tensor([x, y, x, y], dtype=torch.float)
+        for o, (x, y, _, _) in zip(tile_output_list, window_list)])
+    boxes, scores = output['det_boxes'], output['det_scores']
+    assert 0 < len(boxes) < len(tile_boxes)
+    assert ((boxes[:, None] - tile_boxes[None]).abs().amax(dim=2) < 1e-4).any(dim=1).all()
+    assert (boxes[:, 2] > 192).any() and (boxes[:, 3] > 192).any()
+    assert (scores[:-1] >= scores[1:]).all()
+    ## The merge cap keeps the best detections
+    detections_per_img = len(boxes) // 2
+    monkeypatch.setattr(spnet_model, 'detections_per_img', detections_per_img)
+    capped_output = spnet_model._merge_tile_detections(tile_output_list, window_list, (256, 320))
+    assert_outputs_equal(capped_output, {k: (v[:detections_per_img] if k.startswith('det_') else v)
+        for k, v in output.items()})